@@ -1,13 +1,40 @@
 #ifndef SOCKET_MANAGER_H
 #define SOCKET_MANAGER_H
 
+#include <stdint.h>
 #include "freertos/FreeRTOS.h"
 #include "freertos/queue.h"
 
+// Binary metrics payload, an alternative to the JSON string inside the same length-prefixed
+// frame. Little-endian, decoded by esp32Payload.py on the gateway.
+#define BINARY_PAYLOAD_MAGIC 0xB5
+#define BINARY_PAYLOAD_VERSION 1
+
+// Keep in step with METRIC_NAMES in esp32Payload.py
+typedef enum {
+    METRIC_ID_GAS = 1,
+    METRIC_ID_ALARMING = 2
+} esp32_metric_id_t;
+
+typedef struct __attribute__((packed)) {
+    uint8_t magic;
+    uint8_t version;
+    uint8_t count;
+    uint8_t reserved;
+    uint32_t epoch;  // Seconds since 1970 UTC, 0 when the clock is not synchronised
+} binary_payload_header_t;
+
+typedef struct __attribute__((packed)) {
+    uint8_t metric_id;
+    float value;
+    float threshold;  // NAN when the metric has no threshold
+} binary_payload_reading_t;
+
 bool bEstablishConnection(void);
 int iSendMetrics(const char *metrics);
 void vSocketTask(void *pvParameters);
 int iCreateProtocol(const char *metrics, char **out_buffer);
+int iCreateBinaryProtocol(const binary_payload_reading_t *readings, uint8_t count, uint32_t epoch, char **out_buffer);
 
 extern int global_sock;  // Global socket variable for shared access.
 extern QueueHandle_t socket_queue;
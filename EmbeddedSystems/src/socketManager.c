@@ -49,6 +49,45 @@ int iCreateProtocol(const char *metrics, char **out_buffer) {
     return total_length;
 }
 
+int iCreateBinaryProtocol(const binary_payload_reading_t *readings, uint8_t count, uint32_t epoch, char **out_buffer) {
+    size_t payload_length = sizeof(binary_payload_header_t) + count * sizeof(binary_payload_reading_t);
+    size_t device_name_length = strlen(CONFIG_DEVICE_NAME);
+    size_t total_length = HEADER_SIZE + device_name_length + 1 + payload_length;
+
+    // Allocate memory for the protocol buffer
+    char *buffer = malloc(total_length);
+    if (!buffer) {
+        fprintf(stderr, "Failed to allocate memory for protocol buffer.\n");
+        return -1;
+    }
+
+    // Fill the header, the frame length stays big-endian as for JSON payloads
+    buffer[0] = (payload_length >> 24) & 0xFF;
+    buffer[1] = (payload_length >> 16) & 0xFF;
+    buffer[2] = (payload_length >> 8) & 0xFF;
+    buffer[3] = payload_length & 0xFF;
+
+    // Add the device name (null-terminated)
+    memcpy(buffer + HEADER_SIZE, CONFIG_DEVICE_NAME, device_name_length + 1);
+
+    // Add the payload, the ESP32 is little-endian so the structs are copied as they are
+    binary_payload_header_t header = {
+        .magic = BINARY_PAYLOAD_MAGIC,
+        .version = BINARY_PAYLOAD_VERSION,
+        .count = count,
+        .reserved = 0,
+        .epoch = epoch
+    };
+    char *payload = buffer + HEADER_SIZE + device_name_length + 1;
+    memcpy(payload, &header, sizeof(header));
+    memcpy(payload + sizeof(header), readings, count * sizeof(binary_payload_reading_t));
+
+    // Set the out_buffer pointer
+    *out_buffer = buffer;
+
+    return total_length;
+}
+
 bool bEstablishConnection() {
     ESP_LOGI(TAG, "Establishing connection...");
     struct sockaddr_in dest_addr;
@@ -1,3 +1,10 @@
+"""
+Library module grouping snapshots into devices for upload.
+Snapshots are indexed by device name as they are added, so grouping is a single pass, each
+device appears once however many snapshots it reported, and one manager is reused across
+upload cycles with drain.
+"""
+
 import logging
 from systemMetrics import DTO_Aggregator, DTO_DataSnapshot, DTO_Device
 
@@ -5,34 +12,48 @@ from systemMetrics import DTO_Aggregator, DTO_DataSnapshot, DTO_Device
 class aggregationManager:
     logger = logging.getLogger()
     def __init__(self):
-        self.snapshots = list()
-        self.devices = list()
-    
-    def addSnapshotToAggregator(self, snapshot:DTO_DataSnapshot, name):
-        if not snapshot.device_name:
-            snapshot.device_name = name
-        self.snapshots.append(snapshot)
+        # device name -> DTO_Device, in the order devices were first seen
+        self.index = {}
+
+    def addSnapshotToAggregator(self, snapshot:DTO_DataSnapshot, name=None):
+        self.addSnapshotsToAggregator((snapshot,), name)
+
+    def addSnapshotsToAggregator(self, snapshots, name=None):
+        index = self.index
+        for snapshot in snapshots:
+            if not snapshot.device_name:
+                snapshot.device_name = name
+            device = index.get(snapshot.device_name)
+            if device is None:
+                device = index[snapshot.device_name] = DTO_Device(snapshot.device_name)
+            device.data_snapshots.append(snapshot)
 
     def addDeviceToAggregator(self, device:DTO_Device):
-        self.devices.append(device)
-    
+        """Add a device, merging its snapshots into an already indexed device of the same name."""
+        existing = self.index.get(device.name)
+        if existing is None:
+            self.index[device.name] = device
+        elif existing is not device:
+            existing.data_snapshots.extend(device.data_snapshots)
+
     def getAggregatedSnapshotsForDevice(self, name):
-        snapshotsForDevice = list()
-        for snapshot in self.snapshots:
-            if snapshot.device_name == name:
-                snapshotsForDevice.append(snapshot)
-        device = DTO_Device(
-            name,
-            data_snapshots=snapshotsForDevice
-        )
-        return device
+        device = self.index.get(name)
+        return device if device is not None else DTO_Device(name)
 
-    
     def getAggregatedDevices(self, platform_id, name):
         aggregator = DTO_Aggregator(
             platform_uuid=platform_id,
             name=name,
-            devices=self.devices
+            devices=list(self.index.values())
         )
         self.logger.debug("Aggregator: %s", aggregator)
-        return aggregator
\ No newline at end of file
+        return aggregator
+
+    def drain(self, platform_id, name):
+        """getAggregatedDevices, then empty the index for the next cycle."""
+        aggregator = self.getAggregatedDevices(platform_id, name)
+        self.index = {}
+        return aggregator
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,4 @@
+"""
+Benchmarks and load tests. They import the library modules from the repository root, so run
+them as modules from there, e.g. python -m benchmarks.codecBenchmark.
+"""
@@ -0,0 +1,59 @@
+"""
+Microbenchmark for grouping a batch of snapshots into devices before upload: the previous
+linear scan per device against the indexed aggregationManager, reused across cycles.
+
+Usage: python -m benchmarks.aggregationBenchmark [seconds per case]
+"""
+
+import sys
+from benchmarks.common import measure
+from aggregationManager import aggregationManager
+from systemMetrics import DTO_DataSnapshot, DTO_Device, DTO_Metric
+
+# (label, ESP32 devices, snapshots per device in a batch)
+BATCH_SHAPES = [
+    ('10 devices', 10, 4),
+    ('100 devices', 100, 4),
+    ('1k devices', 1000, 1),
+    ('1k devices', 1000, 4)
+]
+
+
+def buildBatch(devices: int, snapshots: int) -> list:
+    # Interleaved the way they arrive from the socket, every device reports once per round
+    return [
+        DTO_DataSnapshot(
+            timestamp_utc=f'2026-01-01T12:00:{s:02d}',
+            metrics=[DTO_Metric('temperature', 20.0 + s, 80.0), DTO_Metric('humidity', 40.0)],
+            device_name=f'esp32-{d}'
+        ) for s in range(snapshots) for d in range(devices)
+    ]
+
+
+def scanGrouping(batch: list) -> list:
+    """The grouping the client used before the index, a scan of the batch per device."""
+    names = []
+    for snapshot in batch:
+        if snapshot.device_name not in names:
+            names.append(snapshot.device_name)
+    return [DTO_Device(name, [s for s in batch if s.device_name == name]) for name in names]
+
+
+def main(seconds: float = 1.0):
+    aggregator = aggregationManager()
+
+    def indexedGrouping(batch: list):
+        aggregator.addSnapshotsToAggregator(batch)
+        return aggregator.drain(None, 'benchmark')
+
+    print(f"{'batch':<12} {'snapshots':>9} {'scan us':>10} {'indexed us':>11} {'speedup':>8}")
+    for label, devices, snapshots in BATCH_SHAPES:
+        batch = buildBatch(devices, snapshots)
+        assert [d.data_snapshots for d in scanGrouping(batch)] == [d.data_snapshots for d in indexedGrouping(batch).devices]
+        scan_us = measure(lambda: scanGrouping(batch), seconds)
+        indexed_us = measure(lambda: indexedGrouping(batch), seconds)
+        print(f"{label:<12} {len(batch):>9} {scan_us:>10.1f} {indexed_us:>11.1f} {scan_us / indexed_us:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 1.0)
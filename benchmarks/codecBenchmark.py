@@ -0,0 +1,33 @@
+"""
+Microbenchmark for the upload codecs: DTO to wire bytes on the client and wire bytes to DTO
+on the server, for the JSON, columnar JSON and binary formats over a few realistic payload shapes.
+
+Usage: python -m benchmarks.codecBenchmark [seconds per case]
+"""
+
+import json
+import sys
+from benchmarks.common import PAYLOAD_SHAPES, buildPayload, measure
+from wireFormat import decodeJsonPayload, encodePayload, unpackAggregator
+
+def decodeJson(body: bytes):
+    return decodeJsonPayload(json.loads(body))
+
+
+def main(seconds: float = 1.0):
+    print(f"{'payload':<12} {'format':<9} {'bytes':>8} {'encode us':>10} {'decode us':>10}")
+    for label, devices, snapshots, metrics in PAYLOAD_SHAPES:
+        aggregator = buildPayload(devices, snapshots, metrics, text_timestamps=True)
+        for wire_format, decode in (
+            ('json', decodeJson),
+            ('columnar', decodeJson),
+            ('binary', unpackAggregator)
+        ):
+            body = encodePayload(aggregator, wire_format)
+            encode_us = measure(lambda: encodePayload(aggregator, wire_format), seconds)
+            decode_us = measure(lambda: decode(body), seconds)
+            print(f"{label:<12} {wire_format:<9} {len(body):>8} {encode_us:>10.1f} {decode_us:>10.1f}")
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 1.0)
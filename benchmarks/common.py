@@ -0,0 +1,48 @@
+"""
+Helpers shared by the benchmarks: payload builders, timing and percentiles.
+"""
+
+import timeit
+from datetime import datetime, timedelta
+from systemMetrics import DTO_Aggregator, DTO_DataSnapshot, DTO_Device, DTO_Metric
+
+# Client payload shapes: (label, devices, snapshots per device, metrics per snapshot)
+PAYLOAD_SHAPES = [
+    ('local only', 1, 1, 3),
+    ('10 devices', 10, 4, 3),
+    ('100 devices', 100, 10, 5)
+]
+
+
+def buildPayload(devices: int, snapshots: int, metrics: int, text_timestamps: bool = False) -> DTO_Aggregator:
+    """
+    An aggregator payload, every other metric with a threshold. Timestamps are datetimes as the
+    server decodes them, or with text_timestamps the strings the client builds.
+    """
+    start = datetime(2026, 1, 1, 12, 0, 0)
+    return DTO_Aggregator(
+        platform_uuid='49ceb0f4-3d61-4e7b-a9e0-066140caf7ca',
+        name='benchmark',
+        devices=[DTO_Device(
+            name=f'device-{d}',
+            data_snapshots=[DTO_DataSnapshot(
+                timestamp_utc=(start + timedelta(seconds=s)).strftime('%Y-%m-%dT%H:%M:%S') if text_timestamps else start + timedelta(seconds=s),
+                metrics=[DTO_Metric(name=f'metric_{m}', value=d * 0.5 + s + m / 7, threshold=80.0 if m % 2 else None) for m in range(metrics)]
+            ) for s in range(snapshots)]
+        ) for d in range(devices)]
+    )
+
+
+def measure(function, seconds: float) -> float:
+    """Best per-call time in microseconds."""
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    repeat = max(int(seconds / elapsed), 3)
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def percentile(samples: list, fraction: float) -> float:
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
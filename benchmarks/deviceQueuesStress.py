@@ -0,0 +1,86 @@
+"""
+Stress test for deviceQueues: producer threads, each the connection handler of its own set of
+devices, put numbered messages as fast as they can while a collector thread drains on an
+interval. Checks that every message is either delivered or counted as dropped, that each
+device's messages arrive in order, and that only the oldest are dropped. Reports puts per
+second for a few producer counts.
+
+Usage: python -m benchmarks.deviceQueuesStress [messages per device]
+"""
+
+import sys
+import threading
+import time
+from deviceQueues import deviceQueues
+
+# (producer threads, devices per producer, queue size, collector interval seconds)
+SCENARIOS = [
+    (1, 100, 100, 0.01),
+    (8, 125, 100, 0.01),
+    (32, 32, 100, 0.01),
+    # Collector far behind the producers, most messages overflow
+    (8, 125, 10, 0.2)
+]
+
+
+def run(producers: int, devices: int, maxlen: int, interval: float, messages: int) -> dict:
+    queues = deviceQueues(maxlen)
+    delivered = {}
+    done = threading.Event()
+
+    def produce(producer: int):
+        names = [f"esp32-{producer}-{d}" for d in range(devices)]
+        put = queues.put
+        for sequence in range(messages):
+            for name in names:
+                put(name, sequence)
+
+    def collect():
+        while True:
+            finished = done.is_set()
+            for name, queue in queues.drain().items():
+                delivered.setdefault(name, []).extend(queue)
+            if finished:
+                return
+            time.sleep(interval)
+
+    collector = threading.Thread(target=collect)
+    threads = [threading.Thread(target=produce, args=(p,)) for p in range(producers)]
+    collector.start()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    collector.join()
+
+    stats = queues.stats()
+    total = producers * devices * messages
+    assert stats['received'] == total, stats
+    assert len(delivered) == producers * devices
+    for name, sequences in delivered.items():
+        dropped = stats['dropped_by_device'].get(name, 0)
+        assert len(sequences) + dropped == messages, (name, len(sequences), dropped)
+        # In order, with no duplicates, and the newest message is never the one dropped
+        assert all(a < b for a, b in zip(sequences, sequences[1:])), name
+        assert sequences[-1] == messages - 1, name
+    assert sum(stats['dropped_by_device'].values()) == stats['dropped']
+    return {
+        'puts_per_s': total / elapsed,
+        'delivered': total - stats['dropped'],
+        'dropped': stats['dropped']
+    }
+
+
+def main(messages: int = 200):
+    print(f"{'producers':>9} {'devices':>8} {'maxlen':>6} {'puts/s':>12} {'delivered':>10} {'dropped':>9}")
+    for producers, devices, maxlen, interval in SCENARIOS:
+        result = run(producers, devices, maxlen, interval, messages)
+        print(f"{producers:>9} {producers * devices:>8} {maxlen:>6} {result['puts_per_s']:>12,.0f} {result['delivered']:>10} {result['dropped']:>9}")
+    print("All messages delivered in order or counted as dropped")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
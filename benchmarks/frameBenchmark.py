@@ -0,0 +1,66 @@
+"""
+Microbenchmark for decoding the ESP32 stream protocol: frames per second through frameDecoder
+against reassembly by bytes concatenation and slicing, for a few frame sizes and read sizes
+(one TCP segment at a time, or large coalesced reads).
+
+Usage: python -m benchmarks.frameBenchmark [seconds per case]
+"""
+
+import json
+import sys
+from benchmarks.common import measure
+from frameDecoder import frameDecoder
+
+FRAMES_PER_STREAM = 1000
+FRAME_PAYLOAD_BYTES = (100, 1024, 16384)
+READ_BYTES = (1460, 65536)
+
+
+def buildStream(payload_bytes: int) -> bytes:
+    payload = json.dumps({'gas': {'value': 1234.5, 'threshold': 4000}, 'pad': 'x' * max(payload_bytes - 50, 0)}).encode()
+    frame = len(payload).to_bytes(4, byteorder='big') + b'esp32-device\x00' + payload
+    return frame * FRAMES_PER_STREAM
+
+
+def slicedDecode(reads: list) -> int:
+    """Reassembly the way the per-message parser would be extended, copying on every step."""
+    buffer = b''
+    count = 0
+    for data in reads:
+        buffer += data
+        while len(buffer) >= 4:
+            length = int.from_bytes(buffer[:4], byteorder='big')
+            terminator = buffer.find(b'\x00', 4)
+            if terminator == -1 or len(buffer) < terminator + 1 + length:
+                break
+            buffer[4:terminator].decode()
+            buffer[terminator + 1:terminator + 1 + length].decode()
+            buffer = buffer[terminator + 1 + length:]
+            count += 1
+    return count
+
+
+def decoderDecode(reads: list) -> int:
+    decoder = frameDecoder(buffer_bytes=65536)
+    count = 0
+    for data in reads:
+        decoder.feed(data)
+        for _ in decoder.frames():
+            count += 1
+    return count
+
+
+def main(seconds: float = 1.0):
+    print(f"{'payload B':>9} {'read B':>7} {'sliced frames/s':>16} {'decoder frames/s':>17} {'speedup':>8}")
+    for payload_bytes in FRAME_PAYLOAD_BYTES:
+        stream = buildStream(payload_bytes)
+        for read_bytes in READ_BYTES:
+            reads = [stream[i:i + read_bytes] for i in range(0, len(stream), read_bytes)]
+            assert slicedDecode(reads) == decoderDecode(reads) == FRAMES_PER_STREAM
+            sliced = FRAMES_PER_STREAM / measure(lambda: slicedDecode(reads), seconds) * 1e6
+            decoder = FRAMES_PER_STREAM / measure(lambda: decoderDecode(reads), seconds) * 1e6
+            print(f"{payload_bytes:>9} {read_bytes:>7} {sliced:>16,.0f} {decoder:>17,.0f} {decoder / sliced:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 1.0)
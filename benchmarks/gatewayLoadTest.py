@@ -0,0 +1,219 @@
+"""
+Load generator for the ESP32 gateway. Starts remoteMonitor in a child process in the given
+gateway mode, opens N simulated device connections on localhost that speak the ESP32 protocol,
+and reports the connections held, acknowledged messages per second, and the RSS, threads and
+CPU of the gateway and any worker processes. The child drains the metrics like the client pipeline does and sends a REBOOT to
+one device per second, which the devices count.
+
+Devices send the firmware's JSON payload or the binary one with --payload binary.
+
+Usage: python -m benchmarks.gatewayLoadTest [--mode asyncio|threads|processes] [--workers N] [--payload json|binary] [--devices N] [--rate messages/s per device, 0 = as fast as acked] [--seconds S]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import resource
+import time
+from types import SimpleNamespace
+import psutil
+from esp32Payload import packReadings
+
+ACK = b"Metrics received"
+REBOOT = b"REBOOT"
+
+
+def raiseFileLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def serve(mode: str, workers: int, port: int, ready):
+    """Gateway child process."""
+    from lib_config.config import ClientConfig
+    from remoteMonitor import remoteMonitor
+    raiseFileLimit()
+    logger = logging.getLogger("gateway")
+    logger.setLevel(logging.ERROR)
+    config = SimpleNamespace(client=ClientConfig(interval=0, socket_host='127.0.0.1', socket_port=port, gateway_mode=mode, gateway_workers=workers))
+    monitor = remoteMonitor(logger, config)
+    time.sleep(0.5)
+    # Workers report once they are listening
+    deadline = time.monotonic() + 15
+    while monitor.shards and len(monitor.shards.worker_stats) < monitor.shards.workers and time.monotonic() < deadline:
+        time.sleep(0.1)
+    ready.set()
+    last_reboot = time.monotonic()
+    while True:
+        time.sleep(0.5)
+        monitor.processEsp32Metrics()
+        if time.monotonic() - last_reboot >= 1:
+            with monitor.lock:
+                device_name = next(iter(monitor.device_connections), None)
+            if device_name:
+                monitor.respondCriticalToEsp32(device_name)
+            last_reboot = time.monotonic()
+
+
+def processTree(gateway: psutil.Process) -> list:
+    try:
+        return [gateway] + gateway.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return [gateway]
+
+
+def treeUsage(gateway: psutil.Process):
+    """RSS bytes, threads and CPU seconds of the gateway and its worker processes."""
+    rss = threads = cpu = 0
+    for process in processTree(gateway):
+        try:
+            rss += process.memory_info().rss
+            threads += process.num_threads()
+            times = process.cpu_times()
+            cpu += times.user + times.system
+        except psutil.NoSuchProcess:
+            continue
+    return rss, threads, cpu
+
+
+def buildFrame(device_name: str, payload_format: str = 'json') -> bytes:
+    """One message as the firmware frames it, with the JSON or binary payload (see esp32Payload.py)."""
+    if payload_format == 'binary':
+        payload = packReadings(int(time.time()), [('Alarming', 0.0, None), ('gas', 1234.5, 4000.0)])
+    else:
+        payload = json.dumps({
+            'Alarming': {'value': 0},
+            'gas': {'value': 1234.5, 'threshold': 4000},
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        }).encode()
+    return len(payload).to_bytes(4, byteorder='big') + device_name.encode() + b'\x00' + payload
+
+
+class loadGenerator:
+    def __init__(self, port: int, devices: int, rate: float, seconds: float, payload_format: str = 'json'):
+        self.port = port
+        self.payload_format = payload_format
+        self.devices = devices
+        self.rate = rate
+        self.seconds = seconds
+        self.connected = 0
+        self.failed = 0
+        self.acks = 0
+        self.reboots = 0
+        self.measuring = False
+        self.stopping = False
+
+    async def device(self, index: int):
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        except OSError:
+            self.failed += 1
+            return
+        self.connected += 1
+        frame = buildFrame(f"sim-{index}", self.payload_format)
+        buffer = b''
+        try:
+            # Spread the first messages over one period so devices do not send in lockstep
+            await asyncio.sleep((index / self.devices) / self.rate if self.rate else 0)
+            while not self.stopping:
+                sent = time.monotonic()
+                writer.write(frame)
+                acked = False
+                while not acked:
+                    data = await reader.read(256)
+                    if not data:
+                        return
+                    buffer += data
+                    while len(buffer) >= len(REBOOT):
+                        if buffer.startswith(REBOOT):
+                            self.reboots += 1
+                            buffer = buffer[len(REBOOT):]
+                        elif buffer.startswith(ACK):
+                            acked = True
+                            if self.measuring:
+                                self.acks += 1
+                            buffer = buffer[len(ACK):]
+                        else:
+                            break
+                if self.rate:
+                    await asyncio.sleep(max(0.0, 1 / self.rate - (time.monotonic() - sent)))
+        except ConnectionError:
+            pass
+        finally:
+            self.connected -= 1
+            writer.close()
+
+    async def run(self, gateway: psutil.Process) -> dict:
+        idle_rss = treeUsage(gateway)[0]
+        tasks = []
+        started = time.monotonic()
+        for index in range(self.devices):
+            tasks.append(asyncio.create_task(self.device(index)))
+            if index % 200 == 199:
+                # Connect in waves rather than overflowing the listen backlog
+                await asyncio.sleep(0.05)
+        while self.connected + self.failed < self.devices and time.monotonic() - started < 30:
+            await asyncio.sleep(0.1)
+        connect_seconds = time.monotonic() - started
+        await asyncio.sleep(1)
+        cpu_started = treeUsage(gateway)[2]
+        self.measuring = True
+        measure_started = time.monotonic()
+        await asyncio.sleep(self.seconds)
+        elapsed = time.monotonic() - measure_started
+        self.measuring = False
+        rss, threads, cpu = treeUsage(gateway)
+        result = {
+            'frame_bytes': len(buildFrame("sim-0", self.payload_format)),
+            'connections_held': self.connected,
+            'connect_failures': self.failed,
+            'connect_seconds': round(connect_seconds, 2),
+            'messages_per_s': round(self.acks / elapsed),
+            'reboots_received': self.reboots,
+            'gateway_processes': len(processTree(gateway)),
+            'gateway_rss_mb': round(rss / 2 ** 20, 1),
+            'gateway_rss_per_connection_kb': round((rss - idle_rss) / max(self.connected, 1) / 1024, 1),
+            'gateway_threads': threads,
+            # Summed over the gateway's processes, 100 is one core
+            'gateway_cpu_percent': round((cpu - cpu_started) / elapsed * 100, 1)
+        }
+        self.stopping = True
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ESP32 gateway load generator")
+    parser.add_argument('--mode', default='asyncio', choices=('asyncio', 'threads', 'processes'))
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=1.0)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--payload', default='json', choices=('json', 'binary'))
+    parser.add_argument('--port', type=int, default=5766)
+    args = parser.parse_args()
+
+    raiseFileLimit()
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    # Not a daemon, daemonic processes cannot start the "processes" mode workers
+    child = context.Process(target=serve, args=(args.mode, args.workers, args.port, ready))
+    child.start()
+    try:
+        if not ready.wait(10):
+            raise SystemExit("Gateway did not start")
+        gateway = psutil.Process(child.pid)
+        result = asyncio.run(loadGenerator(args.port, args.devices, args.rate, args.seconds, args.payload).run(gateway))
+        print(json.dumps({'mode': args.mode, 'payload': args.payload, 'devices': args.devices, 'rate': args.rate, **result}, indent=4))
+    finally:
+        child.terminate()
+        child.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark for storing POST /metrics payloads: the per-row ORM loop uploadMetrics used before
+ingestionManager, with a query per device and metric type and a flush per snapshot, against
+ingestionManager.ingestAggregators. Each case uploads the same aggregator payload repeatedly
+to a fresh SQLite file, so after the first upload every dimension row exists, as it does for a
+client that keeps reporting. Rows are snapshots plus metric values.
+
+Usage: python -m benchmarks.ingestionBenchmark [seconds per case]
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, UTC
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from benchmarks.common import buildPayload
+from ingestionManager import ingestionManager
+from models import Aggregator, Base, Device, MetricType, SystemMetricSnapshot, SystemMetricValue
+from systemMetrics import DTO_Aggregator
+
+# (label, devices, snapshots per device, metrics per snapshot)
+INGEST_SHAPES = [
+    ('1 device', 1, 4, 5),
+    ('50 devices', 50, 4, 5),
+    ('500 devices', 500, 4, 5)
+]
+
+
+def ormIngest(engine, dto_aggregator: DTO_Aggregator) -> list:
+    """The storage loop uploadMetrics ran before ingestionManager, without its per-value logging."""
+    critical_devices = []
+    with Session(engine) as session:
+        aggregator = session.query(Aggregator).filter_by(guid=str(dto_aggregator.platform_uuid)).first()
+        if not aggregator:
+            aggregator = Aggregator(guid=str(dto_aggregator.platform_uuid), name=dto_aggregator.name)
+            session.add(aggregator)
+            session.flush()
+        for dto_device in dto_aggregator.devices:
+            device = session.query(Device).filter_by(aggregator_id=aggregator.aggregator_id, name=dto_device.name).first()
+            if not device:
+                device = Device(aggregator_id=aggregator.aggregator_id, name=dto_device.name)
+                session.add(device)
+                session.flush()
+            now_UTC = datetime.now(UTC)
+            for dto_snapshot in dto_device.data_snapshots:
+                snapshot = SystemMetricSnapshot(
+                    device_id=device.device_id,
+                    client_utc_timestamp_epoch=int(dto_snapshot.timestamp_utc.timestamp()),
+                    server_utc_timestamp_epoch=int(now_UTC.timestamp())
+                )
+                session.add(snapshot)
+                session.flush()
+                for dto_metric in dto_snapshot.metrics:
+                    metric_type = session.query(MetricType).filter_by(device_id=device.device_id, metric_type=dto_metric.name).first()
+                    if not metric_type:
+                        metric_type = MetricType(device_id=device.device_id, metric_type=dto_metric.name, metric_threshold=dto_metric.threshold)
+                        session.add(metric_type)
+                        session.flush()
+                    value = SystemMetricValue(
+                        metric_snapshot_id=snapshot.metric_snapshot_id,
+                        metric_type_id=metric_type.metric_type_id,
+                        metric_value=float(dto_metric.value)
+                    )
+                    session.add(value)
+                    if metric_type.metric_threshold and value.metric_value >= metric_type.metric_threshold:
+                        critical_devices.append(device.name)
+        session.commit()
+    return critical_devices
+
+
+def rowsPerSecond(ingest, rows: int, seconds: float):
+    """Uploads per second and rows per second over at least seconds, after one warm up upload."""
+    first = ingest()
+    uploads = 0
+    started = time.perf_counter()
+    while True:
+        assert ingest() == first
+        uploads += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds and uploads >= 3:
+            return uploads / elapsed, uploads * rows / elapsed
+
+
+def main(seconds: float = 2.0):
+    logger = logging.getLogger('benchmark')
+    logger.setLevel(logging.ERROR)
+    print(f"{'payload':<12} {'rows':>6} {'orm rows/s':>11} {'bulk rows/s':>12} {'orm uploads/s':>14} {'bulk uploads/s':>15} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for label, devices, snapshots, metrics in INGEST_SHAPES:
+            payload = buildPayload(devices, snapshots, metrics)
+            rows = devices * snapshots * (1 + metrics)
+            results = {}
+            for mode in ('orm', 'bulk'):
+                engine = create_engine(f"sqlite:///{os.path.join(directory, f'{mode}-{devices}.db')}")
+                Base.metadata.create_all(engine)
+                if mode == 'orm':
+                    results[mode] = rowsPerSecond(lambda: ormIngest(engine, payload), rows, seconds)
+                else:
+                    ingestion = ingestionManager(engine, logger)
+                    results[mode] = rowsPerSecond(lambda: ingestion.ingestAggregators([payload])[0], rows, seconds)
+                engine.dispose()
+            (orm_uploads, orm_rows), (bulk_uploads, bulk_rows) = results['orm'], results['bulk']
+            print(f"{label:<12} {rows:>6} {orm_rows:>11.0f} {bulk_rows:>12.0f} {orm_uploads:>14.1f} {bulk_uploads:>15.1f} {bulk_rows / orm_rows:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 2.0)
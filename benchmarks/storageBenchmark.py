@@ -0,0 +1,133 @@
+"""
+Concurrency benchmark for the server's database engine: one thread uploads payloads through
+ingestionManager while dashboard reader threads run the latest readings and last hour series
+queries, each on its own Session as the dashboard does. The engine create_engine gives with
+defaults, as the server used before, is compared with createEngine and the storage profile
+in DatabaseConfig (WAL, synchronous NORMAL, mmap, cache and busy timeout, sized pool).
+Reports uploads/s, reads/s, read latency percentiles and the operations that failed, such as
+"database is locked".
+
+Usage: python -m benchmarks.storageBenchmark [seconds per engine] [reader threads]
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from benchmarks.common import buildPayload, percentile
+from dashboard import Dashboard
+from ingestionManager import ingestionManager
+from lib_config.config import DatabaseConfig
+from models import Base, MetricType
+from seriesQuery import querySeries
+from storageProfile import createEngine
+
+DEVICES = 50
+SEED_UPLOADS = 200
+
+
+class concurrencyRun:
+    def __init__(self, engine, readers: int, seconds: float, logger):
+        self.engine = engine
+        self.readers = readers
+        self.seconds = seconds
+        self.ingestion = ingestionManager(engine, logger)
+        self.payload = buildPayload(DEVICES, 4, 5)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.reads = 0
+        self.read_latencies = []
+        self.upload_latencies = []
+        self.errors = {}
+
+    def failed(self, kind: str, error: Exception):
+        with self.lock:
+            key = f"{kind}: {str(error).splitlines()[0][:60]}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def seed(self):
+        for _ in range(SEED_UPLOADS):
+            self.ingestion.ingestAggregators([self.payload])
+        with Session(self.engine) as session:
+            self.metric_type_ids = session.scalars(select(MetricType.metric_type_id).order_by(MetricType.metric_type_id).limit(8)).all()
+
+    def writer(self):
+        while not self.stopping.is_set():
+            started = time.perf_counter()
+            try:
+                self.ingestion.ingestAggregators([self.payload])
+            except Exception as e:
+                self.failed('upload', e)
+                continue
+            with self.lock:
+                self.uploads += 1
+                self.upload_latencies.append(time.perf_counter() - started)
+
+    def reader(self):
+        dashboard = Dashboard()
+        while not self.stopping.is_set():
+            started = time.perf_counter()
+            try:
+                with Session(self.engine) as session:
+                    dashboard.query_latest(session, self.metric_type_ids)
+                    end_epoch = int(time.time())
+                    querySeries(session, self.metric_type_ids, end_epoch - 3600, end_epoch)
+            except Exception as e:
+                self.failed('read', e)
+                continue
+            with self.lock:
+                self.reads += 1
+                self.read_latencies.append(time.perf_counter() - started)
+
+    def run(self) -> dict:
+        self.seed()
+        threads = [threading.Thread(target=self.writer)] + [threading.Thread(target=self.reader) for _ in range(self.readers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(self.seconds)
+        self.stopping.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return {
+            'uploads_per_s': self.uploads / elapsed,
+            'reads_per_s': self.reads / elapsed,
+            'upload_p95_ms': percentile(self.upload_latencies, 0.95) * 1000,
+            'read_p50_ms': percentile(self.read_latencies, 0.5) * 1000,
+            'read_p95_ms': percentile(self.read_latencies, 0.95) * 1000,
+            'errors': self.errors
+        }
+
+
+def main(seconds: float = 5.0, readers: int = 4):
+    logger = logging.getLogger('benchmark')
+    logger.setLevel(logging.CRITICAL)
+    print(f"{DEVICES} device uploads against {readers} dashboard readers, {seconds:g}s per engine")
+    print(f"{'engine':<10} {'uploads/s':>10} {'upload p95 ms':>14} {'reads/s':>8} {'read p50 ms':>12} {'read p95 ms':>12}  errors")
+    with tempfile.TemporaryDirectory() as directory:
+        for label in ('default', 'profile'):
+            connection_string = f"sqlite:///{os.path.join(directory, f'{label}.db')}"
+            if label == 'default':
+                engine = create_engine(connection_string)
+            else:
+                engine = createEngine(DatabaseConfig(connection_string=connection_string, reader_pool_size=readers))
+            Base.metadata.create_all(engine)
+            result = concurrencyRun(engine, readers, seconds, logger).run()
+            engine.dispose()
+            print(
+                f"{label:<10} {result['uploads_per_s']:>10.1f} {result['upload_p95_ms']:>14.1f} {result['reads_per_s']:>8.1f} "
+                f"{result['read_p50_ms']:>12.1f} {result['read_p95_ms']:>12.1f}  {result['errors'] or 'none'}"
+            )
+
+
+if __name__ == "__main__":
+    main(
+        float(sys.argv[1]) if len(sys.argv) > 1 else 5.0,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    )
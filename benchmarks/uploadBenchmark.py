@@ -0,0 +1,147 @@
+"""
+Benchmark for the client's upload transport against a local stand-in for the server's POST
+/metrics endpoint: a module-level requests.post per payload, as MetricsApi used before, against
+MetricsApi.uploadMetrics with its pooled keep-alive session, without and with gzip bodies.
+Reports uploads per second, request bytes on the wire per upload (request line, headers and
+body) and the TCP connections opened.
+
+The stand-in inflates compressed bodies and parses the JSON like the server, but stores nothing.
+--connect-ms delays each new connection to stand in for the TCP and TLS handshakes to a remote host.
+
+Usage: python -m benchmarks.uploadBenchmark [--seconds S per case] [--connect-ms N]
+"""
+
+import argparse
+import json
+import logging
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import requests
+from benchmarks.common import PAYLOAD_SHAPES, buildPayload
+from lib_config.config import ClientConfig
+from metricsAPI import MetricsApi
+
+RESPONSE = json.dumps({'status': 'success', 'message': 'Metric uploaded successfully', 'criticalDevices': []}).encode()
+
+
+class standInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, connect_ms: float):
+        super().__init__(('127.0.0.1', 0), standInHandler)
+        self.connect_ms = connect_ms
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.wire_bytes = 0
+
+    def record(self, connections: int = 0, requests: int = 0, wire_bytes: int = 0):
+        with self.lock:
+            self.connections += connections
+            self.requests += requests
+            self.wire_bytes += wire_bytes
+
+
+class standInHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as the Flask server behind a production proxy
+    protocol_version = 'HTTP/1.1'
+    # The status line and body are separate writes, with Nagle the body waits for the client's delayed ack
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.record(connections=1)
+        if self.server.connect_ms:
+            time.sleep(self.server.connect_ms / 1000)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.record(requests=1, wire_bytes=len(self.requestline) + 2 + len(str(self.headers)) + len(body))
+        if self.headers.get('Content-Encoding', '').lower() in ('gzip', 'deflate'):
+            body = zlib.decompress(body, 32 + zlib.MAX_WBITS)
+        json.loads(body)
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def oldUpload(endpoint: str):
+    """The upload MetricsApi made before the session: a new connection per payload and no timeout."""
+    def upload(aggregator):
+        response = requests.post(endpoint, json=aggregator.to_dict())
+        assert response.status_code == 201
+    return upload
+
+
+def sessionUpload(port: int, spool_dir: str, compress_min_bytes: int, logger):
+    config = SimpleNamespace(
+        client=ClientConfig(interval=0, socket_host='127.0.0.1', socket_port=0, spool_dir=spool_dir, http_compress_min_bytes=compress_min_bytes),
+        web=SimpleNamespace(host='http://127.0.0.1', port=port)
+    )
+    api = MetricsApi(config, logger)
+
+    def upload(aggregator):
+        api.uploadMetrics(aggregator)
+        assert len(api.snapshot_queue) == 0
+    return upload
+
+
+def measure(server: standInServer, upload, aggregator, seconds: float) -> dict:
+    upload(aggregator)
+    server.reset()
+    uploads = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        upload(aggregator)
+        uploads += 1
+    elapsed = time.perf_counter() - started
+    return {
+        'uploads_per_s': uploads / elapsed,
+        'bytes_per_upload': server.wire_bytes / server.requests,
+        'connections': server.connections
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload transport benchmark")
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--connect-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    logger = logging.getLogger('benchmark')
+    logger.setLevel(logging.CRITICAL)
+    server = standInServer(args.connect_ms)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    print(f"Stand-in server on port {port}, {args.connect_ms:g} ms per new connection, {args.seconds:g}s per case")
+    print(f"{'payload':<12} {'transport':<14} {'uploads/s':>10} {'bytes/upload':>13} {'connections':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for label, devices, snapshots, metrics in PAYLOAD_SHAPES:
+            aggregator = buildPayload(devices, snapshots, metrics, text_timestamps=True)
+            transports = [
+                ('requests.post', oldUpload(f"http://127.0.0.1:{port}/metrics")),
+                ('session', sessionUpload(port, f"{directory}/{label}-plain", 0, logger)),
+                ('session+gzip', sessionUpload(port, f"{directory}/{label}-gzip", ClientConfig.http_compress_min_bytes, logger))
+            ]
+            for transport, upload in transports:
+                result = measure(server, upload, aggregator, args.seconds)
+                print(f"{label:<12} {transport:<14} {result['uploads_per_s']:>10.1f} {result['bytes_per_upload']:>13.0f} {result['connections']:>12}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Library module for the client's opt-in change-detection reporting.
+A metric is only sent when it moves beyond its deadband from the last value sent, or once a
+heartbeat interval has passed since it was last sent. A threshold is only sent when it changed
+and with every heartbeat, so the server can rebuild it after losing state.
+"""
+
+import threading
+import time
+
+
+class changeDetector:
+    def __init__(self, heartbeat_seconds: float, deadbands: dict = None, default_deadband: float = 0.0):
+        self.heartbeat_seconds = heartbeat_seconds
+        self.deadbands = deadbands or {}
+        self.default_deadband = default_deadband
+        # (device_name, metric name) -> [last value sent, last threshold sent, monotonic time sent]
+        self.last_sent = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.suppressed = 0
+
+    def filter(self, snapshots):
+        """
+        Drop unchanged metrics from the snapshots, in place, and return the snapshots that still
+        carry at least one metric.
+        """
+        now = time.monotonic()
+        kept = []
+        with self.lock:
+            for snapshot in snapshots:
+                metrics = []
+                for metric in snapshot.metrics:
+                    key = (snapshot.device_name, metric.name)
+                    last = self.last_sent.get(key)
+                    if last is None or now - last[2] >= self.heartbeat_seconds:
+                        # First report or heartbeat, sent in full
+                        self.last_sent[key] = [metric.value, metric.threshold, now]
+                    elif abs(metric.value - last[0]) > self.deadbands.get(metric.name, self.default_deadband):
+                        last[0], last[2] = metric.value, now
+                        if metric.threshold == last[1]:
+                            metric.threshold = None
+                        else:
+                            last[1] = metric.threshold
+                    elif metric.threshold != last[1]:
+                        # Only the threshold moved, the value goes with it as it cannot be sent alone
+                        last[0], last[1], last[2] = metric.value, metric.threshold, now
+                    else:
+                        self.suppressed += 1
+                        continue
+                    self.sent += 1
+                    metrics.append(metric)
+                if metrics:
+                    snapshot.metrics = metrics
+                    kept.append(snapshot)
+        return kept
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.sent + self.suppressed
+            return {
+                'sent': self.sent,
+                'suppressed': self.suppressed,
+                'suppressed_ratio': self.suppressed / total if total else 0.0
+            }
@@ -0,0 +1,324 @@
+"""
+Library module for the client's local metric collectors.
+Each collector declares its own sampling interval and rough cost. The registry runs the collectors
+that are due on every sampling cycle, keeps psutil state between cycles, and measures the time
+each collector takes so that one whose cost outgrows its interval is run less often.
+New collectors subclass metricCollector and are made available by name with @registerCollector.
+"""
+
+import abc
+import logging
+import threading
+import time
+from typing import List
+import psutil
+from systemMetrics import DTO_Metric
+
+MB = 1024 ** 2
+# Collector name -> class, filled by @registerCollector
+COLLECTORS = {}
+
+
+def registerCollector(cls):
+    COLLECTORS[cls.name] = cls
+    return cls
+
+
+class metricCollector(abc.ABC):
+    name = None
+    # Seconds between runs, 0 runs on every sampling cycle
+    interval_seconds = 0.0
+    # 'cheap' or 'expensive', informational, the measured cost is what bounds the interval
+    cost = 'cheap'
+
+    def __init__(self, interval_seconds: float = None, **options):
+        if interval_seconds is not None:
+            self.interval_seconds = interval_seconds
+        self.options = options
+
+    @abc.abstractmethod
+    def collect(self) -> List[DTO_Metric]:
+        pass
+
+    @staticmethod
+    def supported() -> bool:
+        return True
+
+    def details(self) -> dict:
+        """Extra state reported with the collector's stats."""
+        return {}
+
+
+class rateCollector(metricCollector):
+    """Turns cumulative psutil counters into per-second rates between two runs."""
+    def __init__(self, interval_seconds: float = None, **options):
+        super().__init__(interval_seconds, **options)
+        self.previous = None
+
+    @abc.abstractmethod
+    def counters(self) -> dict:
+        pass
+
+    def collect(self) -> List[DTO_Metric]:
+        now = time.monotonic()
+        counters = self.counters()
+        previous, self.previous = self.previous, (now, counters)
+        if previous is None or now <= previous[0]:
+            return []
+        elapsed = now - previous[0]
+        return [
+            DTO_Metric(name=name, value=max(value - previous[1].get(name, value), 0) / elapsed)
+            for name, value in counters.items()
+        ]
+
+
+@registerCollector
+class threadCollector(metricCollector):
+    name = 'threads'
+
+    def collect(self):
+        return [DTO_Metric(name="thread_count", value=float(threading.active_count()), threshold=None)]
+
+
+@registerCollector
+class memoryCollector(metricCollector):
+    name = 'memory'
+
+    def collect(self):
+        ram_usage = psutil.virtual_memory()
+        ram_total_mb = ram_usage.total / MB
+        return [
+            DTO_Metric(name="ram_used_mb", value=float(ram_usage.used / MB), threshold=ram_total_mb * 0.8),
+            DTO_Metric(name="ram_used_percentage", value=float(ram_usage.percent), threshold=80.0)
+        ]
+
+
+@registerCollector
+class cpuCollector(metricCollector):
+    name = 'cpu'
+    interval_seconds = 1.0
+
+    def __init__(self, interval_seconds: float = None, per_core: bool = True, threshold: float = 90.0, **options):
+        super().__init__(interval_seconds, **options)
+        self.per_core = per_core
+        self.threshold = threshold
+        # psutil measures utilisation since the previous call, the first call only sets the baseline
+        psutil.cpu_percent(interval=None)
+        if per_core:
+            psutil.cpu_percent(interval=None, percpu=True)
+
+    def collect(self):
+        metrics = [DTO_Metric(name="cpu_percent", value=float(psutil.cpu_percent(interval=None)), threshold=self.threshold)]
+        if self.per_core:
+            for core, percent in enumerate(psutil.cpu_percent(interval=None, percpu=True)):
+                metrics.append(DTO_Metric(name=f"cpu_core_{core}_percent", value=float(percent)))
+        return metrics
+
+
+@registerCollector
+class loadCollector(metricCollector):
+    name = 'load'
+    interval_seconds = 5.0
+
+    def collect(self):
+        load_1m, load_5m, load_15m = psutil.getloadavg()
+        return [
+            DTO_Metric(name="load_1m", value=load_1m),
+            DTO_Metric(name="load_5m", value=load_5m),
+            DTO_Metric(name="load_15m", value=load_15m)
+        ]
+
+
+@registerCollector
+class diskIoCollector(rateCollector):
+    name = 'disk_io'
+    interval_seconds = 5.0
+
+    def counters(self):
+        io = psutil.disk_io_counters()
+        if io is None:
+            return {}
+        return {
+            'disk_read_bytes_per_s': io.read_bytes,
+            'disk_write_bytes_per_s': io.write_bytes,
+            'disk_reads_per_s': io.read_count,
+            'disk_writes_per_s': io.write_count
+        }
+
+
+@registerCollector
+class netIoCollector(rateCollector):
+    name = 'net_io'
+    interval_seconds = 5.0
+
+    def counters(self):
+        io = psutil.net_io_counters()
+        return {
+            'net_sent_bytes_per_s': io.bytes_sent,
+            'net_recv_bytes_per_s': io.bytes_recv,
+            'net_errors_per_s': io.errin + io.errout,
+            'net_drops_per_s': io.dropin + io.dropout
+        }
+
+
+@registerCollector
+class processCollector(metricCollector):
+    """
+    CPU and resident memory of the top_n processes by CPU, summed per process name.
+    Metrics are named by rank, process_top1_cpu_percent and so on, so the set of metric types stays
+    fixed however the top processes change. The names holding each rank are in the collector's stats.
+    """
+    name = 'processes'
+    interval_seconds = 30.0
+    cost = 'expensive'
+
+    def __init__(self, interval_seconds: float = None, top_n: int = 5, **options):
+        super().__init__(interval_seconds, **options)
+        self.top_n = top_n
+        # Process handles are kept between runs, cpu_percent is measured since the previous call on the same handle
+        self.processes = {}
+        # Process name at each rank in the last run
+        self.top_names = []
+
+    def collect(self):
+        pids = set(psutil.pids())
+        for pid in self.processes.keys() - pids:
+            del self.processes[pid]
+        for pid in pids - self.processes.keys():
+            try:
+                self.processes[pid] = process = psutil.Process(pid)
+                process.cpu_percent(None)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        usage = {}
+        for pid, process in list(self.processes.items()):
+            try:
+                with process.oneshot():
+                    name = process.name()
+                    cpu = process.cpu_percent(None)
+                    rss = process.memory_info().rss
+            except psutil.NoSuchProcess:
+                del self.processes[pid]
+                continue
+            except (psutil.AccessDenied, psutil.ZombieProcess):
+                continue
+            total = usage.setdefault(name, [0.0, 0])
+            total[0] += cpu
+            total[1] += rss
+
+        metrics = []
+        top = sorted(usage.items(), key=lambda item: item[1][0], reverse=True)[:self.top_n]
+        for rank, (name, (cpu, rss)) in enumerate(top, start=1):
+            metrics.append(DTO_Metric(name=f"process_top{rank}_cpu_percent", value=cpu))
+            metrics.append(DTO_Metric(name=f"process_top{rank}_rss_mb", value=rss / MB))
+        self.top_names = [name for name, _ in top]
+        return metrics
+
+    def details(self):
+        return {'top_names': list(self.top_names)}
+
+
+@registerCollector
+class temperatureCollector(metricCollector):
+    name = 'temperatures'
+    interval_seconds = 30.0
+    cost = 'expensive'
+
+    def collect(self):
+        metrics = []
+        for chip, sensors in psutil.sensors_temperatures().items():
+            for index, sensor in enumerate(sensors):
+                label = (sensor.label or str(index)).replace(' ', '_')
+                metrics.append(DTO_Metric(name=f"temp_{chip}_{label}_c", value=sensor.current, threshold=sensor.high or sensor.critical))
+        return metrics
+
+    @staticmethod
+    def supported() -> bool:
+        return hasattr(psutil, 'sensors_temperatures')
+
+
+class collectorRegistry:
+    def __init__(self, settings: dict, cycle_seconds: float, max_overhead_ratio: float = 0.01, logger=None):
+        """
+        settings maps collector names to {"enabled", "interval_seconds", ...options}, collectors
+        not listed are not run. cycle_seconds is how often collect is called.
+        """
+        self.logger = logger or logging.getLogger()
+        self.cycle_seconds = cycle_seconds
+        self.max_overhead_ratio = max_overhead_ratio
+        self.lock = threading.Lock()
+        self.entries = []
+        for name, options in settings.items():
+            options = dict(options)
+            if not options.pop('enabled', True):
+                continue
+            cls = COLLECTORS.get(name)
+            if cls is None:
+                self.logger.error("Unknown collector %s, expected one of %s", name, ', '.join(COLLECTORS))
+                continue
+            if not cls.supported():
+                self.logger.warning("Collector %s is not supported on this platform", name)
+                continue
+            try:
+                collector = cls(**options)
+            except TypeError as e:
+                # Unknown options, or a collector class that does not implement collect
+                self.logger.error("Cannot create collector %s: %s", name, e)
+                continue
+            self.entries.append({
+                'collector': collector,
+                'next_due': 0.0,
+                'interval': None,
+                'stretched': False,
+                'runs': 0,
+                'errors': 0,
+                'seconds': 0.0,
+                'cpu_seconds': 0.0,
+                'max_seconds': 0.0
+            })
+
+    def collect(self) -> List[DTO_Metric]:
+        """Run the collectors that are due and return their metrics. A failing collector is logged and skipped."""
+        metrics = []
+        now = time.monotonic()
+        for entry in self.entries:
+            if now < entry['next_due']:
+                continue
+            collector = entry['collector']
+            started, cpu_started = time.perf_counter(), time.thread_time()
+            try:
+                metrics.extend(collector.collect())
+            except Exception as e:
+                entry['errors'] += 1
+                self.logger.error("Collector %s failed: %s", collector.name, e)
+            elapsed, cpu = time.perf_counter() - started, time.thread_time() - cpu_started
+            with self.lock:
+                entry['runs'] += 1
+                entry['seconds'] += elapsed
+                entry['cpu_seconds'] += cpu
+                entry['max_seconds'] = max(entry['max_seconds'], elapsed)
+                # Stretch the interval so the collector's average CPU cost stays within its overhead share
+                configured = max(collector.interval_seconds, self.cycle_seconds)
+                interval = max(configured, entry['cpu_seconds'] / entry['runs'] / self.max_overhead_ratio)
+                if interval > configured and not entry['stretched']:
+                    self.logger.warning("Collector %s costs %.1fms of CPU, running it every %.1fs", collector.name, cpu * 1000, interval)
+                entry['stretched'] = interval > configured
+                entry['interval'] = interval
+            # Half a cycle of slack so scheduling jitter does not push a run to the following cycle
+            entry['next_due'] = now + interval - self.cycle_seconds / 2
+        return metrics
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                entry['collector'].name: {
+                    'runs': entry['runs'],
+                    'errors': entry['errors'],
+                    'interval_s': entry['interval'],
+                    'avg_ms': entry['seconds'] / entry['runs'] * 1000 if entry['runs'] else 0.0,
+                    'max_ms': entry['max_seconds'] * 1000,
+                    'avg_cpu_ms': entry['cpu_seconds'] / entry['runs'] * 1000 if entry['runs'] else 0.0,
+                    **entry['collector'].details()
+                } for entry in self.entries
+            }
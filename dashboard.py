@@ -1,13 +1,27 @@
 import logging
-from dash import Dash, dependencies, dcc, html
+import threading
+import time
+from collections import OrderedDict
+from dash import ALL, Dash, Patch, ctx, dependencies, dcc, html, no_update
+from dash.exceptions import PreventUpdate
+from sqlalchemy import func, select, union_all
 from sqlalchemy.orm import Session
 from models import MetricType, SystemMetricValue, SystemMetricSnapshot
 from dash_daq import Gauge
-from datetime import datetime
+from datetime import datetime, UTC
+from seriesQuery import querySeries
+
+REFRESH_INTERVAL_MS = 10000
+LATEST_READINGS = 10
+VIEW_CACHE_SIZE = 64
 
 class Dashboard:
     def __init__(self):
         self.logger = logging.getLogger()
+        self.cache_lock = threading.Lock()
+        self.series_cache = {}
+        self.metric_type_ids = {}
+        self.view_cache = OrderedDict()
 
     def create_dash_app(self, webserver, engine):
         self.engine = engine
@@ -21,6 +35,18 @@ class Dashboard:
         dash_app = Dash(__name__, server=webserver, url_base_pathname='/dash/')
         dash_app.layout = html.Div([
             html.H1('System Metrics Dashboard'),
+            dcc.Dropdown(
+                id='time-range-dropdown',
+                options=[
+                    {'label': 'Latest readings', 'value': 0},
+                    {'label': 'Last hour', 'value': 3600},
+                    {'label': 'Last day', 'value': 86400},
+                    {'label': 'Last week', 'value': 604800},
+                    {'label': 'Last 30 days', 'value': 2592000}
+                ],
+                value=0,
+                clearable=False
+            ),
             # A 2x2 grid layout for the 4 divs, each with a dropdown for metric type and view type
             html.Div([
                 html.Div([
@@ -107,119 +133,311 @@ class Dashboard:
             ], style={'display': 'grid', 'gridTemplateColumns': '1fr 1fr', 'gap': '10px'}),  # 2x2 grid layout for divs
             dcc.Interval(
                 id='interval-component',
-                interval=10000,  # Update every 10 seconds
+                interval=REFRESH_INTERVAL_MS,  # Update every 10 seconds
                 n_intervals=0
-            )
+            ),
+            # Last snapshot id each panel has been sent, per browser tab
+            dcc.Store(id='panel-cursors', data={})
         ])
 
+        panel_inputs = [
+            dependencies.Input('metric-type-dropdown-1', 'value'),
+            dependencies.Input('metric-type-dropdown-2', 'value'),
+            dependencies.Input('metric-type-dropdown-3', 'value'),
+            dependencies.Input('metric-type-dropdown-4', 'value'),
+            dependencies.Input('view-type-radio-1', 'value'),
+            dependencies.Input('view-type-radio-2', 'value'),
+            dependencies.Input('view-type-radio-3', 'value'),
+            dependencies.Input('view-type-radio-4', 'value'),
+            dependencies.Input('time-range-dropdown', 'value')
+        ]
+
         @dash_app.callback(
             [
                 dependencies.Output('view-container-1', 'children'),
                 dependencies.Output('view-container-2', 'children'),
                 dependencies.Output('view-container-3', 'children'),
-                dependencies.Output('view-container-4', 'children')
+                dependencies.Output('view-container-4', 'children'),
+                dependencies.Output('panel-cursors', 'data')
             ],
-            [
-                dependencies.Input('metric-type-dropdown-1', 'value'),
-                dependencies.Input('metric-type-dropdown-2', 'value'),
-                dependencies.Input('metric-type-dropdown-3', 'value'),
-                dependencies.Input('metric-type-dropdown-4', 'value'),
-                dependencies.Input('view-type-radio-1', 'value'),
-                dependencies.Input('view-type-radio-2', 'value'),
-                dependencies.Input('view-type-radio-3', 'value'),
-                dependencies.Input('view-type-radio-4', 'value'),
-                dependencies.Input('interval-component', 'n_intervals')
-            ]
+            panel_inputs + [dependencies.Input('interval-component', 'n_intervals')]
         )
-        def update_views(metric_types_1, metric_types_2, metric_types_3, metric_types_4, view_type_1, view_type_2, view_type_3, view_type_4, n_intervals):
+        def update_views(metric_types_1, metric_types_2, metric_types_3, metric_types_4, view_type_1, view_type_2, view_type_3, view_type_4, time_range, n_intervals):
+            # Latest readings panels are kept current by extend_views, only rolled up ranges re-render on a tick
+            if ctx.triggered_id == 'interval-component' and not time_range:
+                raise PreventUpdate
+
+            panels = self.panels(metric_types_1, metric_types_2, metric_types_3, metric_types_4, view_type_1, view_type_2, view_type_3, view_type_4)
+            try:
+                series = self.fetch_series(tuple(sorted(set(panels) - {None})), time_range) if any(panels) else {}
+            except Exception as e:
+                self.logger.error("Error updating views: %s", e)
+                return [html.Div(f"Error: {e}") for _ in panels] + [{}]
+
             # Create a list for each div's view output
             views = []
+            cursors = {}
+            for i, metric_type in enumerate(panels):
+                if not metric_type:
+                    views.append(html.Div(f"Please select a metric type and a view type for div {i + 1}."))
+                    continue
+                view_type = [view_type_1, view_type_2, view_type_3, view_type_4][i]
+                timestamps, values, snapshot_ids = series.get(metric_type, ((), (), ()))
+                views.append(self.render_view(i, metric_type, view_type, timestamps, values))
+                cursors[str(i)] = {'metric_type': metric_type, 'snapshot_id': snapshot_ids[-1] if snapshot_ids else 0, 'rows': len(snapshot_ids)}
+
+            return views + [cursors]
+
+        @dash_app.callback(
+            [
+                dependencies.Output({'type': 'panel-graph', 'index': ALL}, 'extendData'),
+                dependencies.Output({'type': 'panel-gauge', 'index': ALL}, 'value'),
+                dependencies.Output({'type': 'panel-table', 'index': ALL}, 'children'),
+                dependencies.Output('panel-cursors', 'data', allow_duplicate=True)
+            ],
+            [dependencies.Input('interval-component', 'n_intervals')],
+            [dependencies.State(panel_input.component_id, panel_input.component_property) for panel_input in panel_inputs] + [
+                dependencies.State('panel-cursors', 'data'),
+                dependencies.State({'type': 'panel-graph', 'index': ALL}, 'id'),
+                dependencies.State({'type': 'panel-gauge', 'index': ALL}, 'id'),
+                dependencies.State({'type': 'panel-table', 'index': ALL}, 'id')
+            ],
+            prevent_initial_call=True
+        )
+        def extend_views(n_intervals, metric_types_1, metric_types_2, metric_types_3, metric_types_4, view_type_1, view_type_2, view_type_3, view_type_4, time_range, cursors, graph_ids, gauge_ids, table_ids):
+            """Send only the readings each panel has not seen yet since the last tick."""
+            if time_range or not cursors:
+                raise PreventUpdate
+
+            panels = self.panels(metric_types_1, metric_types_2, metric_types_3, metric_types_4, view_type_1, view_type_2, view_type_3, view_type_4)
+            cursors = {index: cursor for index, cursor in cursors.items() if panels[int(index)] == cursor['metric_type']}
+            if not cursors:
+                raise PreventUpdate
+            try:
+                with Session(self.engine) as session:
+                    metric_type_ids = self.resolve_metric_types(session, {cursor['metric_type'] for cursor in cursors.values()})
+                    # Each panel reads only the rows past its own cursor, the shared cache serves the initial render
+                    after = {}
+                    for cursor in cursors.values():
+                        metric_type_id = metric_type_ids.get(cursor['metric_type'])
+                        if metric_type_id is not None:
+                            after[metric_type_id] = min(after.get(metric_type_id, cursor['snapshot_id']), cursor['snapshot_id'])
+                    by_id = self.query_latest(session, after.keys(), after=after)
+            except Exception as e:
+                self.logger.error("Error extending views: %s", e)
+                raise PreventUpdate
+
+            new_readings = {}
+            for index, cursor in cursors.items():
+                epochs, values, snapshot_ids = by_id.get(metric_type_ids.get(cursor['metric_type']), ([], [], []))
+                # Panels sharing a metric type may be at different cursors
+                first_new = next((position for position, snapshot_id in enumerate(snapshot_ids) if snapshot_id > cursor['snapshot_id']), None)
+                if first_new is None:
+                    continue
+                timestamps = [self.format_epoch(epoch) for epoch in epochs[first_new:]]
+                new_readings[int(index)] = (timestamps, [float(value) for value in values[first_new:]], cursor.get('rows', 0))
+                cursors[index] = {
+                    'metric_type': cursor['metric_type'],
+                    'snapshot_id': snapshot_ids[-1],
+                    'rows': min(cursor.get('rows', 0) + len(timestamps), LATEST_READINGS)
+                }
+            if not new_readings:
+                raise PreventUpdate
+
+            graphs = []
+            for graph_id in graph_ids:
+                if graph_id['index'] not in new_readings:
+                    graphs.append(no_update)
+                    continue
+                timestamps, values, _ = new_readings[graph_id['index']]
+                graphs.append([{'x': [timestamps], 'y': [values]}, [0], LATEST_READINGS])
+            gauges = [
+                new_readings[gauge_id['index']][1][-1] if gauge_id['index'] in new_readings else no_update
+                for gauge_id in gauge_ids
+            ]
+            tables = [
+                self.table_patch(*new_readings[table_id['index']]) if table_id['index'] in new_readings else no_update
+                for table_id in table_ids
+            ]
+            return graphs, gauges, tables, cursors
 
-            # Process each dropdown and its corresponding view type
-            for i, (metric_types, view_type) in enumerate([
+        return dash_app
+
+    @staticmethod
+    def panels(metric_types_1, metric_types_2, metric_types_3, metric_types_4, view_type_1, view_type_2, view_type_3, view_type_4):
+        """Return the metric shown by each panel, or None. Only the first metric of each dropdown is shown."""
+        return [
+            metric_types[0] if metric_types and view_type else None
+            for metric_types, view_type in [
                 (metric_types_1, view_type_1),
                 (metric_types_2, view_type_2),
                 (metric_types_3, view_type_3),
                 (metric_types_4, view_type_4)
-            ]):
-                if not metric_types or not view_type:
-                    views.append(html.Div(f"Please select a metric type and a view type for div {i + 1}."))
-                    continue
+            ]
+        ]
 
-                session = Session(self.engine)
-                try:
-                    for metric_type in metric_types[:1]:  # Limit to 1 metric per dropdown
-                        # Fetch the metric type ID
-                        metric_type_obj = session.query(MetricType).filter_by(metric_type=metric_type).first()
-                        if not metric_type_obj:
-                            continue
-
-                        # Fetch recent metric values along with timestamps
-                        query = (
-                            session.query(SystemMetricValue.metric_value, SystemMetricSnapshot.server_utc_timestamp_epoch)
-                            .join(SystemMetricSnapshot, SystemMetricValue.metric_snapshot_id == SystemMetricSnapshot.metric_snapshot_id)
-                            .filter(SystemMetricValue.metric_type_id == metric_type_obj.metric_type_id)
-                            .order_by(SystemMetricSnapshot.server_utc_timestamp_epoch.desc())
-                            .limit(10)
-                        )
-                        results = query.all()
-                        results.reverse()
-
-                        values = [float(r.metric_value) for r in results]
-                        timestamps = [
-                            datetime.utcfromtimestamp(r.server_utc_timestamp_epoch).strftime('%d-%m-%Y %H:%M:%S') 
-                            for r in results
-                        ]
-
-                        # Generate the appropriate view based on the selected view type
-                        if view_type == 'gauge':
-                            if not values:
-                                views.append(html.Div(f"No data for {metric_type}", style={'textAlign': 'center'}))
-                                continue
-
-                            current_value = values[-1]
-                            min_value = min(min(values), 0)
-                            max_value = max(max(values), 100)
-
-                            views.append(
-                                Gauge(
-                                    id=f'{metric_type}-gauge',
-                                    label={'label': metric_type, 'style': {'fontSize': '18px'}},
-                                    min=min_value,
-                                    max=max_value,
-                                    value=current_value,
-                                    showCurrentValue=True,
-                                    color={"gradient": True, "ranges": {"green": [min_value, max_value * 0.7], "red": [max_value * 0.7, max_value]}}
-                                )
-                            )
-                        elif view_type == 'graph':
-                            views.append(
-                                dcc.Graph(
-                                    id=f'{metric_type}-graph',
-                                    figure={
-                                        'data': [
-                                            {'x': timestamps, 'y': values, 'type': 'line', 'name': metric_type}
-                                        ],
-                                        'layout': {'title': metric_type}
-                                    }
-                                )
-                            )
-                        elif view_type == 'table':
-                            views.append(
-                                html.Table(
-                                    children=[
-                                        html.Tr([html.Th('Timestamp'), html.Th('Value')])
-                                    ] + [
-                                        html.Tr([html.Td(ts), html.Td(val)]) for ts, val in zip(timestamps, values)
-                                    ]
-                                )
-                            )
-                except Exception as e:
-                    self.logger.error("Error updating views: %s", e)
-                    views.append(html.Div(f"Error: {e}"))
-                finally:
-                    session.close()
-
-            return views
+    def fetch_series(self, metric_types, time_range):
+        """
+        Return {metric_type: (timestamps, values, snapshot_ids)} for the selected metric names.
+        Snapshot ids are only filled for latest readings. Results are shared by every open
+        dashboard for one refresh interval, so any number of viewers costs one query per interval.
+        """
+        tick = int(time.time() * 1000 // REFRESH_INTERVAL_MS)
+        key = (metric_types, time_range, tick)
+        with self.cache_lock:
+            cached = self.series_cache.get(key)
+        if cached is not None:
+            return cached
 
-        return dash_app
+        with Session(self.engine) as session:
+            metric_type_ids = self.resolve_metric_types(session, metric_types)
+            if time_range:
+                # Wide ranges are served from the rollup tables
+                end_epoch = int(datetime.now(UTC).timestamp())
+                rolled_up, _ = querySeries(session, metric_type_ids.values(), end_epoch - time_range, end_epoch)
+                by_id = {metric_type_id: (epochs, values, []) for metric_type_id, (epochs, values) in rolled_up.items()}
+            else:
+                by_id = self.query_latest(session, metric_type_ids.values())
+
+        series = {}
+        for metric_type, metric_type_id in metric_type_ids.items():
+            epochs, values, snapshot_ids = by_id.get(metric_type_id, ([], [], []))
+            series[metric_type] = (
+                tuple(self.format_epoch(epoch) for epoch in epochs),
+                tuple(float(value) for value in values),
+                tuple(snapshot_ids)
+            )
+        with self.cache_lock:
+            # Entries from earlier ticks can no longer be hit
+            for stale in [k for k in self.series_cache if k[2] != tick]:
+                del self.series_cache[stale]
+            self.series_cache[key] = series
+        return series
+
+    def resolve_metric_types(self, session, metric_types):
+        """
+        Map metric names to the first metric type with that name, as the panels always have.
+        Ids only grow, so a resolved name keeps its id and is not looked up again.
+        """
+        with self.cache_lock:
+            metric_type_ids = {name: self.metric_type_ids[name] for name in metric_types if name in self.metric_type_ids}
+        unresolved = [name for name in metric_types if name not in metric_type_ids]
+        if unresolved:
+            resolved = dict(session.execute(
+                select(MetricType.metric_type, func.min(MetricType.metric_type_id))
+                .where(MetricType.metric_type.in_(unresolved))
+                .group_by(MetricType.metric_type)
+            ).all())
+            with self.cache_lock:
+                self.metric_type_ids.update(resolved)
+            metric_type_ids.update(resolved)
+        return metric_type_ids
+
+    def query_latest(self, session, metric_type_ids, after: dict = None):
+        """
+        Fetch the latest LATEST_READINGS values of every metric type in a single statement.
+        after optionally maps metric type ids to a snapshot id, only values past it are fetched.
+        Returns {metric_type_id: ([epochs], [values], [snapshot_ids])} in ascending order.
+        """
+        branches = []
+        for metric_type_id in metric_type_ids:
+            # Snapshot ids follow server receive order, so this walks the covering index backwards
+            query = (
+                select(SystemMetricValue.metric_type_id, SystemMetricSnapshot.server_utc_timestamp_epoch, SystemMetricValue.metric_value, SystemMetricValue.metric_snapshot_id)
+                .join(SystemMetricSnapshot, SystemMetricValue.metric_snapshot_id == SystemMetricSnapshot.metric_snapshot_id)
+                .where(SystemMetricValue.metric_type_id == metric_type_id)
+            )
+            if after:
+                query = query.where(SystemMetricValue.metric_snapshot_id > after[metric_type_id])
+            branches.append(
+                query.order_by(SystemMetricValue.metric_snapshot_id.desc())
+                .limit(LATEST_READINGS)
+                .subquery()
+                .select()
+            )
+        series = {metric_type_id: ([], [], []) for metric_type_id in metric_type_ids}
+        if not branches:
+            return series
+        for metric_type_id, epoch, value, snapshot_id in session.execute(union_all(*branches)):
+            epochs, values, snapshot_ids = series[metric_type_id]
+            epochs.append(epoch)
+            values.append(value)
+            snapshot_ids.append(snapshot_id)
+        for columns in series.values():
+            for column in columns:
+                column.reverse()
+        return series
+
+    def render_view(self, index, metric_type, view_type, timestamps, values):
+        """Build a panel, reusing the previous component when its data has not changed."""
+        key = (index, metric_type, view_type, timestamps, values)
+        with self.cache_lock:
+            view = self.view_cache.get(key)
+            if view is not None:
+                self.view_cache.move_to_end(key)
+                return view
+
+        view = self.build_view(index, metric_type, view_type, list(timestamps), list(values))
+        with self.cache_lock:
+            self.view_cache[key] = view
+            while len(self.view_cache) > VIEW_CACHE_SIZE:
+                self.view_cache.popitem(last=False)
+        return view
+
+    def build_view(self, index, metric_type, view_type, timestamps, values):
+        # Generate the appropriate view based on the selected view type
+        if view_type == 'gauge':
+            if not values:
+                return html.Div(f"No data for {metric_type}", style={'textAlign': 'center'})
+
+            current_value = values[-1]
+            min_value = min(min(values), 0)
+            max_value = max(max(values), 100)
+
+            return Gauge(
+                id={'type': 'panel-gauge', 'index': index},
+                label={'label': metric_type, 'style': {'fontSize': '18px'}},
+                min=min_value,
+                max=max_value,
+                value=current_value,
+                showCurrentValue=True,
+                color={"gradient": True, "ranges": {"green": [min_value, max_value * 0.7], "red": [max_value * 0.7, max_value]}}
+            )
+        elif view_type == 'graph':
+            return dcc.Graph(
+                id={'type': 'panel-graph', 'index': index},
+                figure={
+                    'data': [
+                        {'x': timestamps, 'y': values, 'type': 'line', 'name': metric_type}
+                    ],
+                    'layout': {'title': metric_type}
+                }
+            )
+        elif view_type == 'table':
+            return html.Table(
+                id={'type': 'panel-table', 'index': index},
+                children=self.table_rows(timestamps, values)
+            )
+        return html.Div(f"Unknown view type {view_type}")
+
+    @staticmethod
+    def format_epoch(epoch) -> str:
+        return datetime.utcfromtimestamp(epoch).strftime('%d-%m-%Y %H:%M:%S')
+
+    @staticmethod
+    def table_patch(timestamps, values, rows):
+        """Append the new rows to a table showing rows readings and drop the oldest past LATEST_READINGS."""
+        patch = Patch()
+        patch.extend(Dashboard.table_rows(timestamps, values)[1:])
+        # Row 0 is the header
+        for _ in range(min(rows + len(timestamps) - LATEST_READINGS, rows)):
+            del patch[1]
+        return patch
+
+    @staticmethod
+    def table_rows(timestamps, values):
+        return [
+            html.Tr([html.Th('Timestamp'), html.Th('Value')])
+        ] + [
+            html.Tr([html.Td(ts), html.Td(val)]) for ts, val in zip(timestamps, values)
+        ]
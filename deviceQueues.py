@@ -0,0 +1,54 @@
+"""
+Library module for the bounded per-device queues between the ESP32 connection handlers and
+the collector. Each device gets a ring buffer of maxlen messages, a full buffer drops its
+oldest message and counts it against the device. One lock is held only for an append or
+to swap out every queue at once, so draining never waits on the number of queued messages.
+"""
+
+import threading
+from collections import deque
+
+
+class deviceQueues:
+    def __init__(self, maxlen: int = 100):
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        # device_name -> deque of messages, oldest first
+        self.queues = {}
+        # device_name -> messages dropped since start
+        self.dropped = {}
+        self.received = 0
+        self.total_dropped = 0
+
+    def put(self, device_name: str, message):
+        with self.lock:
+            queue = self.queues.get(device_name)
+            if queue is None:
+                queue = self.queues[device_name] = deque(maxlen=self.maxlen)
+            elif len(queue) == self.maxlen:
+                # deque(maxlen) drops the oldest entry on append
+                self.dropped[device_name] = self.dropped.get(device_name, 0) + 1
+                self.total_dropped += 1
+            queue.append(message)
+            self.received += 1
+
+    def drain(self) -> dict:
+        """Take every queued message, as {device_name: deque of messages, oldest first}."""
+        with self.lock:
+            queues, self.queues = self.queues, {}
+        return queues
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'devices': len(self.queues),
+                'received': self.received,
+                'dropped': self.total_dropped,
+                'queued': sum(len(queue) for queue in self.queues.values()),
+                # Only devices that have overflowed, to keep the stats line short at thousands of devices
+                'dropped_by_device': dict(self.dropped)
+            }
@@ -0,0 +1,86 @@
+"""
+Library module for the server side cache of dimension rows (aggregators, devices and metric types).
+These rows are keyed on natural keys that almost never change, so ingestion and the threshold
+routes can resolve them without a database round trip. The cache is bounded and evicts the
+least recently used entry once full.
+
+Invalidating a key stamps it with a new generation. A writer that read a value from the database
+takes a generation() token before the read and passes it to put, which then refuses the value if
+the key was invalidated meanwhile, so a value read before an update never returns to the cache.
+"""
+
+import threading
+from collections import OrderedDict
+
+AGGREGATOR = 'aggregator'
+DEVICE = 'device'
+DEVICE_NAME = 'device_name'
+METRIC_TYPE = 'metric_type'
+HEARTBEAT = 'heartbeat'
+
+
+class dimensionCache:
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Generation each key was last invalidated at
+        self.generations = {}
+        self.clock = 0
+        self.stale_puts = 0
+
+    def get(self, kind, *key):
+        """Return the cached value for the natural key or None if it is not cached."""
+        with self.lock:
+            value = self.entries.get((kind, *key))
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((kind, *key))
+            self.hits += 1
+            return value
+
+    def generation(self) -> int:
+        """Token to pass to put for a value about to be read from the database."""
+        with self.lock:
+            return self.clock
+
+    def put(self, kind, *key, value, generation: int = None):
+        """Cache a value. With a generation token, the value is dropped if the key was invalidated since."""
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            if generation is not None and self.generations.get((kind, *key), 0) > generation:
+                self.stale_puts += 1
+                return
+            self.entries[(kind, *key)] = value
+            self.entries.move_to_end((kind, *key))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, kind, *key):
+        with self.lock:
+            self.entries.pop((kind, *key), None)
+            self.clock += 1
+            self.generations[(kind, *key)] = self.clock
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'stale_puts': self.stale_puts,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,153 @@
+"""
+Library module for the asyncio ESP32 gateway.
+Serves every device connection on one event loop, running on its own thread, instead of one
+OS thread per connection. The wire protocol is the one remoteMonitor.parseCustomProtocol
+documents: a 4 byte big-endian payload length, the null-terminated device name, then the JSON
+or binary metrics payload (see esp32Payload.py). Connections are BufferedProtocols receiving straight into a frameDecoder.
+Every frame is acknowledged with "Metrics received", and REBOOT commands from other threads are
+written on the loop.
+"""
+
+import asyncio
+import logging
+import threading
+from frameDecoder import frameDecoder
+from esp32Payload import parsePayload
+
+ACK = b"Metrics received"
+
+
+class gatewayConnection:
+    """Stands in for the socket in remoteMonitor.device_connections, sendall may be called from any thread."""
+    __slots__ = ('loop', 'transport')
+
+    def __init__(self, loop, transport):
+        self.loop = loop
+        self.transport = transport
+
+    def sendall(self, data: bytes):
+        if self.transport.is_closing():
+            raise ConnectionError("Connection is closed")
+        self.loop.call_soon_threadsafe(self.transport.write, data)
+
+
+class gatewayProtocol(asyncio.BufferedProtocol):
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.decoder = frameDecoder(gateway.max_frame_bytes)
+        self.transport = None
+        self.connection = None
+        self.device_name = None
+        self.addr = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connection = gatewayConnection(self.gateway.loop, transport)
+        self.addr = transport.get_extra_info('peername')
+        self.gateway.connections += 1
+        self.gateway.logger.debug(f"Connection established with ESP32 at {self.addr}")
+
+    def get_buffer(self, sizehint):
+        return self.decoder.writable()
+
+    def buffer_updated(self, nbytes):
+        self.decoder.advance(nbytes)
+        gateway = self.gateway
+        acks = 0
+        invalid = None
+        try:
+            for device_name, payload in self.decoder.frames():
+                self.device_name = device_name
+                gateway.onMetrics(device_name, parsePayload(payload), self.connection)
+                acks += 1
+        except ValueError as e:
+            # Covers the frame limits, bad UTF-8, bad JSON and malformed binary payloads, the stream cannot be resynchronised
+            invalid = e
+        if acks:
+            gateway.frames += acks
+            # One write for every frame taken from this read
+            self.transport.write(ACK * acks)
+        if invalid:
+            gateway.errors += 1
+            gateway.logger.error(f"Invalid frame from ESP32 {self.device_name or self.addr}: {invalid}")
+            self.transport.close()
+
+    def eof_received(self):
+        if len(self.decoder):
+            self.gateway.errors += 1
+            self.gateway.logger.warning(f"Connection closed by ESP32 at {self.addr} mid-frame")
+        else:
+            self.gateway.logger.debug(f"Connection closed by ESP32 at {self.addr}")
+        return False
+
+    def pause_writing(self):
+        # The device stopped reading its acks, stop reading its frames until it catches up
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.gateway.connections -= 1
+        if exc:
+            self.gateway.logger.debug(f"Connection with ESP32 at {self.addr} lost: {exc}")
+        if self.device_name is not None and self.gateway.onDisconnect:
+            self.gateway.onDisconnect(self.device_name, self.connection)
+
+
+class esp32Gateway:
+    def __init__(self, host: str, port: int, onMetrics, onDisconnect=None, backlog: int = 1024, max_frame_bytes: int = 65536, reuse_port: bool = False, logger=None):
+        """
+        onMetrics(device_name, message, connection) is called on the loop for every decoded frame, see esp32Payload.parsePayload,
+        onDisconnect(device_name, connection) when a connection that sent a frame closes.
+        reuse_port lets several processes listen on the port, see shardedGateway.py.
+        """
+        self.host = host
+        self.port = port
+        self.onMetrics = onMetrics
+        self.onDisconnect = onDisconnect
+        self.backlog = backlog
+        self.max_frame_bytes = max_frame_bytes
+        self.reuse_port = reuse_port
+        self.logger = logger or logging.getLogger()
+        self.loop = None
+        self.server = None
+        self.ready = threading.Event()
+        self.connections = 0
+        self.frames = 0
+        self.errors = 0
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name="esp32-gateway", daemon=True)
+        thread.start()
+        self.ready.wait()
+        return thread
+
+    def run(self):
+        self.logger.info(f"Starting ESP32 gateway on {self.host}:{self.port}")
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            self.logger.error(f"Error in ESP32 gateway: {e}")
+        finally:
+            self.ready.set()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await self.loop.create_server(
+            lambda: gatewayProtocol(self), self.host, self.port, backlog=self.backlog, reuse_port=self.reuse_port or None
+        )
+        self.ready.set()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def stop(self):
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    def stats(self) -> dict:
+        return {
+            'connections': self.connections,
+            'frames': self.frames,
+            'errors': self.errors
+        }
@@ -0,0 +1,80 @@
+"""
+Library module for the payload of an ESP32 frame (see frameDecoder.py for the framing).
+A payload is either the original JSON object or, from firmware built with the binary option,
+a versioned little-endian struct:
+
+    header   u8 magic (0xB5), u8 version, u8 reading count, u8 reserved, u32 epoch seconds UTC (0 = unsynced)
+    reading  u8 metric id, f32 value, f32 threshold (NaN when the metric has none)   x count
+
+Metric ids map to names through METRIC_NAMES, kept in step with esp32_metric_id_t in the
+firmware's socketManager.h. A JSON payload always starts with '{', so the first byte tells the two apart.
+"""
+
+import json
+import math
+import struct
+from datetime import datetime, timezone
+from functools import lru_cache
+from systemMetrics import DTO_Metric
+
+PAYLOAD_MAGIC = 0xB5
+PAYLOAD_VERSIONS = (1,)
+HEADER = struct.Struct('<BBBxI')
+READING = struct.Struct('<Bff')
+# Metric id -> name, an unknown id is reported as metric_<id>
+METRIC_NAMES = {
+    1: 'gas',
+    2: 'Alarming'
+}
+METRIC_IDS = {name: metric_id for metric_id, name in METRIC_NAMES.items()}
+
+
+def isBinary(payload) -> bool:
+    return len(payload) > 0 and payload[0] == PAYLOAD_MAGIC
+
+
+def parsePayload(payload):
+    """
+    Check a frame's payload as it arrives. Returns the JSON object, or the binary payload itself
+    to be unpacked later by payloadMetrics. Raises ValueError for a malformed payload of either kind.
+    """
+    if not isBinary(payload):
+        return json.loads(payload)
+    if len(payload) < HEADER.size:
+        raise ValueError(f"Binary payload of {len(payload)} bytes is shorter than its header")
+    _, version, count, _ = HEADER.unpack_from(payload)
+    if version not in PAYLOAD_VERSIONS:
+        raise ValueError(f"Unsupported binary payload version {version}")
+    if len(payload) != HEADER.size + count * READING.size:
+        raise ValueError(f"Binary payload of {len(payload)} bytes does not hold {count} readings")
+    return payload
+
+
+@lru_cache(maxsize=256)
+def epochTimestamp(epoch: int) -> str:
+    """Formatted once per second for all the devices reporting in it."""
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def payloadMetrics(payload):
+    """
+    Returns (timestamp, [DTO_Metric]) for a binary payload parsePayload accepted, the timestamp
+    formatted as for JSON payloads, or None when the device clock was unsynced.
+    """
+    epoch = HEADER.unpack_from(payload)[3]
+    names = METRIC_NAMES
+    metrics = [
+        # threshold != threshold is the NaN test, NaN marks a metric without threshold
+        DTO_Metric(names.get(metric_id) or f"metric_{metric_id}", value, None if threshold != threshold else threshold)
+        for metric_id, value, threshold in READING.iter_unpack(memoryview(payload)[HEADER.size:])
+    ]
+    return (epochTimestamp(epoch) if epoch else None), metrics
+
+
+def packReadings(epoch: int, readings, version: int = 1) -> bytes:
+    """Encode [(name, value, threshold or None)] the way the firmware does, for device simulators."""
+    nan = math.nan
+    return HEADER.pack(PAYLOAD_MAGIC, version, len(readings), epoch) + b''.join(
+        READING.pack(METRIC_IDS[name], value, nan if threshold is None else threshold)
+        for name, value, threshold in readings
+    )
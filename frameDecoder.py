@@ -0,0 +1,105 @@
+"""
+Library module for incremental decoding of the ESP32 stream protocol: a 4 byte big-endian
+payload length, the null-terminated device name, then the metrics payload (see esp32Payload.py).
+Bytes are received straight into one reusable bytearray (recv_into, or asyncio's
+BufferedProtocol), any number of complete frames are taken from it per read without slicing
+copies, and only the tail of an incomplete frame is ever moved back to the front.
+"""
+
+import struct
+
+HEADER_SIZE = 4
+unpack_header = struct.Struct('>I').unpack_from
+
+
+class frameDecoder:
+    __slots__ = ('max_frame_bytes', 'max_name_bytes', 'buffer', 'view', 'start', 'end', 'needed')
+
+    def __init__(self, max_frame_bytes: int = 65536, buffer_bytes: int = 4096, max_name_bytes: int = 256):
+        self.max_frame_bytes = max_frame_bytes
+        self.max_name_bytes = max_name_bytes
+        self.buffer = bytearray(buffer_bytes)
+        self.view = memoryview(self.buffer)
+        # Unconsumed bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # Buffer end offset the frame at start needs before it can be decoded
+        self.needed = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def writable(self, minimum: int = 1024) -> memoryview:
+        """Free space after the buffered bytes, at least minimum bytes, to receive into. Call advance with the count received."""
+        if len(self.buffer) - self.end < minimum:
+            pending = self.end - self.start
+            if self.start and len(self.buffer) - pending >= minimum:
+                # Move the incomplete frame to the front, the only copy the decoder makes
+                self.view[:pending] = self.view[self.start:self.end]
+            else:
+                self.grow(pending + minimum)
+            if self.needed:
+                self.needed -= self.start
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def advance(self, nbytes: int):
+        self.end += nbytes
+
+    def feed(self, data):
+        """Append bytes received elsewhere."""
+        size = len(data)
+        self.writable(size)[:size] = data
+        self.end += size
+
+    def recvFrom(self, sock) -> int:
+        """One recv_into from a blocking socket. Returns the bytes received, 0 once the peer has closed."""
+        nbytes = sock.recv_into(self.writable())
+        self.end += nbytes
+        return nbytes
+
+    def grow(self, size: int):
+        pending = self.view[self.start:self.end]
+        capacity = len(self.buffer)
+        while capacity < size:
+            capacity *= 2
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.view[:len(pending)] = pending
+
+    def frames(self) -> list:
+        """
+        Take every complete frame buffered, as (device_name, payload) pairs, payload being the bytes for esp32Payload.parsePayload.
+        Raises ValueError for a frame that can never be valid, after which the stream cannot be resynchronised.
+        """
+        end = self.end
+        if end < self.needed:
+            return []
+        buffer = self.buffer
+        max_frame_bytes, max_name_bytes = self.max_frame_bytes, self.max_name_bytes
+        start = self.start
+        frames = []
+        try:
+            while end - start >= HEADER_SIZE:
+                length = unpack_header(buffer, start)[0]
+                if length > max_frame_bytes:
+                    raise ValueError(f"Frame of {length} bytes exceeds {max_frame_bytes}")
+                name_start = start + HEADER_SIZE
+                terminator = buffer.find(b'\x00', name_start, name_start + max_name_bytes + 1)
+                if terminator == -1 or terminator >= end:
+                    if end - name_start > max_name_bytes:
+                        raise ValueError(f"Device name longer than {max_name_bytes} bytes or missing its null terminator")
+                    break
+                payload_end = terminator + 1 + length
+                if payload_end > end:
+                    # Nothing to do until the rest of this frame has arrived
+                    self.needed = payload_end
+                    break
+                frames.append((buffer[name_start:terminator].decode(), buffer[terminator + 1:payload_end]))
+                start = payload_end
+        finally:
+            if start == end:
+                self.start = self.end = self.needed = 0
+            else:
+                self.start = start
+        return frames
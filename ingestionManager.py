@@ -0,0 +1,410 @@
+"""
+Library module for storing uploaded aggregator payloads in the metrics database.
+The aggregator, device and metric type rows referenced by a payload are resolved with a
+handful of set-based queries, and all snapshots and metric values are written with
+multi-row inserts inside a single transaction.
+"""
+
+import logging
+from datetime import datetime, UTC
+from typing import List
+from sqlalchemy import insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from models import Aggregator, Device, MetricType, SystemMetricSnapshot, SystemMetricValue
+from systemMetrics import DTO_Aggregator, DTO_ColumnarDevice
+from rollupManager import updateRollups
+from dimensionCache import dimensionCache, AGGREGATOR, DEVICE, DEVICE_NAME, HEARTBEAT, METRIC_TYPE
+
+# SQLite limits the number of bound parameters per statement, so IN lists are chunked.
+IN_CLAUSE_CHUNK_SIZE = 500
+# Dimension ids resolved inside a transaction are only cached once it commits.
+PENDING_CACHE_KEY = 'pending_dimension_cache'
+# Cache generation taken before the first read of a session, see dimensionCache.
+CACHE_GENERATION_KEY = 'dimension_cache_generation'
+
+
+def chunked(items, size=IN_CLAUSE_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def snapshotEpoch(timestamp) -> int:
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return int(timestamp.timestamp())
+
+
+def deviceMetricTypes(device):
+    """Yield (metric name, threshold) for every metric a device reports, in either payload layout."""
+    if isinstance(device, DTO_ColumnarDevice):
+        yield from zip(device.metric_names, device.thresholds)
+        return
+    for snapshot in device.data_snapshots:
+        for metric in snapshot.metrics:
+            yield metric.name, metric.threshold
+
+
+def deviceEpochs(device):
+    """Client epoch of each snapshot of a device, in either payload layout."""
+    if isinstance(device, DTO_ColumnarDevice):
+        return [int(epoch) for epoch in device.epochs]
+    return [snapshotEpoch(snapshot.timestamp_utc) for snapshot in device.data_snapshots]
+
+
+def deviceRows(device, column):
+    """
+    Yield, per snapshot of a device, its (column(metric name), value) pairs in either payload layout.
+    column is looked up once per metric name, row payloads are read as they are without pivoting them.
+    """
+    if isinstance(device, DTO_ColumnarDevice):
+        columns = [column(name) for name in device.metric_names]
+        for row in device.values:
+            yield zip(columns, row)
+        return
+    columns = {}
+    for snapshot in device.data_snapshots:
+        row = []
+        for metric in snapshot.metrics:
+            name = metric.name
+            if name not in columns:
+                columns[name] = column(name)
+            row.append((columns[name], metric.value))
+        yield row
+
+
+class ingestionManager:
+    def __init__(self, engine, logger=None, cache: dimensionCache = None):
+        self.engine = engine
+        self.logger = logger or logging.getLogger()
+        self.cache = cache if cache is not None else dimensionCache()
+
+    def ingestAggregators(self, dto_aggregators: List[DTO_Aggregator]) -> List[List[str]]:
+        """
+        Store the supplied aggregator payloads in one transaction.
+        Returns, for each payload, the device names with a metric at or above its threshold
+        (one entry per breaching metric, matching the /metrics response contract).
+        """
+        with Session(self.engine) as session:
+            critical_devices = self.ingestInSession(session, dto_aggregators)
+            self.commit(session)
+        return critical_devices
+
+    def ingestEach(self, dto_aggregators: List[DTO_Aggregator]) -> list:
+        """
+        Store the payloads in one transaction, falling back to one transaction per payload if
+        the batch fails so a single bad payload does not reject the others.
+        Returns, for each payload, its critical device list or the exception that prevented storing it.
+        """
+        try:
+            return self.ingestAggregators(dto_aggregators)
+        except Exception as e:
+            if len(dto_aggregators) == 1:
+                return [e]
+            self.logger.error("Batch of %s payloads failed, retrying individually: %s", len(dto_aggregators), e)
+        results = []
+        for dto_aggregator in dto_aggregators:
+            try:
+                results.extend(self.ingestAggregators([dto_aggregator]))
+            except Exception as e:
+                self.logger.exception("Failed to store payload from %s: %s", dto_aggregator.name, e)
+                results.append(e)
+        return results
+
+    def commit(self, session: Session):
+        """
+        Commit the session and cache the dimension ids it resolved. Values whose key was invalidated
+        after the session started reading, such as a threshold updated meanwhile, are not cached.
+        """
+        session.commit()
+        generation = session.info.pop(CACHE_GENERATION_KEY, None)
+        for kind, key, value in session.info.pop(PENDING_CACHE_KEY, []):
+            self.cache.put(kind, *key, value=value, generation=generation)
+
+    def remember(self, session: Session, kind, key, value):
+        session.info.setdefault(PENDING_CACHE_KEY, []).append((kind, key, value))
+
+    def cacheGeneration(self, session: Session) -> int:
+        """The cache generation from before the session's first read, taken on the first call."""
+        return session.info.setdefault(CACHE_GENERATION_KEY, self.cache.generation())
+
+    def ingestInSession(self, session: Session, dto_aggregators: List[DTO_Aggregator]) -> List[List[str]]:
+        """
+        Stage the dto_aggregators on an open session without committing.
+        Payloads may be DTO_Aggregator or DTO_ColumnarAggregator, rows are built from either layout directly.
+        """
+        server_epoch = int(datetime.now(UTC).timestamp())
+        self.cacheGeneration(session)
+
+        aggregator_ids = self.resolveAggregators(session, {
+            str(payload.platform_uuid): payload.name for payload in dto_aggregators
+        })
+
+        device_keys = set()
+        for payload in dto_aggregators:
+            aggregator_id = aggregator_ids[str(payload.platform_uuid)]
+            for device in payload.devices:
+                device_keys.add((aggregator_id, device.name))
+        device_ids = self.resolveDevices(session, device_keys)
+
+        # The threshold of a new metric type is taken from the first metric that reports it
+        metric_type_keys = {}
+        for payload in dto_aggregators:
+            aggregator_id = aggregator_ids[str(payload.platform_uuid)]
+            for device in payload.devices:
+                device_id = device_ids[(aggregator_id, device.name)]
+                for name, threshold in deviceMetricTypes(device):
+                    metric_type_keys.setdefault((device_id, name), threshold)
+        metric_types = self.resolveMetricTypes(session, metric_type_keys)
+
+        heartbeats = {}
+        for payload in dto_aggregators:
+            if payload.heartbeat_seconds is None:
+                continue
+            aggregator_id = aggregator_ids[str(payload.platform_uuid)]
+            for device in payload.devices:
+                device_id = device_ids[(aggregator_id, device.name)]
+                for name, _ in deviceMetricTypes(device):
+                    heartbeats[metric_types[(device_id, name)][0]] = float(payload.heartbeat_seconds)
+        if heartbeats:
+            self.recordHeartbeats(session, heartbeats)
+
+        # (payload index, device_id, device) in snapshot row order
+        staged = []
+        snapshot_rows = []
+        for payload_index, payload in enumerate(dto_aggregators):
+            aggregator_id = aggregator_ids[str(payload.platform_uuid)]
+            for device in payload.devices:
+                device_id = device_ids[(aggregator_id, device.name)]
+                staged.append((payload_index, device_id, device))
+                for epoch in deviceEpochs(device):
+                    snapshot_rows.append({
+                        'device_id': device_id,
+                        'client_utc_timestamp_epoch': epoch,
+                        'server_utc_timestamp_epoch': server_epoch
+                    })
+        if not snapshot_rows:
+            return [[] for _ in dto_aggregators]
+
+        snapshot_ids = iter(session.scalars(
+            insert(SystemMetricSnapshot).returning(
+                SystemMetricSnapshot.metric_snapshot_id, sort_by_parameter_order=True
+            ),
+            snapshot_rows
+        ).all())
+
+        value_rows = []
+        critical_devices = [[] for _ in dto_aggregators]
+        for payload_index, device_id, device in staged:
+            for row in deviceRows(device, lambda name, device_id=device_id: metric_types[(device_id, name)]):
+                snapshot_id = next(snapshot_ids)
+                for (metric_type_id, threshold), value in row:
+                    if value is None:
+                        continue
+                    value = float(value)
+                    value_rows.append({
+                        'metric_snapshot_id': snapshot_id,
+                        'metric_type_id': metric_type_id,
+                        'metric_value': value
+                    })
+                    if threshold and value >= threshold:
+                        critical_devices[payload_index].append(device.name)
+
+        if value_rows:
+            session.execute(insert(SystemMetricValue), value_rows)
+            updateRollups(session, server_epoch, ((row['metric_type_id'], row['metric_value']) for row in value_rows))
+        self.logger.info("Staged %s snapshots and %s metric values", len(snapshot_rows), len(value_rows))
+        return critical_devices
+
+    def recordHeartbeats(self, session: Session, heartbeats: dict):
+        """
+        Store {metric_type_id: heartbeat_seconds} for metric types reported on change.
+        Only heartbeats that differ from the cached value are written. A heartbeat stays set if the
+        client later reports every sample again, values then arrive well within it.
+        """
+        changed = {}
+        for metric_type_id, heartbeat in heartbeats.items():
+            if self.cache.get(HEARTBEAT, metric_type_id) != heartbeat:
+                changed.setdefault(heartbeat, []).append(metric_type_id)
+        for heartbeat, metric_type_ids in changed.items():
+            for chunk in chunked(metric_type_ids):
+                session.execute(
+                    update(MetricType).where(MetricType.metric_type_id.in_(chunk)).values(metric_heartbeat_seconds=heartbeat)
+                )
+            for metric_type_id in metric_type_ids:
+                self.remember(session, HEARTBEAT, (metric_type_id,), heartbeat)
+
+    def evaluateThresholds(self, dto_aggregator: DTO_Aggregator) -> List[str]:
+        """
+        Return the critical devices of a payload without touching the database.
+        Stored thresholds are taken from the dimension cache, metrics whose type is not cached
+        are checked against the threshold sent with them.
+        """
+        critical_devices = []
+        aggregator_id = self.cache.get(AGGREGATOR, str(dto_aggregator.platform_uuid))
+        for device in dto_aggregator.devices:
+            device_id = None
+            if aggregator_id is not None:
+                device_id = self.cache.get(DEVICE, aggregator_id, device.name)
+            thresholds = {}
+            for name, threshold in deviceMetricTypes(device):
+                thresholds.setdefault(name, threshold)
+            if device_id is not None:
+                for name in thresholds:
+                    metric_type = self.cache.get(METRIC_TYPE, device_id, name)
+                    if metric_type is not None:
+                        thresholds[name] = metric_type[1]
+            for row in deviceRows(device, thresholds.get):
+                for threshold, value in row:
+                    if threshold and value is not None and float(value) >= threshold:
+                        critical_devices.append(device.name)
+        return critical_devices
+
+    def resolveAggregators(self, session: Session, names_by_guid: dict) -> dict:
+        """Return {guid: aggregator_id}, inserting any aggregators not yet stored."""
+        found = {}
+        for guid in names_by_guid:
+            aggregator_id = self.cache.get(AGGREGATOR, guid)
+            if aggregator_id is not None:
+                found[guid] = aggregator_id
+        uncached = [guid for guid in names_by_guid if guid not in found]
+        if not uncached:
+            return found
+
+        resolved = self.selectAggregators(session, uncached)
+        missing = [{'guid': guid, 'name': names_by_guid[guid]} for guid in uncached if guid not in resolved]
+        if missing:
+            # Conflicts mean a concurrent upload inserted the row first, the re-select picks it up
+            session.execute(sqlite_insert(Aggregator).on_conflict_do_nothing(), missing)
+            resolved.update(self.selectAggregators(session, [row['guid'] for row in missing]))
+        for guid, aggregator_id in resolved.items():
+            self.remember(session, AGGREGATOR, (guid,), aggregator_id)
+        found.update(resolved)
+        return found
+
+    def selectAggregators(self, session: Session, guids) -> dict:
+        found = {}
+        for chunk in chunked(guids):
+            rows = session.execute(
+                select(Aggregator.guid, Aggregator.aggregator_id)
+                .where(Aggregator.guid.in_(chunk))
+                .order_by(Aggregator.aggregator_id)
+            ).all()
+            for guid, aggregator_id in rows:
+                found.setdefault(guid, aggregator_id)
+        return found
+
+    def resolveDevices(self, session: Session, keys: set) -> dict:
+        """Return {(aggregator_id, name): device_id}, inserting any devices not yet stored."""
+        found = {}
+        for key in keys:
+            device_id = self.cache.get(DEVICE, *key)
+            if device_id is not None:
+                found[key] = device_id
+        uncached = keys - found.keys()
+        if not uncached:
+            return found
+
+        resolved = self.selectDevices(session, uncached)
+        missing = [{'aggregator_id': aggregator_id, 'name': name} for aggregator_id, name in uncached if (aggregator_id, name) not in resolved]
+        if missing:
+            session.execute(sqlite_insert(Device).on_conflict_do_nothing(), missing)
+            resolved.update(self.selectDevices(session, uncached - resolved.keys()))
+        for key, device_id in resolved.items():
+            self.remember(session, DEVICE, key, device_id)
+        found.update(resolved)
+        return found
+
+    def selectDevices(self, session: Session, keys: set) -> dict:
+        found = {}
+        aggregator_ids = {aggregator_id for aggregator_id, _ in keys}
+        for names in chunked({name for _, name in keys}):
+            rows = session.execute(
+                select(Device.aggregator_id, Device.name, Device.device_id)
+                .where(Device.aggregator_id.in_(aggregator_ids), Device.name.in_(names))
+                .order_by(Device.device_id)
+            ).all()
+            for aggregator_id, name, device_id in rows:
+                if (aggregator_id, name) in keys:
+                    found.setdefault((aggregator_id, name), device_id)
+        return found
+
+    def resolveMetricTypes(self, session: Session, thresholds_by_key: dict) -> dict:
+        """
+        Return {(device_id, metric_type): (metric_type_id, metric_threshold)}, inserting any
+        metric types not yet stored with the supplied threshold.
+        """
+        found = {}
+        for key in thresholds_by_key:
+            metric_type = self.cache.get(METRIC_TYPE, *key)
+            if metric_type is not None:
+                found[key] = metric_type
+        uncached = thresholds_by_key.keys() - found.keys()
+        if not uncached:
+            return found
+
+        resolved = self.selectMetricTypes(session, uncached)
+        missing = [
+            {'device_id': device_id, 'metric_type': name, 'metric_threshold': thresholds_by_key[(device_id, name)]}
+            for device_id, name in uncached if (device_id, name) not in resolved
+        ]
+        if missing:
+            session.execute(sqlite_insert(MetricType).on_conflict_do_nothing(), missing)
+            resolved.update(self.selectMetricTypes(session, uncached - resolved.keys()))
+        for key, metric_type in resolved.items():
+            self.remember(session, METRIC_TYPE, key, metric_type)
+        found.update(resolved)
+        return found
+
+    def selectMetricTypes(self, session: Session, keys) -> dict:
+        found = {}
+        keys = set(keys)
+        for device_ids in chunked({device_id for device_id, _ in keys}):
+            rows = session.execute(
+                select(MetricType.device_id, MetricType.metric_type, MetricType.metric_type_id, MetricType.metric_threshold)
+                .where(MetricType.device_id.in_(device_ids))
+                .order_by(MetricType.metric_type_id)
+            ).all()
+            for device_id, name, metric_type_id, threshold in rows:
+                if (device_id, name) in keys:
+                    found.setdefault((device_id, name), (metric_type_id, threshold))
+        return found
+
+    def lookupMetricType(self, session: Session, device_name: str, metric_type: str):
+        """
+        Return (device_id, metric_type_id, metric_threshold) for the first device with the given
+        name, or None if the device or metric type is not stored.
+        """
+        generation = self.cacheGeneration(session)
+        device_id = self.cache.get(DEVICE_NAME, device_name)
+        if device_id is None:
+            device_id = session.scalars(
+                select(Device.device_id).where(Device.name == device_name).order_by(Device.device_id).limit(1)
+            ).first()
+            if device_id is None:
+                return None
+            self.cache.put(DEVICE_NAME, device_name, value=device_id, generation=generation)
+
+        found = self.cache.get(METRIC_TYPE, device_id, metric_type)
+        if found is None:
+            found = self.selectMetricTypes(session, {(device_id, metric_type)}).get((device_id, metric_type))
+            if found is None:
+                return None
+            self.cache.put(METRIC_TYPE, device_id, metric_type, value=found, generation=generation)
+        metric_type_id, threshold = found
+        return device_id, metric_type_id, threshold
+
+    def updateMetricThreshold(self, device_name: str, metric_type: str, threshold: float) -> bool:
+        """Set the threshold of a stored metric type. Returns False if it does not exist."""
+        with Session(self.engine) as session:
+            found = self.lookupMetricType(session, device_name, metric_type)
+            if found is None:
+                return False
+            device_id, metric_type_id, _ = found
+            session.execute(
+                update(MetricType).where(MetricType.metric_type_id == metric_type_id).values(metric_threshold=threshold)
+            )
+            session.commit()
+        self.cache.invalidate(METRIC_TYPE, device_id, metric_type)
+        return True
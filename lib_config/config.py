@@ -7,7 +7,7 @@ to enable files to be loaded relative to the script without resorting to absolut
 
 import json
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 from typing import Any
 import logging
@@ -27,10 +27,93 @@ class ClientConfig:
     interval: int
     socket_host: str
     socket_port: int
+    # ESP32 connections are served by a thread each ("threads"), all on one event loop ("asyncio", see esp32Gateway.py)
+    # or by gateway_workers processes sharing the port ("processes", see shardedGateway.py, 0 workers = one per CPU)
+    gateway_mode: str = "threads"
+    gateway_workers: int = 0
+    gateway_backlog: int = 1024
+    # A frame announcing a longer metrics payload closes the connection
+    gateway_max_frame_bytes: int = 65536
+    # Messages queued per device between collector cycles, beyond it the oldest are dropped and counted
+    gateway_device_queue_size: int = 100
+    sample_interval_seconds: float = 0.5
+    buffer_size: int = 1000
+    upload_batch_size: int = 20
+    upload_max_age_seconds: float = 2.0
+    stats_log_interval_seconds: float = 60
+    http_connect_timeout_seconds: float = 3.05
+    http_read_timeout_seconds: float = 10.0
+    http_pool_size: int = 2
+    # Request bodies at least this large are gzip compressed, 0 disables compression
+    http_compress_min_bytes: int = 1024
+    http_retry_attempts: int = 3
+    http_backoff_base_seconds: float = 0.5
+    http_backoff_max_seconds: float = 30.0
+    # Local collectors by name, each {"enabled", "interval_seconds", ...collector options}, see collectorRegistry.py
+    collectors: dict = field(default_factory=lambda: {'threads': {}, 'memory': {}})
+    # A collector is run less often once its average CPU time exceeds this share of its interval
+    collector_max_overhead_ratio: float = 0.01
+    # Opt-in change detection: a metric is sent when it moves by more than its deadband, and at
+    # least once per heartbeat. Deadbands are absolute, keyed on metric name
+    change_detection: bool = False
+    change_heartbeat_seconds: float = 60.0
+    change_deadbands: dict = field(default_factory=dict)
+    change_default_deadband: float = 0.0
+    # Opt-in windowed pre-aggregation: samples are summarised per window_seconds before upload,
+    # see windowAggregator.py for the statistics. Threshold breaches are forwarded immediately
+    window_aggregation: bool = False
+    window_seconds: float = 10.0
+    window_statistics: list = field(default_factory=lambda: ['mean', 'min', 'max', 'p95', 'last', 'count'])
+    window_forward_breaches: bool = True
+    # Upload encoding: "json", "columnar" (JSON with per-device metric columns) or the struct-packed "binary" format, see wireFormat.py
+    wire_format: str = "json"
+    # Durable upload spool, unsent payloads beyond spool_max_bytes are evicted oldest segment first
+    spool_dir: str = "spool"
+    spool_segment_bytes: int = 1048576
+    spool_max_bytes: int = 67108864
+    spool_fsync: bool = False
+    # A backlog is replayed through POST /metrics/batch in batches bounded by count and uncompressed size
+    spool_replay_batch_size: int = 50
+    spool_replay_max_bytes: int = 1048576
 
 @dataclass
 class DatabaseConfig:
     connection_string: str
+    dimension_cache_size: int = 10000
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    mmap_size: int = 268435456
+    cache_size_kb: int = 65536
+    busy_timeout_ms: int = 5000
+    # Only takes effect on a new database, existing ones are converted by main.py --convert-auto-vacuum or RetentionConfig.convert_auto_vacuum
+    auto_vacuum: str = "INCREMENTAL"
+    # Pooled connections are shared by dashboard readers plus the single writer
+    reader_pool_size: int = 4
+
+@dataclass
+class IngestionConfig:
+    write_behind: bool = False
+    queue_size: int = 1000
+    batch_size: int = 200
+    batch_wait_seconds: float = 0.05
+    retry_after_seconds: int = 1
+    # Largest number of payloads accepted by one POST /metrics/batch
+    max_batch_items: int = 1000
+
+@dataclass
+class RetentionConfig:
+    enabled: bool = False
+    interval_seconds: int = 3600
+    # Days of raw values to keep, None keeps them forever
+    raw_retention_days: Optional[float] = 7
+    # Per metric type name overrides of raw_retention_days
+    metric_raw_retention_days: dict = field(default_factory=dict)
+    # Days of rollups to keep per resolution ('1m', '1h', '1d'), missing keeps them forever
+    rollup_retention_days: dict = field(default_factory=lambda: {'1m': 30, '1h': 365})
+    chunk_size: int = 5000
+    vacuum_pages: int = 10000
+    # Convert an existing database to incremental auto_vacuum once at server start up, see retentionManager.convertAutoVacuum
+    convert_auto_vacuum: bool = False
 
 @dataclass
 class ConsoleLoggingConfig:
@@ -60,6 +143,8 @@ class Aggregator:
 class Config:
     web: WebConfig
     database: DatabaseConfig
+    ingestion: IngestionConfig
+    retention: RetentionConfig
     logging_config: LoggingConfig
     aggregator: Aggregator
     mode = ""
@@ -90,6 +175,8 @@ class Config:
         self.web = WebConfig(**self._config.get('web', {}))
         self.client = ClientConfig(**self._config.get('client', {}))
         self.database = DatabaseConfig(**self._config.get('database', {}))
+        self.ingestion = IngestionConfig(**self._config.get('ingestion', {}))
+        self.retention = RetentionConfig(**self._config.get('retention', {}))
         self.aggregator = Aggregator(**self._config.get('aggregator', {}))
         raw_logging_config = self._config.get('logging_config', {})
         self.logging_config = LoggingConfig(
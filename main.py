@@ -41,6 +41,24 @@ class ApplicationHandler:
             app.config.web.host = host
         
         return app.run()
+
+    def convert_auto_vacuum(self) -> int:
+        """
+        Convert the server database to incremental auto_vacuum and exit. This runs a full VACUUM, so run it while the server is stopped.
+        """
+        from retentionManager import convertAutoVacuum
+        from storageProfile import createEngine
+
+        engine = createEngine(self.config.database)
+        try:
+            if not convertAutoVacuum(engine, self.logger):
+                self.logger.info("Database is already in incremental auto_vacuum mode")
+            return 0
+        except Exception as e:
+            self.logger.exception("Failed to convert database to incremental auto_vacuum: %s", str(e))
+            return 1
+        finally:
+            engine.dispose()
     
     def entryPoint(self, args) -> int:
         # Validate port
@@ -59,6 +77,8 @@ class ApplicationHandler:
                 return 1
 
         # Check mode
+        if args.convert_auto_vacuum:
+            return self.convert_auto_vacuum()
         if args.client and args.server:
             self.logger.error("Error: You can only specify one mode, either --client or --server.")
             return 1
@@ -80,6 +100,7 @@ def main() -> int:
     parser.add_argument("-s", "--server", action="store_true", help="Run the server")
     parser.add_argument("-i", "--ip", type=str, help="Specify the IP address for the server")
     parser.add_argument("-p", "--port", type=int, help="Specify the port for the server")
+    parser.add_argument("--convert-auto-vacuum", action="store_true", help="Convert the server database to incremental auto_vacuum with a one-off full VACUUM and exit")
 
     # Parse arguments
     args = parser.parse_args()
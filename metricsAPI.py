@@ -1,48 +1,152 @@
+import gzip
 import logging
+import random
+import time
 from systemMetrics import DTO_Aggregator
 import requests
-from collections import deque
+from requests.adapters import HTTPAdapter
+from uploadSpool import uploadSpool
+from wireFormat import BINARY_BATCH_CONTENT_TYPE, BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE, NDJSON_CONTENT_TYPE, encodePayload, isBinary, packBatch
+
+# Responses worth retrying, everything else in the 4xx range means the payload itself was rejected
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
 
 class MetricsApi:
     def __init__(self, config, logger):
-        self.snapshot_queue = deque()
         self.config = config
         self.logger = logger
+        # Durable on-disk queue of aggregator payloads that have not been accepted by the server yet
+        self.snapshot_queue = uploadSpool(
+            config.client.spool_dir,
+            segment_bytes=config.client.spool_segment_bytes,
+            max_bytes=config.client.spool_max_bytes,
+            fsync=config.client.spool_fsync,
+            logger=logger
+        )
+        self.timeout = (config.client.http_connect_timeout_seconds, config.client.http_read_timeout_seconds)
+        # One pooled keep-alive session so uploads reuse the TCP/TLS connection
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.client.http_pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.consecutive_failures = 0
+        self.next_attempt = 0.0
+        self.bytes_sent = 0
 
     def uploadMetrics(self, aggregator: DTO_Aggregator):
         criticalDevices = []
-        self.logger.debug("Aggregated devices: %s", aggregator.to_dict())
-        self.snapshot_queue.append(aggregator.to_dict())
+        self.logger.debug("Aggregated devices: %s", aggregator)
+        self.snapshot_queue.append(encodePayload(aggregator, self.config.client.wire_format))
         self.logger.info("Current upload queue size: %s", len(self.snapshot_queue))
-        while self.snapshot_queue: # TODO: Maybe turn this into another function called flush that can be called by a different thread
-            snapshot = self.snapshot_queue.popleft()
+        if time.monotonic() < self.next_attempt:
+            self.logger.debug("Server backing off for %.1fs, keeping snapshots queued", self.next_attempt - time.monotonic())
+            return []
+        while len(self.snapshot_queue):
+            records = self.takeBatch()
             try:
-                endpoint = f"{self.config.web.host}:{self.config.web.port}/metrics"
-                response = requests.post(endpoint, json=snapshot) 
-                if response.status_code == 201:
-                    try:
-                        response_data = response.json()  # Parse the response as JSON
-                        self.logger.debug(response_data)
-                        critical_devices = response_data.get("criticalDevices", [])
-                        if critical_devices:
-                            criticalDevices.extend(critical_devices)  # Add to the list
-                    except ValueError as e:
-                        self.logger.error("Failed to parse response JSON: %s", e)
+                binary = isBinary(records[0][0])
+                if len(records) == 1:
+                    response = self.post("/metrics", records[0][0], BINARY_CONTENT_TYPE if binary else JSON_CONTENT_TYPE)
+                elif binary:
+                    response = self.post("/metrics/batch", packBatch(body for body, _ in records), BINARY_BATCH_CONTENT_TYPE)
                 else:
-                    self.logger.error("Failed to upload snapshot, status code: %s, response: %s", response.status_code, response.text)
-                    self.snapshot_queue.appendleft(snapshot)
-                    return []
+                    # The spool already holds one JSON document per payload, joined as is into NDJSON
+                    response = self.post("/metrics/batch", b'\n'.join(body for body, _ in records), NDJSON_CONTENT_TYPE)
             except Exception as e:
                 self.logger.error("Failed to upload snapshot: %s", e)
-                self.snapshot_queue.appendleft(snapshot)
-                return []
+                self.backoff()
+                return criticalDevices
+            if response.status_code in (201, 207):
+                try:
+                    response_data = response.json()  # Parse the response as JSON
+                    self.logger.debug(response_data)
+                except ValueError as e:
+                    self.logger.error("Failed to parse response JSON: %s", e)
+                    response_data = {}
+                results = response_data.get("results") or [{'code': 201}] * len(records)
+                # Payloads are acknowledged in order, up to the first one the server asked to retry
+                delivered = next((i for i, result in enumerate(results) if result.get('code') in RETRYABLE_STATUS_CODES), len(records))
+                for result in results[:delivered]:
+                    if result.get('code') != 201:
+                        self.logger.error("Server rejected snapshot, dropping it. Status code: %s, response: %s", result.get('code'), result.get('message'))
+                if delivered:
+                    self.consecutive_failures = 0
+                    self.snapshot_queue.commit(records[delivered - 1][1])
+                criticalDevices.extend(device for device in response_data.get("criticalDevices", []) if device not in criticalDevices)
+                if delivered < len(records):
+                    self.logger.error("Server could not store %s of %s snapshots, retrying later", len(records) - delivered, len(records))
+                    self.backoff(response.headers.get('Retry-After'))
+                    return criticalDevices
+            elif response.status_code in RETRYABLE_STATUS_CODES:
+                self.logger.error("Failed to upload snapshot, status code: %s, response: %s", response.status_code, response.text)
+                self.backoff(response.headers.get('Retry-After'))
+                return criticalDevices
+            else:
+                self.logger.error("Server rejected %s snapshots, dropping them. Status code: %s, response: %s", len(records), response.status_code, response.text)
+                self.snapshot_queue.commit(records[-1][1])
         self.logger.info("All snapshots in upload queue uploaded successfully")
         return criticalDevices
+
+    def takeBatch(self):
+        """
+        The oldest queued payloads, bounded by spool_replay_batch_size and spool_replay_max_bytes.
+        A batch never mixes wire formats, payloads spooled before a wire_format change keep theirs.
+        """
+        records = self.snapshot_queue.peek(self.config.client.spool_replay_batch_size)
+        binary = isBinary(records[0][0])
+        size = 0
+        for count, (body, _) in enumerate(records):
+            size += len(body) + 4
+            if count and (size > self.config.client.spool_replay_max_bytes or isBinary(body) != binary):
+                return records[:count]
+        return records
+
+    def post(self, path, body: bytes, content_type=JSON_CONTENT_TYPE):
+        """POST an encoded body, gzip compressed when large, retrying transient failures with backoff."""
+        headers = {'Content-Type': content_type}
+        if 0 < self.config.client.http_compress_min_bytes <= len(body):
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        endpoint = f"{self.config.web.host}:{self.config.web.port}{path}"
+
+        attempts = max(self.config.client.http_retry_attempts, 1)
+        for attempt in range(attempts):
+            try:
+                response = self.session.post(endpoint, data=body, headers=headers, timeout=self.timeout)
+                self.bytes_sent += len(body)
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt == attempts - 1:
+                    return response
+                retry_after = response.headers.get('Retry-After')
+                self.logger.warning("Upload attempt %s returned %s, retrying", attempt + 1, response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == attempts - 1:
+                    raise
+                retry_after = None
+                self.logger.warning("Upload attempt %s failed, retrying: %s", attempt + 1, e)
+            time.sleep(self.backoffDelay(attempt, retry_after))
+
+    def backoffDelay(self, attempt, retry_after=None):
+        """Exponential backoff with equal jitter, never shorter than a Retry-After from the server."""
+        ceiling = min(self.config.client.http_backoff_max_seconds, self.config.client.http_backoff_base_seconds * 2 ** attempt)
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        try:
+            delay = max(delay, float(retry_after)) if retry_after else delay
+        except ValueError:
+            pass
+        return delay
+
+    def backoff(self, retry_after=None):
+        """Hold off further uploads after the retries of a request were exhausted."""
+        self.consecutive_failures += 1
+        delay = self.backoffDelay(self.consecutive_failures, retry_after)
+        self.next_attempt = time.monotonic() + delay
+        self.logger.warning("Upload failed %s times in a row, next attempt in %.1fs", self.consecutive_failures, delay)
     
     def testServerLive(self):
         try:
             endpoint = self.config.web.host + ":" + str(self.config.web.port) + "/hello"
-            response = requests.get(endpoint)
+            response = self.session.get(endpoint, timeout=self.timeout)
             if response.status_code == 200:
                 self.logger.info("Server is live")
                 return 0
@@ -52,3 +156,4 @@ class MetricsApi:
         except Exception as e:
                 self.logger.error("Failed to connect to server: %s", e)
                 return 1
+
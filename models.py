@@ -1,5 +1,5 @@
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Float
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, PrimaryKeyConstraint, String, Float
+from sqlalchemy.orm import declared_attr, relationship
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -12,6 +12,10 @@ class Aggregator(Base):
     guid = Column(String, nullable=False)
     name = Column(String, nullable=False)
 
+    __table_args__ = (
+        Index('ux_aggregators_guid', 'guid', unique=True),
+    )
+
 class SystemMetricSnapshot(Base):
     __tablename__ = 'system_metric_snapshots'
 
@@ -22,6 +26,12 @@ class SystemMetricSnapshot(Base):
 
     system_recorded = relationship('Device')
 
+    __table_args__ = (
+        # Time ordered reads across all devices and per device
+        Index('ix_snapshots_server_time', 'server_utc_timestamp_epoch'),
+        Index('ix_snapshots_device_server_time', 'device_id', 'server_utc_timestamp_epoch'),
+    )
+
 class Device(Base):
     __tablename__ = 'devices'
 
@@ -31,6 +41,11 @@ class Device(Base):
 
     aggregator = relationship('Aggregator')
 
+    __table_args__ = (
+        Index('ux_devices_aggregator_name', 'aggregator_id', 'name', unique=True),
+        Index('ix_devices_name', 'name'),
+    )
+
 class MetricType(Base):
     __tablename__ = 'metric_types'
 
@@ -38,9 +53,17 @@ class MetricType(Base):
     device_id = Column(ForeignKey('devices.device_id'), nullable=False)
     metric_type = Column(String, nullable=False)
     metric_threshold = Column(Float, nullable=True)
+    # Set when the client reports this metric only on change, at least once per heartbeat.
+    # A value then holds until the next stored value or for this many seconds, whichever is first.
+    metric_heartbeat_seconds = Column(Float, nullable=True)
     
     device = relationship('Device')
 
+    __table_args__ = (
+        Index('ux_metric_types_device_metric', 'device_id', 'metric_type', unique=True),
+        Index('ix_metric_types_metric', 'metric_type'),
+    )
+
 class SystemMetricValue(Base):
     __tablename__ = 'metric_values'
 
@@ -52,5 +75,46 @@ class SystemMetricValue(Base):
     device_type = relationship('MetricType')
     metric_snapshot = relationship('SystemMetricSnapshot')
 
-
-
+    __table_args__ = (
+        # Covers series reads by metric type without touching the table
+        Index('ix_metric_values_type_snapshot', 'metric_type_id', 'metric_snapshot_id', 'metric_value'),
+        # Lets time ordered snapshot scans probe for the value of a metric type
+        Index('ix_metric_values_snapshot_type', 'metric_snapshot_id', 'metric_type_id', 'metric_value'),
+    )
+
+
+class MetricRollupMixin:
+    """Downsampled metric values per metric type and time bucket. The average is sum_value / value_count."""
+    @declared_attr
+    def metric_type_id(cls):
+        return Column(ForeignKey('metric_types.metric_type_id'), nullable=False)
+
+    bucket_start_epoch = Column(Integer, nullable=False)
+    min_value = Column(Float, nullable=False)
+    max_value = Column(Float, nullable=False)
+    sum_value = Column(Float, nullable=False)
+    value_count = Column(Integer, nullable=False)
+    last_value = Column(Float, nullable=False)
+    last_epoch = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        # Range reads are always for a metric type over a span of buckets
+        PrimaryKeyConstraint('metric_type_id', 'bucket_start_epoch'),
+    )
+
+class MetricRollupMinute(MetricRollupMixin, Base):
+    __tablename__ = 'metric_rollups_1m'
+    resolution = '1m'
+    bucket_seconds = 60
+
+class MetricRollupHour(MetricRollupMixin, Base):
+    __tablename__ = 'metric_rollups_1h'
+    resolution = '1h'
+    bucket_seconds = 3600
+
+class MetricRollupDay(MetricRollupMixin, Base):
+    __tablename__ = 'metric_rollups_1d'
+    resolution = '1d'
+    bucket_seconds = 86400
+
+ROLLUP_MODELS = [MetricRollupMinute, MetricRollupHour, MetricRollupDay]
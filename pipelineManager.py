@@ -0,0 +1,221 @@
+"""
+Library module for the client's collection and upload pipeline.
+A collector thread samples on a fixed-rate schedule and pushes snapshots into a bounded ring
+buffer. An uploader thread drains the buffer in batches bounded by count or age, so a slow
+server never delays sampling. With window aggregation on, only window summaries and threshold
+breaches enter the buffer, and a breach is uploaded without waiting for the batch to fill.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from aggregationManager import aggregationManager
+from changeDetector import changeDetector
+from windowAggregator import windowAggregator
+
+
+class stageTimer:
+    """Running count, total, maximum and last duration of a pipeline stage, in seconds."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'avg_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'max_ms': self.max * 1000,
+            'last_ms': self.last * 1000
+        }
+
+
+class pipelineManager:
+    def __init__(self, config, logger, localMonitor, remoteMonitor, metricsSDK, agg_id, name):
+        self.client = config.client
+        self.logger = logger or logging.getLogger()
+        self.localMonitor = localMonitor
+        self.remoteMonitor = remoteMonitor
+        self.metricsSDK = metricsSDK
+        self.agg_id = agg_id
+        self.name = name
+        # Entries are (enqueue monotonic time, snapshot)
+        self.buffer = deque(maxlen=self.client.buffer_size)
+        # Only used by the uploader thread, emptied by drain after every batch
+        self.aggregator = aggregationManager()
+        self.changes = None
+        if self.client.change_detection:
+            self.changes = changeDetector(self.client.change_heartbeat_seconds, self.client.change_deadbands, self.client.change_default_deadband)
+        self.windows = None
+        if self.client.window_aggregation:
+            self.windows = windowAggregator(self.client.window_seconds, self.client.window_statistics, self.client.window_forward_breaches)
+        self.buffer_ready = threading.Condition()
+        # Set when the buffer holds a snapshot that should not wait for the batch size or age
+        self.urgent = False
+        self.stopping = threading.Event()
+        self.failed = threading.Event()
+        self.stats_lock = threading.Lock()
+        self.dropped = 0
+        self.timers = {
+            'collect': stageTimer(),
+            # How late each sample started relative to its schedule
+            'sample_lag': stageTimer(),
+            'upload': stageTimer(),
+            # Time between a snapshot entering the buffer and its upload completing
+            'buffer_age': stageTimer()
+        }
+        self.threads = [
+            threading.Thread(target=self.collect, name="collector", daemon=True),
+            threading.Thread(target=self.upload, name="uploader", daemon=True)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        with self.buffer_ready:
+            self.buffer_ready.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def wait(self) -> int:
+        """Block until the pipeline stops. Returns 1 if it stopped because of a failure."""
+        last_report = time.monotonic()
+        while not self.stopping.wait(1):
+            if time.monotonic() - last_report >= self.client.stats_log_interval_seconds:
+                self.logger.info("Pipeline stats: %s", self.stats())
+                last_report = time.monotonic()
+        return 1 if self.failed.is_set() else 0
+
+    def collect(self):
+        """Sample local and ESP32 metrics every sample_interval_seconds, without drift."""
+        period = self.client.sample_interval_seconds
+        next_sample = time.monotonic()
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            lag = started - next_sample
+            try:
+                snapshots = []
+                localsnapshot = self.localMonitor.monitorSystemUsage()
+                if localsnapshot == 1:
+                    self.logger.error("System reading failed")
+                    self.fail()
+                    return
+                localsnapshot.device_name = self.name
+                if localsnapshot.metrics:
+                    snapshots.append(localsnapshot)
+                esp32_snapshots = self.remoteMonitor.processEsp32Metrics()
+                if esp32_snapshots:
+                    snapshots.extend(esp32_snapshots)
+                if self.windows:
+                    breaches = self.windows.add(snapshots)
+                    if breaches:
+                        self.push(breaches, urgent=True)
+                    snapshots = self.windows.flush()
+                if self.changes:
+                    snapshots = self.changes.filter(snapshots)
+                self.push(snapshots)
+            except Exception as e:
+                self.logger.exception("Collector failed: %s", e)
+            finished = time.monotonic()
+            with self.stats_lock:
+                self.timers['sample_lag'].record(max(lag, 0.0))
+                self.timers['collect'].record(finished - started)
+
+            next_sample += period
+            if next_sample < finished:
+                # Overran one or more periods, skip them rather than bursting to catch up
+                next_sample = finished + period - (finished - next_sample) % period
+            self.stopping.wait(next_sample - finished)
+
+    def push(self, snapshots, urgent: bool = False):
+        if not snapshots:
+            return
+        now = time.monotonic()
+        with self.buffer_ready:
+            for snapshot in snapshots:
+                if len(self.buffer) == self.buffer.maxlen:
+                    # deque(maxlen) drops the oldest entry on append
+                    with self.stats_lock:
+                        self.dropped += 1
+                self.buffer.append((now, snapshot))
+            if urgent:
+                self.urgent = True
+            if urgent or len(self.buffer) >= self.client.upload_batch_size:
+                self.buffer_ready.notify()
+
+    def take_batch(self):
+        """Wait until a batch is due (by count, by age or an urgent push) and remove it from the buffer."""
+        with self.buffer_ready:
+            while not self.stopping.is_set():
+                if self.urgent or len(self.buffer) >= self.client.upload_batch_size:
+                    break
+                if self.buffer:
+                    age = time.monotonic() - self.buffer[0][0]
+                    if age >= self.client.upload_max_age_seconds:
+                        break
+                    self.buffer_ready.wait(self.client.upload_max_age_seconds - age)
+                else:
+                    self.buffer_ready.wait(self.client.upload_max_age_seconds)
+            self.urgent = False
+            count = min(len(self.buffer), self.client.upload_batch_size)
+            return [self.buffer.popleft() for _ in range(count)]
+
+    def upload(self):
+        while not self.stopping.is_set():
+            batch = self.take_batch()
+            if not batch:
+                continue
+            started = time.monotonic()
+            try:
+                self.aggregator.addSnapshotsToAggregator((snapshot for _, snapshot in batch), self.name)
+                aggregatedDevices = self.aggregator.drain(self.agg_id, self.name)
+                if self.changes:
+                    aggregatedDevices.heartbeat_seconds = self.client.change_heartbeat_seconds
+                self.logger.debug("Aggregated devices: %s", aggregatedDevices)
+
+                request = self.metricsSDK.uploadMetrics(aggregatedDevices)
+                if len(request) > 0:
+                    self.logger.info(request)
+                    for device in request:
+                        if device == self.name:
+                            self.logger.critical("Simulating system reboot...")
+                        else:
+                            self.remoteMonitor.respondCriticalToEsp32(device)
+            except Exception as e:
+                self.logger.exception("Uploader failed: %s", e)
+            finished = time.monotonic()
+            with self.stats_lock:
+                self.timers['upload'].record(finished - started)
+                for enqueued, _ in batch:
+                    self.timers['buffer_age'].record(finished - enqueued)
+
+    def fail(self):
+        self.failed.set()
+        self.stopping.set()
+        with self.buffer_ready:
+            self.buffer_ready.notify_all()
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            stats = {name: timer.to_dict() for name, timer in self.timers.items()}
+            stats['dropped'] = self.dropped
+        stats['buffered'] = len(self.buffer)
+        stats['spool'] = self.metricsSDK.snapshot_queue.stats()
+        stats['collectors'] = self.localMonitor.stats()
+        stats['esp32'] = self.remoteMonitor.stats()
+        if self.windows:
+            stats['window'] = self.windows.stats()
+        if self.changes:
+            stats['change_detection'] = self.changes.stats()
+        return stats
@@ -1,20 +1,54 @@
+from collections import deque
 from datetime import datetime
-import json
 import socket
 import threading
 
 from lib_config.config import Config
+from esp32Gateway import esp32Gateway
+from frameDecoder import frameDecoder
+from deviceQueues import deviceQueues
+from esp32Payload import parsePayload, payloadMetrics
+from shardedGateway import shardedGateway
+from wireFormat import unpackAggregator
 from systemMetrics import DTO_DataSnapshot, DTO_Metric
 
 class remoteMonitor:
-    def __init__(self, logger):
-        self.config = Config(__file__, run_type="client")
+    def __init__(self, logger, config=None, reuse_port=False):
+        self.config = config or Config(__file__, run_type="client")
         self.logger = logger
-        self.esp32_metrics = {}
+        # Bounded per-device queues, written by the connection handlers and drained by the collector
+        self.esp32_metrics = deviceQueues(self.config.client.gateway_device_queue_size)
         self.device_connections = {}
-
-        # Start the ESP32 socket server in a separate thread
-        threading.Thread(target=self.startEsp32SocketServer, daemon=True).start()
+        # Guards device_connections
+        self.lock = threading.Lock()
+        self.gateway = None
+        self.shards = None
+        # Packed batches from the gateway workers, oldest dropped beyond gateway_device_queue_size
+        self.shard_batches = deque(maxlen=self.config.client.gateway_device_queue_size)
+        self.dropped_batches = 0
+
+        mode = self.config.client.gateway_mode
+        if mode == "processes" and not hasattr(socket, "SO_REUSEPORT"):
+            self.logger.warning("SO_REUSEPORT is not available on this platform, serving ESP32 connections in this process")
+            mode = "asyncio"
+        if mode == "processes":
+            # Connections spread over worker processes, which forward converted batches
+            self.shards = shardedGateway(self.config.client, self.recordShardBatch, self.recordEsp32Connection, self.forgetEsp32Connection, self.logger)
+            self.shards.start()
+        elif mode == "asyncio":
+            # All device connections on one event loop thread
+            self.gateway = esp32Gateway(
+                self.config.client.socket_host, self.config.client.socket_port,
+                self.recordEsp32Metrics, self.forgetEsp32Connection,
+                backlog=self.config.client.gateway_backlog,
+                max_frame_bytes=self.config.client.gateway_max_frame_bytes,
+                reuse_port=reuse_port,
+                logger=self.logger
+            )
+            self.gateway.start()
+        else:
+            # Start the ESP32 socket server in a separate thread
+            threading.Thread(target=self.startEsp32SocketServer, daemon=True).start()
 
     def startEsp32SocketServer(self):
         """Start a raw socket server to listen for ESP32 metrics."""
@@ -22,7 +56,7 @@ class remoteMonitor:
         try:
             server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_sock.bind((self.config.client.socket_host, self.config.client.socket_port))
-            server_sock.listen(5)
+            server_sock.listen(self.config.client.gateway_backlog)
             while True:
                 conn, addr = server_sock.accept()
                 threading.Thread(target=self.handleEsp32Connection, args=(conn, addr)).start()
@@ -34,63 +68,72 @@ class remoteMonitor:
         """Handle an incoming connection from ESP32."""
         self.logger.info(f"Connection established with ESP32 at {addr}")
         connected_device = None
+        decoder = frameDecoder(self.config.client.gateway_max_frame_bytes)
         try:
             while True:  # Keep the connection open
-                data = conn.recv(1024)  # Receive raw binary data
-                if not data:  # Connection closed by the client
-                    self.logger.info(f"Connection closed by ESP32 at {addr}")
+                if not decoder.recvFrom(conn):  # Connection closed by the client
+                    if len(decoder):
+                        self.logger.warning(f"Connection closed by ESP32 at {addr} mid-frame")
+                    else:
+                        self.logger.info(f"Connection closed by ESP32 at {addr}")
                     break
 
-                self.logger.debug(f"Raw data received: {data}")
-
-                # Parse the custom protocol
-                metrics, device_name = self.parseCustomProtocol(data)
-                with threading.Lock():
-                    if device_name not in self.esp32_metrics:
-                        self.device_connections[device_name] = conn
-                        connected_device = device_name
-                        self.esp32_metrics[device_name] = []
-                    self.esp32_metrics[device_name].append(metrics)
-                self.logger.info(f"Device name: {device_name}, Metrics: {metrics}")
+                # A read may hold part of a frame or several frames
+                acks = 0
+                for device_name, payload in decoder.frames():
+                    self.recordEsp32Metrics(device_name, parsePayload(payload), conn)
+                    connected_device = device_name
+                    acks += 1
 
-                conn.sendall(b"Metrics received")  # Acknowledge
+                if acks:
+                    conn.sendall(b"Metrics received" * acks)  # Acknowledge each frame
         except Exception as e:
             self.logger.error(f"Error handling ESP32 connection: {e}")
         finally:
             if connected_device:
-                self.device_connections.pop(connected_device, None)  # Remove the connection
+                self.forgetEsp32Connection(connected_device, conn)  # Remove the connection
             conn.close()
 
-
+    def recordEsp32Metrics(self, device_name, metrics, conn):
+        """Queue a device's metrics for the next processEsp32Metrics, and remember the connection to reach it on."""
+        if self.device_connections.get(device_name) is not conn:
+            self.recordEsp32Connection(device_name, conn)
+        self.esp32_metrics.put(device_name, metrics)
+        self.logger.debug("Device name: %s, Metrics: %s", device_name, metrics)
+
+    def recordEsp32Connection(self, device_name, conn):
+        with self.lock:
+            self.device_connections[device_name] = conn
+
+    def forgetEsp32Connection(self, device_name, conn):
+        with self.lock:
+            # The device may already have reconnected on another connection
+            if self.device_connections.get(device_name) is conn:
+                del self.device_connections[device_name]
+
+    def recordShardBatch(self, payload):
+        """Queue a packed batch from a gateway worker for the next processEsp32Metrics."""
+        if len(self.shard_batches) == self.shard_batches.maxlen:
+            self.dropped_batches += 1
+        self.shard_batches.append(payload)
 
     def parseCustomProtocol(self, data):
         """
-        Parse the custom protocol received from ESP32.
+        Parse one complete message of the custom protocol received from ESP32. Streams are
+        decoded with frameDecoder, which handles partial and coalesced messages.
 
         Protocol structure:
         - 4 bytes: Length of the metrics payload (big-endian integer)
         - Null-terminated string: Device name
-        - Remaining bytes: Metrics payload (JSON string)
+        - Remaining bytes: Metrics payload (JSON string, or the binary layout in esp32Payload.py)
         """
         try:
-            # Extract the length of the metrics payload
-            metrics_length = int.from_bytes(data[:4], byteorder='big')
-            self.logger.debug(f"Metrics length: {metrics_length}")
-
-            # Find the null-terminated device name
-            null_terminator_index = data.find(b'\x00', 4)
-            if null_terminator_index == -1:
-                raise ValueError("Invalid protocol: Missing null terminator for device name")
-            
-            # Extract the device name
-            device_name = data[4:null_terminator_index].decode()
-            self.logger.debug(f"Device name: {device_name}")
-
-            # Extract the metrics payload
-            metrics_start_index = null_terminator_index + 1
-            metrics_payload = data[metrics_start_index:metrics_start_index + metrics_length].decode()
-            metrics = json.loads(metrics_payload)  # Parse the JSON metrics
-            return metrics, device_name
+            decoder = frameDecoder(self.config.client.gateway_max_frame_bytes)
+            decoder.feed(data)
+            for device_name, payload in decoder.frames():
+                self.logger.debug(f"Device name: {device_name}")
+                return parsePayload(payload), device_name
+            raise ValueError("Invalid protocol: Incomplete frame")
         except Exception as e:
             self.logger.error(f"Error parsing custom protocol: {e}")
             raise
@@ -100,13 +143,32 @@ class remoteMonitor:
         try:
             snapshots = []  # List to hold snapshots for all devices
 
-            # Iterate over each device in the metrics dictionary
-            with threading.Lock():  # Ensure thread-safe access to self.esp32_metrics
-                for device_name, metrics_list in self.esp32_metrics.items():
-                    device_metrics = []  # Collect metrics for the current device
-
-                    while metrics_list:
-                        raw_metric = metrics_list.pop(0)  # Get and remove the oldest metric
+            # Batches from gateway workers are already converted and grouped per device. Only the
+            # devices are used, their platform uuid and name are the client's own.
+            while self.shard_batches:
+                try:
+                    devices = unpackAggregator(self.shard_batches.popleft()).devices
+                except ValueError as e:
+                    # Skip only the malformed batch, the ones already taken this tick are kept
+                    self.logger.error(f"Dropping malformed batch from an ESP32 gateway worker: {e}")
+                    continue
+                for device in devices:
+                    for snapshot in device.data_snapshots:
+                        snapshot.device_name = device.name
+                        snapshots.append(snapshot)
+
+            # Take the queued metrics, converting them happens outside the queues' lock
+            pending = self.esp32_metrics.drain()
+
+            # Iterate over each device with queued metrics
+            for device_name, metrics_list in pending.items():
+                for raw_metric in metrics_list:  # Oldest first
+                    if isinstance(raw_metric, (bytes, bytearray)):
+                        # Binary payload, unpacked in one pass
+                        metric_time, device_metrics = payloadMetrics(raw_metric)
+                        metric_time = metric_time or datetime.now().isoformat()
+                    else:
+                        device_metrics = []  # Collect the metrics of this message
                         metric_time = datetime.now().isoformat()
                         for key, value in raw_metric.items():
                             if key == "timestamp":
@@ -117,14 +179,14 @@ class remoteMonitor:
                                 else:
                                     device_metrics.append(DTO_Metric(name=key, value=float(value.get("value"))))
 
-                        if device_metrics:
-                            snapshot = DTO_DataSnapshot(
-                                metrics=device_metrics,
-                                timestamp_utc=metric_time,
-                                device_name=device_name 
-                            )
-                            self.logger.info(f"Created ESP32 snapshot for device {device_name}: {snapshot}")
-                            snapshots.append(snapshot)
+                    if device_metrics:
+                        snapshot = DTO_DataSnapshot(
+                            metrics=device_metrics,
+                            timestamp_utc=metric_time,
+                            device_name=device_name 
+                        )
+                        self.logger.debug("Created ESP32 snapshot for device %s: %s", device_name, snapshot)
+                        snapshots.append(snapshot)
 
             return snapshots if snapshots else None  # Return the list of snapshots or None if empty
         except Exception as e:
@@ -134,12 +196,12 @@ class remoteMonitor:
     def respondCriticalToEsp32(self, device_name):
         """Send a reboot message to the specified ESP32 device."""
         try:
-            # Check if the device connection exists
-            if device_name not in self.device_connections:
+            # Check if the device connection exists, it may close at any time
+            with self.lock:
+                conn = self.device_connections.get(device_name)
+            if conn is None:
                 self.logger.error(f"No active connection for device {device_name}")
                 return
-            
-            conn = self.device_connections[device_name]
 
             # Send the reboot command
             conn.sendall(b"REBOOT")
@@ -147,3 +209,20 @@ class remoteMonitor:
         except Exception as e:
             self.logger.error(f"Failed to send reboot command to {device_name}: {e}")
 
+    def stop(self):
+        """Stop the gateway workers or the asyncio gateway. The threaded socket server runs until exit."""
+        if self.shards:
+            self.shards.stop()
+        if self.gateway:
+            self.gateway.stop()
+
+    def stats(self) -> dict:
+        stats = self.esp32_metrics.stats()
+        with self.lock:
+            stats['connected'] = len(self.device_connections)
+        if self.gateway:
+            stats['gateway'] = self.gateway.stats()
+        if self.shards:
+            stats['workers'] = self.shards.stats()
+            stats['dropped_batches'] = self.dropped_batches
+        return stats
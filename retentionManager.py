@@ -0,0 +1,185 @@
+"""
+Library module for the retention and compaction of stored metrics.
+Expired raw values, the snapshots left without values and expired rollup buckets are deleted in
+bounded chunks, each in its own short transaction, and freed pages are returned to the file
+system with an incremental vacuum. A database created before incremental auto_vacuum has to be
+converted once with convertAutoVacuum, which the retention runs never do.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, UTC
+from sqlalchemy import text
+from lib_config.config import RetentionConfig
+from models import ROLLUP_MODELS
+
+SECONDS_PER_DAY = 86400
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def convertAutoVacuum(engine, logger=None) -> bool:
+    """
+    Switch an existing database to incremental auto_vacuum. Returns False if it already was.
+    auto_vacuum only changes through a full VACUUM, which rewrites the file and holds an exclusive
+    lock on it throughout, so this is run on its own as a one-off rather than by the retention runs.
+    """
+    logger = logger or logging.getLogger()
+    with engine.connect() as connection:
+        if connection.execute(text('PRAGMA auto_vacuum')).scalar() == AUTO_VACUUM_INCREMENTAL:
+            return False
+        logger.warning("Converting database to incremental auto_vacuum with a full VACUUM, writes are blocked until it finishes")
+        start = time.perf_counter()
+        connection.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+        connection.exec_driver_sql('VACUUM')
+        logger.info("Converted database to incremental auto_vacuum in %.1fs", time.perf_counter() - start)
+    return True
+
+
+class retentionManager:
+    def __init__(self, engine, config: RetentionConfig, logger=None):
+        self.engine = engine
+        self.config = config
+        self.logger = logger or logging.getLogger()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.last_report = None
+        self.report_lock = threading.Lock()
+
+    def start(self):
+        """Run the retention policy every interval_seconds on a background thread."""
+        self.thread = threading.Thread(target=self.loop, name="retention", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+    def loop(self):
+        while not self.stopping.is_set():
+            try:
+                self.runOnce()
+            except Exception as e:
+                self.logger.exception("Retention run failed: %s", e)
+            self.stopping.wait(self.config.interval_seconds)
+
+    def runOnce(self) -> dict:
+        """Apply the retention policy once and return a report of what was purged."""
+        start = time.perf_counter()
+        now_epoch = int(datetime.now(UTC).timestamp())
+        report = {
+            'started_utc_epoch': now_epoch,
+            'values_purged': 0,
+            'snapshots_purged': 0,
+            'rollups_purged': {},
+            'bytes_reclaimed': 0,
+            'seconds': 0.0
+        }
+        size_before = self.databaseSize()
+
+        latest_cutoff = None
+        for cutoff, metric_type_ids, exclude in self.rawCutoffs(now_epoch):
+            report['values_purged'] += self.purgeValues(cutoff, metric_type_ids, exclude)
+            latest_cutoff = cutoff if latest_cutoff is None else max(latest_cutoff, cutoff)
+        if latest_cutoff is not None:
+            report['snapshots_purged'] = self.purgeEmptySnapshots(latest_cutoff)
+
+        for model in ROLLUP_MODELS:
+            days = self.config.rollup_retention_days.get(model.resolution)
+            if days is not None:
+                report['rollups_purged'][model.resolution] = self.purgeRollups(model, now_epoch - int(days * SECONDS_PER_DAY))
+
+        self.vacuum()
+        report['bytes_reclaimed'] = max(size_before - self.databaseSize(), 0)
+        report['seconds'] = time.perf_counter() - start
+        self.logger.info("Retention run: %s", report)
+        with self.report_lock:
+            self.last_report = report
+        return report
+
+    def rawCutoffs(self, now_epoch: int):
+        """
+        Yield (cutoff_epoch, metric_type_ids, exclude) groups. When exclude is True the group
+        covers every metric type except the listed ones.
+        """
+        overrides = {}
+        if self.config.metric_raw_retention_days:
+            with self.engine.connect() as connection:
+                rows = connection.execute(text('SELECT metric_type_id, metric_type FROM metric_types')).all()
+            for metric_type_id, metric_type in rows:
+                if metric_type in self.config.metric_raw_retention_days:
+                    overrides[metric_type_id] = self.config.metric_raw_retention_days[metric_type]
+
+        by_days = {}
+        for metric_type_id, days in overrides.items():
+            by_days.setdefault(days, []).append(metric_type_id)
+        for days, metric_type_ids in by_days.items():
+            if days is not None:
+                yield now_epoch - int(days * SECONDS_PER_DAY), metric_type_ids, False
+        if self.config.raw_retention_days is not None:
+            yield now_epoch - int(self.config.raw_retention_days * SECONDS_PER_DAY), list(overrides), True
+
+    def purgeValues(self, cutoff_epoch: int, metric_type_ids, exclude: bool) -> int:
+        if not metric_type_ids and not exclude:
+            return 0
+        type_filter = ''
+        if metric_type_ids:
+            operator = 'NOT IN' if exclude else 'IN'
+            type_filter = f"AND v.metric_type_id {operator} ({', '.join(str(int(i)) for i in metric_type_ids)})"
+        return self.deleteInChunks(
+            'DELETE FROM metric_values WHERE metric_id IN ('
+            '  SELECT v.metric_id FROM system_metric_snapshots s'
+            '  JOIN metric_values v ON v.metric_snapshot_id = s.metric_snapshot_id'
+            f' WHERE s.server_utc_timestamp_epoch < :cutoff {type_filter} LIMIT :chunk'
+            ')',
+            cutoff_epoch
+        )
+
+    def purgeEmptySnapshots(self, cutoff_epoch: int) -> int:
+        return self.deleteInChunks(
+            'DELETE FROM system_metric_snapshots WHERE metric_snapshot_id IN ('
+            '  SELECT s.metric_snapshot_id FROM system_metric_snapshots s'
+            '  WHERE s.server_utc_timestamp_epoch < :cutoff'
+            '  AND NOT EXISTS (SELECT 1 FROM metric_values v WHERE v.metric_snapshot_id = s.metric_snapshot_id)'
+            '  LIMIT :chunk'
+            ')',
+            cutoff_epoch
+        )
+
+    def purgeRollups(self, model, cutoff_epoch: int) -> int:
+        return self.deleteInChunks(
+            f'DELETE FROM {model.__tablename__} WHERE rowid IN ('
+            f'  SELECT rowid FROM {model.__tablename__} WHERE bucket_start_epoch < :cutoff LIMIT :chunk'
+            ')',
+            cutoff_epoch
+        )
+
+    def deleteInChunks(self, statement: str, cutoff_epoch: int) -> int:
+        """Repeat a chunked delete, one short transaction per chunk, until nothing is left."""
+        deleted = 0
+        while not self.stopping.is_set():
+            with self.engine.begin() as connection:
+                result = connection.execute(text(statement), {'cutoff': cutoff_epoch, 'chunk': self.config.chunk_size})
+            deleted += result.rowcount
+            if result.rowcount < self.config.chunk_size:
+                break
+        return deleted
+
+    def vacuum(self):
+        with self.engine.connect() as connection:
+            if connection.execute(text('PRAGMA auto_vacuum')).scalar() != AUTO_VACUUM_INCREMENTAL:
+                self.logger.warning("Database is not in incremental auto_vacuum mode, free pages are not reclaimed until it is converted with --convert-auto-vacuum")
+                return
+            # sqlite3 steps a plain execute once, which frees a single page, executescript runs it to completion
+            connection.connection.driver_connection.executescript(f'PRAGMA incremental_vacuum({int(self.config.vacuum_pages)});')
+
+    def databaseSize(self) -> int:
+        with self.engine.connect() as connection:
+            page_count = connection.execute(text('PRAGMA page_count')).scalar()
+            page_size = connection.execute(text('PRAGMA page_size')).scalar()
+        return page_count * page_size
+
+    def report(self):
+        with self.report_lock:
+            return self.last_report
@@ -0,0 +1,104 @@
+"""
+Library module for the downsampled rollup tables (1 minute, 1 hour and 1 day buckets).
+Rollups are updated in the same transaction as the raw metric values they summarise, and wide
+time range reads are served from the coarsest table that still gives enough points.
+"""
+
+import logging
+from sqlalchemy import case, func, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from models import ROLLUP_MODELS, SystemMetricValue
+
+# Ranges up to this span are read from the raw metric_values table
+RAW_MAX_SPAN_SECONDS = 3600
+# Upper bound on points per series when choosing a rollup resolution
+MAX_POINTS_PER_SERIES = 500
+
+
+def updateRollups(session: Session, server_epoch: int, values):
+    """
+    Fold (metric_type_id, metric_value) pairs recorded at server_epoch into every rollup table.
+    Values are pre-aggregated per metric type so each table gets one upsert row per series.
+    """
+    accumulators = {}
+    for metric_type_id, value in values:
+        accumulator = accumulators.get(metric_type_id)
+        if accumulator is None:
+            accumulators[metric_type_id] = [value, value, value, 1, value]
+        else:
+            accumulator[0] = min(accumulator[0], value)
+            accumulator[1] = max(accumulator[1], value)
+            accumulator[2] += value
+            accumulator[3] += 1
+            accumulator[4] = value
+    if not accumulators:
+        return
+
+    for model in ROLLUP_MODELS:
+        bucket_start = server_epoch - server_epoch % model.bucket_seconds
+        rows = [{
+            'metric_type_id': metric_type_id,
+            'bucket_start_epoch': bucket_start,
+            'min_value': minimum,
+            'max_value': maximum,
+            'sum_value': total,
+            'value_count': count,
+            'last_value': last,
+            'last_epoch': server_epoch
+        } for metric_type_id, (minimum, maximum, total, count, last) in accumulators.items()]
+        statement = sqlite_insert(model)
+        statement = statement.on_conflict_do_update(
+            index_elements=[model.metric_type_id, model.bucket_start_epoch],
+            set_={
+                'min_value': func.min(model.min_value, statement.excluded.min_value),
+                'max_value': func.max(model.max_value, statement.excluded.max_value),
+                'sum_value': model.sum_value + statement.excluded.sum_value,
+                'value_count': model.value_count + statement.excluded.value_count,
+                'last_value': case(
+                    (statement.excluded.last_epoch >= model.last_epoch, statement.excluded.last_value),
+                    else_=model.last_value
+                ),
+                'last_epoch': func.max(model.last_epoch, statement.excluded.last_epoch)
+            }
+        )
+        session.execute(statement, rows)
+
+
+def backfillRollups(engine, logger=None):
+    """Populate empty rollup tables from the raw values, for databases created before rollups existed."""
+    logger = logger or logging.getLogger()
+    with engine.begin() as connection:
+        if connection.execute(select(SystemMetricValue.metric_id).limit(1)).first() is None:
+            return
+        for model in ROLLUP_MODELS:
+            if connection.execute(select(model.metric_type_id).limit(1)).first() is not None:
+                continue
+            seconds = model.bucket_seconds
+            connection.execute(text(
+                f'INSERT INTO {model.__tablename__} '
+                '(metric_type_id, bucket_start_epoch, min_value, max_value, sum_value, value_count, last_value, last_epoch) '
+                'SELECT metric_type_id, bucket, MIN(metric_value), MAX(metric_value), SUM(metric_value), COUNT(*), '
+                '       MAX(CASE WHEN position = 1 THEN metric_value END), MAX(epoch) '
+                'FROM ('
+                '  SELECT v.metric_type_id, v.metric_value, s.server_utc_timestamp_epoch AS epoch, '
+                f'        s.server_utc_timestamp_epoch - s.server_utc_timestamp_epoch % {seconds} AS bucket, '
+                '         ROW_NUMBER() OVER ('
+                f'          PARTITION BY v.metric_type_id, s.server_utc_timestamp_epoch - s.server_utc_timestamp_epoch % {seconds} '
+                '           ORDER BY s.server_utc_timestamp_epoch DESC, v.metric_id DESC'
+                '         ) AS position '
+                '  FROM metric_values v JOIN system_metric_snapshots s ON v.metric_snapshot_id = s.metric_snapshot_id'
+                ') GROUP BY metric_type_id, bucket'
+            ))
+            logger.info("Backfilled rollup table %s", model.__tablename__)
+
+
+def chooseRollup(start_epoch: int, end_epoch: int, max_points: int = MAX_POINTS_PER_SERIES):
+    """Return the rollup model to read for the range, or None to read raw values."""
+    span = end_epoch - start_epoch
+    if span <= RAW_MAX_SPAN_SECONDS:
+        return None
+    for model in ROLLUP_MODELS:
+        if span / model.bucket_seconds <= max_points:
+            return model
+    return ROLLUP_MODELS[-1]
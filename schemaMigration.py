@@ -0,0 +1,72 @@
+"""
+Library module for bringing an existing metrics database up to the schema declared in models.py.
+create_all only creates missing tables, so this adds missing nullable columns, merges rows that
+would violate the natural key unique indexes and then creates any missing indexes.
+"""
+
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+from models import Base
+
+# (table, natural key columns, primary key, [(referencing table, referencing column)])
+# Ordered so that merging parents first exposes any duplicates it creates in the children.
+NATURAL_KEYS = [
+    ('aggregators', ['guid'], 'aggregator_id', [('devices', 'aggregator_id')]),
+    ('devices', ['aggregator_id', 'name'], 'device_id', [('metric_types', 'device_id'), ('system_metric_snapshots', 'device_id')]),
+    ('metric_types', ['device_id', 'metric_type'], 'metric_type_id', [('metric_values', 'metric_type_id')]),
+]
+
+
+def migrateSchema(engine, logger=None):
+    """Migrate the database behind engine in place. Safe to run on every start up."""
+    logger = logger or logging.getLogger()
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            addMissingColumns(connection, inspector, table, logger)
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            if any(index.unique and index.name not in existing_indexes for index in table.indexes):
+                mergeDuplicates(connection, table.name, logger)
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    connection.execute(CreateIndex(index))
+                    logger.info("Created index %s on %s", index.name, table.name)
+
+
+def addMissingColumns(connection, inspector, table, logger):
+    existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+        if column.name in existing_columns:
+            continue
+        if not column.nullable:
+            raise RuntimeError(f"Cannot add non-nullable column {table.name}.{column.name} to an existing table")
+        column_type = column.type.compile(dialect=connection.dialect)
+        connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        logger.info("Added column %s.%s", table.name, column.name)
+
+
+def mergeDuplicates(connection, table_name, logger):
+    """Point references at the lowest id of each natural key in table_name and delete the rest."""
+    for name, key_columns, primary_key, references in NATURAL_KEYS:
+        if name != table_name:
+            continue
+        key = ', '.join(key_columns)
+        duplicates = connection.execute(text(
+            f'SELECT {primary_key}, keep_id FROM ('
+            f'  SELECT {primary_key}, MIN({primary_key}) OVER (PARTITION BY {key}) AS keep_id FROM {table_name}'
+            f') WHERE {primary_key} != keep_id'
+        )).all()
+        if not duplicates:
+            return
+        for duplicate_id, keep_id in duplicates:
+            for referencing_table, referencing_column in references:
+                connection.execute(
+                    text(f'UPDATE {referencing_table} SET {referencing_column} = :keep_id WHERE {referencing_column} = :duplicate_id'),
+                    {'keep_id': keep_id, 'duplicate_id': duplicate_id}
+                )
+            connection.execute(text(f'DELETE FROM {table_name} WHERE {primary_key} = :duplicate_id'), {'duplicate_id': duplicate_id})
+        logger.warning("Merged %s duplicate rows in %s", len(duplicates), table_name)
@@ -0,0 +1,209 @@
+"""
+Library module for reading metric series over a time range.
+Every read is a single set-based query over either the raw metric values or a rollup table and
+returns parallel epoch/value lists per metric type, without constructing ORM objects per row.
+Series reported on change (see MetricType.metric_heartbeat_seconds) have their last value carried
+forward into the range and across empty buckets, for up to one heartbeat.
+"""
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from models import ROLLUP_MODELS, Device, MetricType, SystemMetricSnapshot, SystemMetricValue
+from rollupManager import MAX_POINTS_PER_SERIES, chooseRollup
+
+AGGREGATIONS = ('avg', 'min', 'max', 'sum', 'count', 'last')
+
+
+def resolveSeries(session: Session, keys):
+    """Return {(device_name, metric_type): metric_type_id} for the stored (device_name, metric_type) keys."""
+    keys = set(keys)
+    if not keys:
+        return {}
+    # A row value IN list cannot use an index, so match names and metric types separately and pair them up here
+    rows = session.execute(
+        select(Device.name, MetricType.metric_type, MetricType.metric_type_id)
+        .join(MetricType, MetricType.device_id == Device.device_id)
+        .where(Device.name.in_({name for name, _ in keys}), MetricType.metric_type.in_({metric_type for _, metric_type in keys}))
+        .order_by(MetricType.metric_type_id)
+    ).all()
+    found = {}
+    for device_name, metric_type, metric_type_id in rows:
+        if (device_name, metric_type) in keys:
+            found.setdefault((device_name, metric_type), metric_type_id)
+    return found
+
+
+def loadHeartbeats(session: Session, metric_type_ids) -> dict:
+    """Return {metric_type_id: heartbeat_seconds} for the metric types reported on change."""
+    metric_type_ids = list(metric_type_ids)
+    if not metric_type_ids:
+        return {}
+    return dict(session.execute(
+        select(MetricType.metric_type_id, MetricType.metric_heartbeat_seconds)
+        .where(MetricType.metric_type_id.in_(metric_type_ids), MetricType.metric_heartbeat_seconds.is_not(None))
+    ).all())
+
+
+def valuesBefore(session: Session, heartbeats: dict, start_epoch: int) -> dict:
+    """Return {metric_type_id: (epoch, value)} for the last raw value within a heartbeat before start_epoch."""
+    if not heartbeats:
+        return {}
+    epoch = SystemMetricSnapshot.server_utc_timestamp_epoch
+    rows = session.execute(
+        # SQLite takes the bare value column from the row that satisfies the lone max()
+        select(SystemMetricValue.metric_type_id, func.max(epoch), SystemMetricValue.metric_value)
+        .join(SystemMetricSnapshot, SystemMetricValue.metric_snapshot_id == SystemMetricSnapshot.metric_snapshot_id)
+        .where(
+            SystemMetricValue.metric_type_id.in_(heartbeats.keys()),
+            epoch < start_epoch,
+            epoch >= start_epoch - max(heartbeats.values())
+        )
+        .group_by(SystemMetricValue.metric_type_id)
+    ).all()
+    return {
+        metric_type_id: (last_epoch, value) for metric_type_id, last_epoch, value in rows
+        if last_epoch >= start_epoch - heartbeats[metric_type_id]
+    }
+
+
+def carryForward(series, heartbeats: dict, carried: dict, start_epoch: int, end_epoch: int):
+    """
+    Bound each change-reported series with carried values: the value in effect at start_epoch
+    and the last value at the earlier of end_epoch and one heartbeat after it was stored.
+    """
+    for metric_type_id, heartbeat in heartbeats.items():
+        epochs, values = series[metric_type_id]
+        if metric_type_id in carried and (not epochs or epochs[0] > start_epoch):
+            epochs.insert(0, start_epoch)
+            values.insert(0, carried[metric_type_id][1])
+        if epochs:
+            held_until = min(end_epoch, epochs[-1] + heartbeat)
+            if held_until > epochs[-1]:
+                epochs.append(held_until)
+                values.append(values[-1])
+
+
+def fillBuckets(series, heartbeats: dict, carried: dict, start_epoch: int, end_epoch: int, step: int):
+    """Fill empty buckets of each change-reported series with the previous value, for up to one heartbeat."""
+    first_bucket = start_epoch - start_epoch % step
+    for metric_type_id, heartbeat in heartbeats.items():
+        epochs, values = series[metric_type_id]
+        # Each stored bucket, and a value carried in from before the range, holds until the next one
+        anchors = list(zip(epochs, values))
+        if metric_type_id in carried and (not epochs or epochs[0] > first_bucket):
+            carried_epoch, carried_value = carried[metric_type_id]
+            anchors.insert(0, (carried_epoch, carried_value))
+        filled_epochs, filled_values = [], []
+        for index, (epoch, value) in enumerate(anchors):
+            until = min(epoch + heartbeat, end_epoch, anchors[index + 1][0] - 1 if index + 1 < len(anchors) else end_epoch)
+            for bucket in range(max(epoch - epoch % step, first_bucket), until + 1, step):
+                filled_epochs.append(bucket)
+                filled_values.append(value)
+        series[metric_type_id] = (filled_epochs, filled_values)
+
+
+def querySeries(session: Session, metric_type_ids, start_epoch: int, end_epoch: int, max_points: int = MAX_POINTS_PER_SERIES, heartbeats: dict = None):
+    """
+    Read the series of each metric type between start_epoch and end_epoch (inclusive).
+    Returns ({metric_type_id: ([epochs], [values])}, source) where source is 'raw' or the rollup
+    resolution used. Rollup points are bucket averages.
+    """
+    series = {metric_type_id: ([], []) for metric_type_id in metric_type_ids}
+    model = chooseRollup(start_epoch, end_epoch, max_points)
+    if not series:
+        return series, model.resolution if model else 'raw'
+    if model is None:
+        query = (
+            select(SystemMetricValue.metric_type_id, SystemMetricSnapshot.server_utc_timestamp_epoch, SystemMetricValue.metric_value)
+            .join(SystemMetricSnapshot, SystemMetricValue.metric_snapshot_id == SystemMetricSnapshot.metric_snapshot_id)
+            .where(
+                SystemMetricValue.metric_type_id.in_(series.keys()),
+                SystemMetricSnapshot.server_utc_timestamp_epoch.between(start_epoch, end_epoch)
+            )
+            .order_by(SystemMetricSnapshot.server_utc_timestamp_epoch, SystemMetricValue.metric_id)
+        )
+    else:
+        query = (
+            select(model.metric_type_id, model.bucket_start_epoch, model.sum_value / model.value_count)
+            .where(
+                model.metric_type_id.in_(series.keys()),
+                model.bucket_start_epoch.between(start_epoch - start_epoch % model.bucket_seconds, end_epoch)
+            )
+            .order_by(model.bucket_start_epoch)
+        )
+    appendRows(series, session.execute(query))
+    if heartbeats is None:
+        heartbeats = loadHeartbeats(session, series.keys())
+    carryForward(series, heartbeats, valuesBefore(session, heartbeats, start_epoch), start_epoch, end_epoch)
+    return series, model.resolution if model else 'raw'
+
+
+def queryAggregatedSeries(session: Session, metric_type_ids, start_epoch: int, end_epoch: int, step: int, aggregation: str = 'avg', heartbeats: dict = None):
+    """
+    Read each series aggregated into step second buckets aligned to the epoch.
+    The coarsest rollup whose bucket divides step is used, raw values otherwise.
+    Returns ({metric_type_id: ([bucket epochs], [values])}, source). For change-reported series
+    empty buckets are filled, except for count and sum which only cover the reported values.
+    """
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {aggregation}, expected one of {', '.join(AGGREGATIONS)}")
+    series = {metric_type_id: ([], []) for metric_type_id in metric_type_ids}
+    model = None
+    for candidate in ROLLUP_MODELS:
+        if step % candidate.bucket_seconds == 0:
+            model = candidate
+    source = model.resolution if model else 'raw'
+    if not series:
+        return series, source
+
+    if model is None:
+        epoch = SystemMetricSnapshot.server_utc_timestamp_epoch
+        bucket = (epoch - epoch % step).label('bucket')
+        value = SystemMetricValue.metric_value
+        aggregates = {
+            'avg': func.avg(value),
+            'min': func.min(value),
+            'max': func.max(value),
+            'sum': func.sum(value),
+            'count': func.count(value),
+            # SQLite takes a bare column from the row that satisfies a lone max(), ids follow arrival order
+            'last': value
+        }
+        query = (
+            select(SystemMetricValue.metric_type_id, bucket, aggregates[aggregation])
+            .join(SystemMetricSnapshot, SystemMetricValue.metric_snapshot_id == SystemMetricSnapshot.metric_snapshot_id)
+            .where(SystemMetricValue.metric_type_id.in_(series.keys()), epoch.between(start_epoch, end_epoch))
+        )
+        if aggregation == 'last':
+            query = query.add_columns(func.max(SystemMetricValue.metric_id))
+    else:
+        epoch = model.bucket_start_epoch
+        bucket = (epoch - epoch % step).label('bucket')
+        aggregates = {
+            'avg': func.sum(model.sum_value) / func.sum(model.value_count),
+            'min': func.min(model.min_value),
+            'max': func.max(model.max_value),
+            'sum': func.sum(model.sum_value),
+            'count': func.sum(model.value_count),
+            'last': model.last_value
+        }
+        query = (
+            select(model.metric_type_id, bucket, aggregates[aggregation])
+            .where(model.metric_type_id.in_(series.keys()), epoch.between(start_epoch - start_epoch % step, end_epoch))
+        )
+        if aggregation == 'last':
+            query = query.add_columns(func.max(model.last_epoch))
+    query = query.group_by(query.selected_columns[0], bucket).order_by(bucket)
+    appendRows(series, (row[:3] for row in session.execute(query)))
+    if aggregation not in ('count', 'sum'):
+        if heartbeats is None:
+            heartbeats = loadHeartbeats(session, series.keys())
+        fillBuckets(series, heartbeats, valuesBefore(session, heartbeats, start_epoch), start_epoch, end_epoch, step)
+    return series, source
+
+
+def appendRows(series, rows):
+    for metric_type_id, epoch, value in rows:
+        epochs, values = series[metric_type_id]
+        epochs.append(epoch)
+        values.append(value)
@@ -1,16 +1,26 @@
 from flask import Flask, request
+import atexit
+import json
 import logging
+import zlib
 import sys
 import sqlite3
 from sqlalchemy.orm import Session
 from sqlalchemy.inspection import inspect
 from models import *
 from lib_config.config import Config
-from sqlalchemy import create_engine
+from storageProfile import createEngine
 from dataclasses import dataclass
-from systemMetrics import DTO_Aggregator
+from wireFormat import BINARY_BATCH_CONTENT_TYPE, BINARY_CONTENT_TYPE, NDJSON_CONTENT_TYPE, decodeJsonPayload, unpackAggregator, unpackBatch
 from datetime import datetime, UTC
 from dashboard import Dashboard
+from ingestionManager import ingestionManager
+from dimensionCache import dimensionCache
+from schemaMigration import migrateSchema
+from rollupManager import backfillRollups
+from writeBehindQueue import writeBehindQueue
+from retentionManager import convertAutoVacuum, retentionManager
+from seriesQuery import AGGREGATIONS, loadHeartbeats, queryAggregatedSeries, querySeries, resolveSeries
 
 @dataclass
 class SQLSystemMetric:
@@ -18,6 +28,9 @@ class SQLSystemMetric:
     system_id: int
     metrics: str
 
+# Upper bound on a decompressed request body, guards against compression bombs
+MAX_DECOMPRESSED_BYTES = 64 * 1024 * 1024
+
 class CursorManager:
     def __init__(self, cursor: sqlite3.Cursor):
         self.cursor = cursor
@@ -34,104 +47,75 @@ class Application:
         self.sqllite_file = self.config.database.connection_string.split('sqlite:///')[1]
         self.logger = logger
         self.webserver = Flask(__name__)
-        self.engine = create_engine(self.config.database.connection_string)
+        self.engine = createEngine(self.config.database)
+        self.ingestion = ingestionManager(self.engine, self.logger, dimensionCache(self.config.database.dimension_cache_size))
+        self.writeBehind = None
         self.setup_routes()
         self.create_tables()
+        if self.config.ingestion.write_behind:
+            self.writeBehind = writeBehindQueue(
+                self.ingestion,
+                self.logger,
+                max_size=self.config.ingestion.queue_size,
+                batch_size=self.config.ingestion.batch_size,
+                batch_wait=self.config.ingestion.batch_wait_seconds
+            )
+            atexit.register(self.writeBehind.stop)
+            self.logger.info("Write-behind ingestion enabled")
+        self.retention = None
+        if self.config.retention.enabled:
+            self.retention = retentionManager(self.engine, self.config.retention, self.logger)
+            self.retention.start()
+            self.logger.info("Retention enabled, running every %ss", self.config.retention.interval_seconds)
         dashboard = Dashboard()
         self.dash_app = dashboard.create_dash_app(self.webserver, self.engine)
         self.logger.debug("Server application initialised")
 
     def create_tables(self):
-        """Ensure tables exist in the SQLite database."""
+        """Ensure tables exist in the SQLite database and migrate existing ones to the current schema."""
         Base.metadata.create_all(self.engine)
+        migrateSchema(self.engine, self.logger)
+        if self.config.retention.convert_auto_vacuum:
+            convertAutoVacuum(self.engine, self.logger)
+        backfillRollups(self.engine, self.logger)
         self.logger.info("Tables created (if they didn't already exist)")
 
     def setup_routes(self):
         self.webserver.route("/hello", methods=['GET'])(self.helloWorld)
         self.webserver.route("/metrics", methods=['POST'])(self.uploadMetrics)
+        self.webserver.route("/metrics/batch", methods=['POST'])(self.uploadMetricsBatch)
         self.webserver.route("/threshold", methods=['POST'])(self.updateMetricThreshold)
         self.webserver.route("/threshold", methods=['GET'])(self.getMetricThreshold)
         self.webserver.route("/dashboards", methods=['GET'])(self.displayMetrics)
+        self.webserver.route("/stats", methods=['GET'])(self.getStats)
+        self.webserver.route("/series", methods=['GET'])(self.getSeries)
 
     def helloWorld(self):
         self.logger.info("Hello world called")
         return {'message': 'Hello world from data reading web server'}
 
     def uploadMetrics(self):
-        session = None
         try:
             message = 'Metric uploaded successfully'
-            criticalDevices = []
-            data = request.get_json()
             self.logger.info("Upload metrics called")
-            dto_aggregator = DTO_Aggregator.from_dict(data)
+            if request.mimetype == BINARY_CONTENT_TYPE:
+                dto_aggregator = unpackAggregator(self.get_request_body())
+            else:
+                dto_aggregator = decodeJsonPayload(self.get_request_json())
             self.logger.info("JSON Deserialized. Storing aggregator snapshot: %s", dto_aggregator)
-            session = Session(self.engine)
-
-            aggregator = session.query(Aggregator).filter_by(guid=str(dto_aggregator.platform_uuid)).first()
-            if not aggregator:
-                aggregator = Aggregator(
-                    guid=str(dto_aggregator.platform_uuid),
-                    name=dto_aggregator.name
-                )
-                session.add(aggregator)
-                session.flush()
-
-            for dto_device in dto_aggregator.devices:
-                device = session.query(Device).filter_by(
-                    aggregator_id=aggregator.aggregator_id,
-                    name=dto_device.name
-                ).first()
-
-                if not device:
-                    device = Device(
-                        aggregator_id=aggregator.aggregator_id,
-                        name=dto_device.name
-                    )
-                    session.add(device)
-                    session.flush()
-
-                now_UTC = datetime.now(UTC)
-
-                for dto_snapshot in dto_device.data_snapshots:
-                    snapshot = SystemMetricSnapshot(
-                        device_id=device.device_id,
-                        client_utc_timestamp_epoch=int(dto_snapshot.timestamp_utc.timestamp()),
-                        server_utc_timestamp_epoch=int(now_UTC.timestamp())
-                    )
-                    session.add(snapshot)
-                    session.flush()
 
-                    for dto_metric in dto_snapshot.metrics:
-                        metric_type = session.query(MetricType).filter_by(
-                            device_id=device.device_id,
-                            metric_type=dto_metric.name
-                        ).first()
-
-                        if not metric_type:
-                            metric_type = MetricType(
-                                device_id=device.device_id,
-                                metric_type=dto_metric.name,
-                                metric_threshold=dto_metric.threshold
-                            )
-                            session.add(metric_type)
-                            session.flush()
-
-                        device_metric_value = SystemMetricValue(
-                            metric_snapshot_id=snapshot.metric_snapshot_id,
-                            metric_type_id=metric_type.metric_type_id,
-                            metric_value=float(dto_metric.value)
-                        )
-                        session.add(device_metric_value)
-                        if metric_type.metric_threshold and device_metric_value.metric_value >= metric_type.metric_threshold:
-                            message = 'Some devices above threshold'
-                            criticalDevices.append(device.name)
-
-                        self.logger.info("Uploaded: %s %s", device_metric_value.metric_type_id, device_metric_value.metric_value) 
-
-
-            session.commit()
-            session.close()
+            if self.writeBehind:
+                if not self.writeBehind.submit(dto_aggregator):
+                    self.logger.warning("Write-behind queue full, rejecting upload from %s", dto_aggregator.name)
+                    return {
+                        'status': 'error',
+                        'message': 'Server busy, retry later'
+                    }, 503, {'Retry-After': str(self.config.ingestion.retry_after_seconds)}
+                criticalDevices = self.ingestion.evaluateThresholds(dto_aggregator)
+            else:
+                criticalDevices = self.ingestion.ingestAggregators([dto_aggregator])[0]
+            if criticalDevices:
+                message = 'Some devices above threshold'
 
             return {
                 'status': 'success',
@@ -139,63 +123,131 @@ class Application:
                 'criticalDevices': criticalDevices
             }, 201
         except Exception as e:
-            if session is not None:
-                self.logger.error("Rolling back session due to error: %s", str(e))
+            self.logger.exception("Error in upload_snapshot route: %s", str(e))
+            return {
+                'status': 'error',
+                'message': str(e)
+            }, 500
+
+    def uploadMetricsBatch(self):
+        """
+        Store a JSON array, NDJSON stream or binary batch of aggregator payloads in one transaction.
+        Responds 201 when every payload was stored, 207 with a per-item status otherwise.
+        """
+        try:
+            body = self.get_request_body()
+            decode = decodeJsonPayload
+            if request.mimetype == BINARY_BATCH_CONTENT_TYPE:
+                items = unpackBatch(body)
+                decode = unpackAggregator
+            elif request.mimetype == NDJSON_CONTENT_TYPE:
+                items = []
+                for line in body.splitlines():
+                    if line.strip():
+                        try:
+                            items.append(json.loads(line))
+                        except ValueError as e:
+                            # Kept in place so item indexes still match the request lines
+                            items.append(e)
+            else:
+                items = json.loads(body)
+                if not isinstance(items, list):
+                    return {'status': 'error', 'message': 'Expected a JSON array of aggregator payloads'}, 400
+            if len(items) > self.config.ingestion.max_batch_items:
+                return {
+                    'status': 'error',
+                    'message': f'Batch of {len(items)} payloads exceeds the limit of {self.config.ingestion.max_batch_items}'
+                }, 413
+            self.logger.info("Batch upload of %s payloads", len(items))
+
+            results = [None] * len(items)
+            decoded = []
+            for index, item in enumerate(items):
                 try:
-                    session.rollback()
-                    session.close()
+                    if isinstance(item, Exception):
+                        raise item
+                    decoded.append((index, decode(item)))
                 except Exception as e:
-                    self.logger.exception("Error rolling back session: %s", str(e))
+                    results[index] = {'status': 'error', 'code': 400, 'message': f'Invalid payload: {e}'}
+
+            if self.writeBehind:
+                for index, dto_aggregator in decoded:
+                    if self.writeBehind.submit(dto_aggregator):
+                        results[index] = {'status': 'success', 'code': 201, 'criticalDevices': self.ingestion.evaluateThresholds(dto_aggregator)}
+                    else:
+                        results[index] = {'status': 'error', 'code': 503, 'message': 'Server busy, retry later'}
+            elif decoded:
+                stored = self.ingestion.ingestEach([dto_aggregator for _, dto_aggregator in decoded])
+                for (index, _), outcome in zip(decoded, stored):
+                    if isinstance(outcome, Exception):
+                        results[index] = {'status': 'error', 'code': 500, 'message': str(outcome)}
+                    else:
+                        results[index] = {'status': 'success', 'code': 201, 'criticalDevices': outcome}
 
-            self.logger.exception("Error in upload_snapshot route: %s", str(e))
+            criticalDevices = []
+            for result in results:
+                criticalDevices.extend(result.get('criticalDevices', []))
+            failed = sum(1 for result in results if result['code'] != 201)
+            response = {
+                'status': 'success' if not failed else 'partial',
+                'message': f'{len(results) - failed} of {len(results)} payloads stored',
+                'results': results,
+                'criticalDevices': criticalDevices
+            }
+            if not failed:
+                return response, 201
+            headers = {}
+            if any(result['code'] == 503 for result in results):
+                headers['Retry-After'] = str(self.config.ingestion.retry_after_seconds)
+            return response, 207, headers
+        except Exception as e:
+            self.logger.exception("Error in upload_snapshot_batch route: %s", str(e))
             return {
                 'status': 'error',
                 'message': str(e)
             }, 500
 
+    def get_request_body(self) -> bytes:
+        """Return the raw request body, inflated first if it was sent gzip or deflate encoded."""
+        encoding = request.headers.get('Content-Encoding', '').lower()
+        if encoding in ('', 'identity'):
+            return request.get_data()
+        if encoding not in ('gzip', 'deflate'):
+            raise ValueError(f"Unsupported Content-Encoding {encoding}")
+        # wbits 32 + MAX_WBITS accepts both gzip and zlib headers
+        inflater = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        body = inflater.decompress(request.get_data(), MAX_DECOMPRESSED_BYTES)
+        if inflater.unconsumed_tail:
+            raise ValueError("Decompressed request body too large")
+        return body
+
+    def get_request_json(self):
+        """Parse the JSON request body, inflating it first if it was sent gzip or deflate encoded."""
+        encoding = request.headers.get('Content-Encoding', '').lower()
+        if encoding in ('', 'identity'):
+            return request.get_json()
+        return json.loads(self.get_request_body())
+
     def displayMetrics(self):
         self.logger.info("Redirecting to Dash app")
         return self.dash_app.index()
     
     def updateMetricThreshold(self):
-        session = None
         try:
             data = request.get_json()
             self.logger.info("Update metric threshold called")
-            session = Session(self.engine)
-            device = session.query(Device).filter_by(
-                name=data['device_name']
-            ).first()
-
-            metric_type = session.query(MetricType).filter_by(
-                device_id=device.device_id,
-                metric_type=data['metric_type']
-            ).first()
-
-            if not metric_type:
+            if not self.ingestion.updateMetricThreshold(data['device_name'], data['metric_type'], data['new_threshold']):
                 return {
                     'status': 'error',
                     'message': 'Metric type not found'
                 }, 404
 
-            metric_type.metric_threshold = data['new_threshold']
-
-            self.logger.info("Metric threshold updated: %s %s", metric_type.metric_type, metric_type.metric_threshold)
-            session.commit()
-            session.close()
+            self.logger.info("Metric threshold updated: %s %s", data['metric_type'], data['new_threshold'])
             return {
                 'status': 'success',
                 'message': 'Metric threshold updated successfully'
             }, 200
         except Exception as e:
-            if session is not None:
-                self.logger.error("Rolling back session due to error: %s", str(e))
-                try:
-                    session.rollback()
-                    session.close()
-                except Exception as e:
-                    self.logger.exception("Error rolling back session: %s", str(e))
-
             self.logger.exception("Error in update_metric_threshold route: %s", str(e))
             return {
                 'status': 'error',
@@ -209,25 +261,18 @@ class Application:
             self.logger.info("Get metric threshold called")
             session = Session(self.engine)
 
-            device = session.query(Device).filter_by(
-                name=data['device_name']
-            ).first()
-
-            metric_type = session.query(MetricType).filter_by(
-                device_id=device.device_id,
-                metric_type=data['metric_type']
-            ).first()
-
+            metric_type = self.ingestion.lookupMetricType(session, data['device_name'], data['metric_type'])
+            session.close()
             if not metric_type:
                 return {
                     'status': 'error',
                     'message': 'Metric type not found'
                 }, 404
 
-            session.close()
+            _, _, metric_threshold = metric_type
             return {
                 'status': 'success',
-                'message': metric_type.metric_threshold
+                'message': metric_threshold
             }, 200
         except Exception as e:
             if session is not None:
@@ -242,10 +287,93 @@ class Application:
                 'message': str(e)
             }, 500
 
+    def getSeries(self):
+        """
+        Return many (device, metric type) series for a time range as parallel timestamp/value arrays.
+        Accepts a JSON body {"series": [{"device_name", "metric_type"}], "start", "end", "step", "aggregation"}
+        or the same as query parameters with series given as repeated device_name:metric_type values.
+        """
+        session = None
+        try:
+            self.logger.info("Get series called")
+            data = request.get_json(silent=True) or {}
+            if 'series' in data:
+                keys = [(item['device_name'], item['metric_type']) for item in data['series']]
+            else:
+                keys = [tuple(item.rsplit(':', 1)) for item in request.args.getlist('series')]
+            end_epoch = int(data.get('end', request.args.get('end', datetime.now(UTC).timestamp())))
+            start_epoch = int(data.get('start', request.args.get('start', end_epoch - 3600)))
+            step = data.get('step', request.args.get('step'))
+            aggregation = data.get('aggregation', request.args.get('aggregation', 'avg'))
+
+            if not keys or any(len(key) != 2 for key in keys):
+                return {
+                    'status': 'error',
+                    'message': 'Expected one or more series as device_name:metric_type'
+                }, 400
+            if start_epoch > end_epoch or (step is not None and int(step) <= 0) or aggregation not in AGGREGATIONS:
+                return {
+                    'status': 'error',
+                    'message': f"Expected start <= end, a positive step and an aggregation in {', '.join(AGGREGATIONS)}"
+                }, 400
+
+            session = Session(self.engine)
+            metric_type_ids = resolveSeries(session, keys)
+            heartbeats = loadHeartbeats(session, set(metric_type_ids.values()))
+            if step is None:
+                series, source = querySeries(session, set(metric_type_ids.values()), start_epoch, end_epoch, heartbeats=heartbeats)
+            else:
+                series, source = queryAggregatedSeries(session, set(metric_type_ids.values()), start_epoch, end_epoch, int(step), aggregation, heartbeats)
+            session.close()
+
+            response = []
+            for device_name, metric_type in keys:
+                metric_type_id = metric_type_ids.get((device_name, metric_type))
+                timestamps, values = series.get(metric_type_id, ([], []))
+                response.append({
+                    'device_name': device_name,
+                    'metric_type': metric_type,
+                    'found': metric_type_id is not None,
+                    # Set for series reported on change, values hold between points for up to this long
+                    'heartbeat_seconds': heartbeats.get(metric_type_id),
+                    'timestamps': timestamps,
+                    'values': values
+                })
+            return {
+                'status': 'success',
+                'start': start_epoch,
+                'end': end_epoch,
+                'step': int(step) if step is not None else None,
+                'aggregation': aggregation if step is not None else None,
+                'source': source,
+                'series': response
+            }, 200
+        except Exception as e:
+            if session is not None:
+                session.close()
+            self.logger.exception("Error in get_series route: %s", str(e))
+            return {
+                'status': 'error',
+                'message': str(e)
+            }, 500
+
+    def getStats(self):
+        stats = {
+            'status': 'success',
+            'dimension_cache': self.ingestion.cache.stats()
+        }
+        if self.writeBehind:
+            stats['write_behind'] = self.writeBehind.stats()
+        if self.retention:
+            stats['retention'] = self.retention.report()
+        return stats, 200
+
     def run(self) -> int:
         try:
             self.logger.info("Starting Flask web server on port %s", self.config.web.port)
             self.webserver.run(debug=self.config.web.debug, port=self.config.web.port)
+            if self.writeBehind:
+                self.writeBehind.stop()
             self.logger.info("Application completed successfully")
             return 0
         except Exception as e:
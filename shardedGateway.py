@@ -0,0 +1,198 @@
+"""
+Library module for the sharded ESP32 gateway, gateway_mode "processes".
+Worker processes each run the asyncio gateway on the same port with SO_REUSEPORT, so the
+kernel spreads device connections across them and parsing runs outside the client's GIL.
+Every sampling interval a worker converts the messages of its own devices, groups them per
+device and forwards them to the client process as one binary payload (see wireFormat.py),
+together with the devices that connected to or disconnected from it. Commands for a device,
+such as REBOOT, are sent to the worker holding its connection. A worker that dies is restarted.
+"""
+
+import dataclasses
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+# Results from the workers: ('metrics', worker, packed payload), ('connected' | 'disconnected', worker, device_name), ('stats', worker, dict)
+METRICS, CONNECTED, DISCONNECTED, STATS = 'metrics', 'connected', 'disconnected', 'stats'
+STATS_INTERVAL_SECONDS = 5.0
+STOP_GRACE_SECONDS = 2.0
+
+
+def runWorker(index: int, client, results, commands):
+    """Worker process entry point, client is the ClientConfig."""
+    # Imported here so the client process does not need them to start workers
+    from aggregationManager import aggregationManager
+    from remoteMonitor import remoteMonitor
+    from wireFormat import packAggregator
+
+    parent = os.getppid()
+    # Exiting must not wait to flush results nobody will read, other workers keep the queue's pipe open
+    results.cancel_join_thread()
+    logger = logging.getLogger(f"esp32-worker-{index}")
+    monitor = remoteMonitor(logger, SimpleNamespace(client=dataclasses.replace(client, gateway_mode="asyncio")), reuse_port=True)
+    stopping = threading.Event()
+    threading.Thread(target=relayCommands, args=(monitor, commands, stopping, logger), name="commands", daemon=True).start()
+    aggregator = aggregationManager()
+    owned = set()
+    last_stats = 0.0
+    while os.getppid() == parent:
+        if stopping.wait(client.sample_interval_seconds):
+            logger.info("ESP32 worker %s stopping", index)
+            monitor.stop()
+            return
+        with monitor.lock:
+            connected = set(monitor.device_connections)
+        for device_name in connected - owned:
+            results.put((CONNECTED, index, device_name))
+        for device_name in owned - connected:
+            results.put((DISCONNECTED, index, device_name))
+        owned = connected
+        snapshots = monitor.processEsp32Metrics()
+        if snapshots:
+            aggregator.addSnapshotsToAggregator(snapshots)
+            # The client only unpacks the devices of a batch, the platform uuid is left empty
+            results.put((METRICS, index, packAggregator(aggregator.drain('', f"esp32-worker-{index}"))))
+        if time.monotonic() - last_stats >= STATS_INTERVAL_SECONDS:
+            results.put((STATS, index, monitor.stats()))
+            last_stats = time.monotonic()
+    # The client process is gone
+    logger.warning("ESP32 worker %s exiting, its parent process has stopped", index)
+
+
+def relayCommands(monitor, commands, stopping, logger):
+    """Send the commands for the worker's devices. None asks the worker to stop."""
+    while True:
+        command = commands.get()
+        if command is None:
+            stopping.set()
+            return
+        device_name, data = command
+        with monitor.lock:
+            conn = monitor.device_connections.get(device_name)
+        if conn is None:
+            logger.error(f"No active connection for device {device_name}")
+            continue
+        try:
+            conn.sendall(data)
+        except Exception as e:
+            logger.error(f"Failed to send to device {device_name}: {e}")
+
+
+class workerConnection:
+    """Stands in for a device's socket in the client process, sendall hands the data to the worker holding the connection."""
+    __slots__ = ('worker', 'device_name', 'commands')
+
+    def __init__(self, worker: int, device_name: str, commands):
+        self.worker = worker
+        self.device_name = device_name
+        self.commands = commands
+
+    def sendall(self, data: bytes):
+        self.commands.put((self.device_name, data))
+
+
+class shardedGateway:
+    def __init__(self, client, onBatch, onConnect, onDisconnect, logger=None):
+        """
+        client is the ClientConfig. onBatch(payload) is called with each packed batch,
+        onConnect/onDisconnect(device_name, connection) as devices move between workers.
+        """
+        self.client = client
+        self.workers = client.gateway_workers or os.cpu_count() or 1
+        self.onBatch = onBatch
+        self.onConnect = onConnect
+        self.onDisconnect = onDisconnect
+        self.logger = logger or logging.getLogger()
+        self.context = multiprocessing.get_context('spawn')
+        self.results = self.context.Queue()
+        self.commands = [self.context.Queue() for _ in range(self.workers)]
+        self.processes = [None] * self.workers
+        # device_name -> workerConnection of the worker that holds its connection
+        self.owners = {}
+        self.worker_stats = {}
+        self.restarts = 0
+        self.batches = 0
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.logger.info(f"Starting {self.workers} ESP32 gateway workers on {self.client.socket_host}:{self.client.socket_port}")
+        for index in range(self.workers):
+            self.startWorker(index)
+        threading.Thread(target=self.readResults, name="esp32-workers", daemon=True).start()
+
+    def startWorker(self, index: int):
+        process = self.context.Process(
+            target=runWorker, args=(index, self.client, self.results, self.commands[index]),
+            name=f"esp32-worker-{index}", daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def stop(self):
+        """Ask the workers to stop, terminating any that have not exited within a sampling interval."""
+        self.stopping.set()
+        for commands in self.commands:
+            commands.put(None)
+        deadline = time.monotonic() + self.client.sample_interval_seconds + STOP_GRACE_SECONDS
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                self.logger.warning(f"ESP32 gateway worker {index} did not stop, terminating it")
+                process.terminate()
+                process.join()
+
+    def readResults(self):
+        last_check = time.monotonic()
+        while not self.stopping.is_set():
+            try:
+                kind, worker, value = self.results.get(timeout=1)
+            except queue.Empty:
+                kind = None
+            if kind == METRICS:
+                self.batches += 1
+                self.onBatch(value)
+            elif kind == CONNECTED:
+                connection = self.owners[value] = workerConnection(worker, value, self.commands[worker])
+                self.onConnect(value, connection)
+            elif kind == DISCONNECTED:
+                self.release(value, worker)
+            elif kind == STATS:
+                self.worker_stats[worker] = value
+            if time.monotonic() - last_check >= 1:
+                self.restartDeadWorkers()
+                last_check = time.monotonic()
+
+    def release(self, device_name: str, worker: int):
+        # The device may already have reconnected through another worker
+        connection = self.owners.get(device_name)
+        if connection is not None and connection.worker == worker:
+            del self.owners[device_name]
+            self.onDisconnect(device_name, connection)
+
+    def restartDeadWorkers(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive() or self.stopping.is_set():
+                continue
+            self.logger.error(f"ESP32 gateway worker {index} exited with code {process.exitcode}, restarting it")
+            for device_name in [name for name, connection in self.owners.items() if connection.worker == index]:
+                self.release(device_name, index)
+            self.worker_stats.pop(index, None)
+            self.restarts += 1
+            self.startWorker(index)
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'alive': sum(1 for process in self.processes if process is not None and process.is_alive()),
+            'restarts': self.restarts,
+            'batches': self.batches,
+            'devices': len(self.owners),
+            'by_worker': dict(self.worker_stats)
+        }
@@ -0,0 +1,34 @@
+"""
+Library module for creating the server's database engine from the storage profile in DatabaseConfig.
+Every pooled SQLite connection is configured with the profile's pragmas so that dashboard
+readers and the ingestion writer do not block each other.
+"""
+
+from sqlalchemy import create_engine, event
+from lib_config.config import DatabaseConfig
+
+
+def createEngine(database: DatabaseConfig):
+    pool_size = database.reader_pool_size + 1
+    engine = create_engine(
+        database.connection_string,
+        pool_size=pool_size,
+        max_overflow=pool_size,
+        connect_args={'timeout': database.busy_timeout_ms / 1000, 'check_same_thread': False}
+    )
+
+    @event.listens_for(engine, "connect")
+    def applyPragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA auto_vacuum={database.auto_vacuum}")
+            cursor.execute(f"PRAGMA journal_mode={database.journal_mode}")
+            cursor.execute(f"PRAGMA synchronous={database.synchronous}")
+            cursor.execute(f"PRAGMA mmap_size={int(database.mmap_size)}")
+            # Negative cache_size is in KiB rather than pages
+            cursor.execute(f"PRAGMA cache_size=-{int(database.cache_size_kb)}")
+            cursor.execute(f"PRAGMA busy_timeout={int(database.busy_timeout_ms)}")
+        finally:
+            cursor.close()
+
+    return engine
@@ -2,69 +2,180 @@
 Library module for the data model for the metrics data. This is a pure
 DTO data definition. The implementation of the logic to read and store metrics
 is in the metrics_client_datamodel.py module.
+
+The to_dict/from_dict methods are written out per class rather than derived by
+reflection, they sit on the upload path of both the client and the server.
 """
 
 from datetime import datetime
 from typing import List
 from dataclasses import dataclass, field
-from dataclasses_json import dataclass_json
-import uuid            
-import logging
+import uuid
+
 
-@dataclass_json
-@dataclass
+@dataclass(slots=True)
 class DTO_Metric:
     name: str
     value: float
     threshold: float = field(default=None)
 
-@dataclass_json
-@dataclass
+    def to_dict(self):
+        """Convert DTO_Metric to a dictionary for JSON serialization. A missing threshold is omitted."""
+        if self.threshold is None:
+            return {'name': self.name, 'value': self.value}
+        return {'name': self.name, 'value': self.value, 'threshold': self.threshold}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data['name'], data['value'], data.get('threshold'))
+
+
+@dataclass(slots=True)
 class DTO_DataSnapshot:
-    timestamp_utc: datetime = field(
-        default_factory=lambda: datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
-        metadata={'dataclasses_json': {
-            'encoder': lambda d: d.isoformat() if isinstance(d, datetime) else d,
-            'decoder': lambda d: datetime.fromisoformat(d) if isinstance(d, str) else d
-        }}
-    )
+    timestamp_utc: datetime = field(default_factory=lambda: datetime.now().strftime('%Y-%m-%dT%H:%M:%S'))
     metrics: List[DTO_Metric] = field(default_factory=list)
     device_name: str = field(default=None)
 
     def to_dict(self):
         """Convert DTO_DataSnapshot to a dictionary for JSON serialization."""
+        timestamp = self.timestamp_utc
         return {
-            'timestamp_utc': self.timestamp_utc.isoformat(),
+            'timestamp_utc': timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp,
             'metrics': [metric.to_dict() for metric in self.metrics]
         }
 
- 
-@dataclass_json
-@dataclass 
+    @classmethod
+    def from_dict(cls, data: dict):
+        timestamp = data['timestamp_utc']
+        metric = DTO_Metric
+        return cls(
+            datetime.fromisoformat(timestamp) if isinstance(timestamp, str) else timestamp,
+            [metric(m['name'], m['value'], m.get('threshold')) for m in data.get('metrics', ())],
+            data.get('device_name')
+        )
+
+
+@dataclass(slots=True)
 class DTO_Device:
     name: str
     data_snapshots: List[DTO_DataSnapshot] = field(default_factory=list)
+
     def to_dict(self):
         """Convert DTO_Device to a dictionary for JSON serialization."""
         return {
             'name': self.name,
             'data_snapshots': [snapshot.to_dict() for snapshot in self.data_snapshots]
         }
-    
-@dataclass_json
-@dataclass
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        snapshot = DTO_DataSnapshot.from_dict
+        return cls(data['name'], [snapshot(s) for s in data.get('data_snapshots', ())])
+
+
+@dataclass(slots=True)
 class DTO_Aggregator:
-    logger = logging.getLogger()
-    logger.info("Test")
-    platform_uuid: uuid.UUID = field(metadata={'dataclasses_json': {'encoder': str}})
+    platform_uuid: uuid.UUID
     name: str
     devices: List[DTO_Device] = field(default_factory=list)
-
+    # Set when metrics are only reported on change, see changeDetector.py
+    heartbeat_seconds: float = field(default=None)
 
     def to_dict(self):
         """Convert DTO_Aggregator to a dictionary for JSON serialization."""
-        return {
+        data = {
             'platform_uuid': str(self.platform_uuid),  # Convert UUID to string
             'name': self.name,
             'devices': [device.to_dict() for device in self.devices]
-        }
\ No newline at end of file
+        }
+        if self.heartbeat_seconds is not None:
+            data['heartbeat_seconds'] = self.heartbeat_seconds
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        device = DTO_Device.from_dict
+        return cls(data['platform_uuid'], data['name'], [device(d) for d in data.get('devices', ())], data.get('heartbeat_seconds'))
+
+
+@dataclass(slots=True)
+class DTO_ColumnarDevice:
+    """
+    The snapshots of one device as columns: metric names and their thresholds once, then one
+    client epoch and one value vector per snapshot, aligned with metric_names (None where the
+    snapshot did not report that metric).
+    """
+    name: str
+    metric_names: List[str] = field(default_factory=list)
+    thresholds: List[float] = field(default_factory=list)
+    epochs: List[int] = field(default_factory=list)
+    values: List[List[float]] = field(default_factory=list)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'metrics': self.metric_names,
+            'thresholds': self.thresholds,
+            'epochs': self.epochs,
+            'values': self.values
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        device = cls(data['name'], data['metrics'], data.get('thresholds') or [None] * len(data['metrics']), data['epochs'], data['values'])
+        width = len(device.metric_names)
+        if len(device.thresholds) != width or len(device.values) != len(device.epochs) or any(len(row) != width for row in device.values):
+            raise ValueError(f"Columnar device {device.name} has mismatched column lengths")
+        return device
+
+    @classmethod
+    def from_device(cls, device: DTO_Device):
+        """Pivot a DTO_Device. A metric keeps the threshold of the first snapshot reporting it."""
+        columns = {}
+        thresholds = []
+        for snapshot in device.data_snapshots:
+            for metric in snapshot.metrics:
+                if metric.name not in columns:
+                    columns[metric.name] = len(columns)
+                    thresholds.append(metric.threshold)
+        epochs = []
+        values = []
+        for snapshot in device.data_snapshots:
+            timestamp = snapshot.timestamp_utc
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp)
+            epochs.append(int(timestamp.timestamp()))
+            row = [None] * len(columns)
+            for metric in snapshot.metrics:
+                row[columns[metric.name]] = metric.value
+            values.append(row)
+        return cls(device.name, list(columns), thresholds, epochs, values)
+
+
+@dataclass(slots=True)
+class DTO_ColumnarAggregator:
+    platform_uuid: uuid.UUID
+    name: str
+    devices: List[DTO_ColumnarDevice] = field(default_factory=list)
+    heartbeat_seconds: float = field(default=None)
+
+    def to_dict(self):
+        data = {
+            'layout': 'columnar',
+            'platform_uuid': str(self.platform_uuid),
+            'name': self.name,
+            'devices': [device.to_dict() for device in self.devices]
+        }
+        if self.heartbeat_seconds is not None:
+            data['heartbeat_seconds'] = self.heartbeat_seconds
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        device = DTO_ColumnarDevice.from_dict
+        return cls(data['platform_uuid'], data['name'], [device(d) for d in data.get('devices', ())], data.get('heartbeat_seconds'))
+
+    @classmethod
+    def from_aggregator(cls, aggregator: DTO_Aggregator):
+        device = DTO_ColumnarDevice.from_device
+        return cls(aggregator.platform_uuid, aggregator.name, [device(d) for d in aggregator.devices], aggregator.heartbeat_seconds)
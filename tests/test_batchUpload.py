@@ -0,0 +1,133 @@
+"""
+Tests for POST /metrics/batch through the Flask test client: 201 when every payload is stored,
+207 with a per-item status otherwise, 400 for a body that is not a batch, 413 past
+max_batch_items and per-item 503 with Retry-After when the write-behind queue is full.
+"""
+
+import json
+import logging
+import threading
+import uuid
+from types import SimpleNamespace
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+from ingestionManager import ingestionManager
+from lib_config.config import IngestionConfig
+from models import Base, SystemMetricSnapshot
+from server import Application
+from systemMetrics import DTO_Aggregator, DTO_DataSnapshot, DTO_Device, DTO_Metric
+from wireFormat import BINARY_BATCH_CONTENT_TYPE, NDJSON_CONTENT_TYPE, packAggregator, packBatch
+from writeBehindQueue import writeBehindQueue
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'metrics.db'}")
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def application(engine, write_behind=None, max_batch_items=1000):
+    """The server's routes on a test database, without its config file, dashboard or retention."""
+    app = Application.__new__(Application)
+    app.config = SimpleNamespace(ingestion=IngestionConfig(max_batch_items=max_batch_items, retry_after_seconds=3))
+    app.logger = logging.getLogger('test')
+    app.webserver = Flask(__name__)
+    app.engine = engine
+    app.ingestion = ingestionManager(engine, app.logger)
+    app.writeBehind = write_behind
+    app.setup_routes()
+    return app
+
+
+def aggregator(device_name, value):
+    return DTO_Aggregator(uuid.UUID(int=1), 'aggregator', [
+        DTO_Device(device_name, [DTO_DataSnapshot('2024-01-01T00:00:00', [DTO_Metric('cpu_percent', value, 90.0)])])
+    ])
+
+
+def storedSnapshots(engine) -> int:
+    with Session(engine) as session:
+        return session.scalar(select(func.count()).select_from(SystemMetricSnapshot))
+
+
+def test_json_array_all_stored(engine):
+    client = application(engine).webserver.test_client()
+    response = client.post('/metrics/batch', json=[aggregator('a', 10.0).to_dict(), aggregator('b', 95.0).to_dict()])
+    assert response.status_code == 201
+    assert [result['code'] for result in response.json['results']] == [201, 201]
+    assert response.json['criticalDevices'] == ['b']
+    assert storedSnapshots(engine) == 2
+
+
+def test_json_array_keeps_item_indexes(engine):
+    client = application(engine).webserver.test_client()
+    response = client.post('/metrics/batch', json=[aggregator('a', 10.0).to_dict(), {'name': 'no uuid'}, aggregator('c', 95.0).to_dict()])
+    assert response.status_code == 207
+    assert response.json['status'] == 'partial'
+    assert [result['code'] for result in response.json['results']] == [201, 400, 201]
+    assert response.json['results'][2]['criticalDevices'] == ['c']
+    assert 'Retry-After' not in response.headers
+    assert storedSnapshots(engine) == 2
+
+
+def test_ndjson_bad_line_keeps_item_indexes(engine):
+    client = application(engine).webserver.test_client()
+    body = '\n'.join([json.dumps(aggregator('a', 10.0).to_dict()), '{"truncated": ', '', json.dumps(aggregator('b', 10.0).to_dict())])
+    response = client.post('/metrics/batch', data=body, content_type=NDJSON_CONTENT_TYPE)
+    assert response.status_code == 207
+    # Blank lines are skipped, the bad line keeps its place
+    assert [result['code'] for result in response.json['results']] == [201, 400, 201]
+    assert storedSnapshots(engine) == 2
+
+
+def test_binary_batch(engine):
+    client = application(engine).webserver.test_client()
+    body = packBatch([packAggregator(aggregator('a', 95.0)), b'SM\x01junk', packAggregator(aggregator('b', 10.0))])
+    response = client.post('/metrics/batch', data=body, content_type=BINARY_BATCH_CONTENT_TYPE)
+    assert response.status_code == 207
+    assert [result['code'] for result in response.json['results']] == [201, 400, 201]
+    assert response.json['criticalDevices'] == ['a']
+    assert storedSnapshots(engine) == 2
+
+
+def test_not_a_batch_is_rejected(engine):
+    client = application(engine).webserver.test_client()
+    response = client.post('/metrics/batch', json=aggregator('a', 10.0).to_dict())
+    assert response.status_code == 400
+    assert storedSnapshots(engine) == 0
+
+
+def test_oversize_batch_is_rejected(engine):
+    client = application(engine, max_batch_items=2).webserver.test_client()
+    response = client.post('/metrics/batch', json=[aggregator(f'device-{i}', 10.0).to_dict() for i in range(3)])
+    assert response.status_code == 413
+    assert storedSnapshots(engine) == 0
+
+
+def test_write_behind_full(engine):
+    app = application(engine)
+    release = threading.Event()
+    storing = threading.Event()
+
+    class blockedIngestion:
+        def ingestAggregators(self, batch):
+            storing.set()
+            release.wait()
+
+    app.writeBehind = writeBehindQueue(blockedIngestion(), app.logger, max_size=1, batch_size=1, batch_wait=0)
+    try:
+        # The writer holds one payload and the queue holds another, so the queue is full
+        assert app.writeBehind.submit(aggregator('filler', 1.0))
+        assert storing.wait(5)
+        assert app.writeBehind.submit(aggregator('filler', 2.0))
+        response = app.webserver.test_client().post('/metrics/batch', json=[aggregator('a', 10.0).to_dict(), {'name': 'no uuid'}])
+        assert response.status_code == 207
+        assert [result['code'] for result in response.json['results']] == [503, 400]
+        assert response.headers['Retry-After'] == '3'
+    finally:
+        release.set()
+        app.writeBehind.stop()
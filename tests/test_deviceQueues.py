@@ -0,0 +1,68 @@
+"""
+Tests for deviceQueues: producer threads, each the connection handler of its own devices, put
+numbered messages while a collector thread drains. Every message must be delivered or counted
+as dropped against its device, in order, and a full queue only ever drops its oldest message.
+"""
+
+import threading
+import pytest
+from deviceQueues import deviceQueues
+
+
+def test_overflow_drops_the_oldest_and_counts_it():
+    queues = deviceQueues(maxlen=3)
+    for sequence in range(5):
+        queues.put('a', sequence)
+    queues.put('b', 0)
+    assert {name: list(queue) for name, queue in queues.drain().items()} == {'a': [2, 3, 4], 'b': [0]}
+    stats = queues.stats()
+    assert (stats['received'], stats['dropped'], stats['dropped_by_device'], stats['queued']) == (6, 2, {'a': 2}, 0)
+
+
+@pytest.mark.parametrize('producers, devices, maxlen', [(8, 16, 50), (16, 8, 4)], ids=['roomy', 'overflowing'])
+def test_concurrent_producers_and_drainer(producers, devices, maxlen):
+    messages = 300
+    queues = deviceQueues(maxlen)
+    delivered = {}
+    done = threading.Event()
+    start = threading.Barrier(producers + 1)
+
+    def produce(producer: int):
+        names = [f"esp32-{producer}-{d}" for d in range(devices)]
+        start.wait()
+        for sequence in range(messages):
+            for name in names:
+                queues.put(name, sequence)
+
+    def collect():
+        start.wait()
+        while True:
+            finished = done.is_set()
+            for name, queue in queues.drain().items():
+                delivered.setdefault(name, []).extend(queue)
+            if finished:
+                return
+
+    collector = threading.Thread(target=collect)
+    threads = [threading.Thread(target=produce, args=(p,)) for p in range(producers)]
+    collector.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    collector.join()
+
+    stats = queues.stats()
+    produced = producers * devices * messages
+    assert stats['received'] == produced
+    assert sum(len(sequences) for sequences in delivered.values()) + stats['dropped'] == produced
+    assert len(delivered) == producers * devices
+    for name, sequences in delivered.items():
+        # In order and without duplicates, and the newest message is always kept
+        assert all(a < b for a, b in zip(sequences, sequences[1:])), name
+        assert sequences[-1] == messages - 1, name
+        # The per-device counter is exactly the number of messages that never arrived
+        assert stats['dropped_by_device'].get(name, 0) == messages - len(sequences), name
+    assert sum(stats['dropped_by_device'].values()) == stats['dropped']
+    assert stats['queued'] == 0
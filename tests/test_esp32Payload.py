@@ -0,0 +1,54 @@
+"""
+Tests for the ESP32 frame payloads in esp32Payload.py, binary and JSON.
+"""
+
+import json
+import math
+import pytest
+from esp32Payload import HEADER, PAYLOAD_MAGIC, READING, packReadings, parsePayload, payloadMetrics
+
+EPOCH = 1700000000
+
+
+def test_binary_round_trip():
+    payload = packReadings(EPOCH, [('gas', 412.5, 800.0), ('Alarming', 0.0, None)])
+    assert parsePayload(payload) is payload
+    timestamp, metrics = payloadMetrics(payload)
+    assert timestamp == '2023-11-14T22:13:20'
+    assert [(metric.name, metric.value, metric.threshold) for metric in metrics] == [('gas', 412.5, 800.0), ('Alarming', 0.0, None)]
+
+
+def test_nan_threshold_is_no_threshold():
+    payload = HEADER.pack(PAYLOAD_MAGIC, 1, 1, EPOCH) + READING.pack(1, 1.0, math.nan)
+    _, [metric] = payloadMetrics(parsePayload(payload))
+    assert metric.threshold is None
+
+
+def test_unknown_metric_id_is_named_by_id():
+    payload = HEADER.pack(PAYLOAD_MAGIC, 1, 2, EPOCH) + READING.pack(1, 1.0, 2.0) + READING.pack(77, 3.0, 4.0)
+    _, metrics = payloadMetrics(parsePayload(payload))
+    assert [metric.name for metric in metrics] == ['gas', 'metric_77']
+
+
+def test_unsynced_clock_has_no_timestamp():
+    timestamp, metrics = payloadMetrics(parsePayload(packReadings(0, [('gas', 1.0, None)])))
+    assert timestamp is None
+    assert len(metrics) == 1
+
+
+@pytest.mark.parametrize('payload', [
+    packReadings(EPOCH, [('gas', 1.0, None)], version=2),
+    packReadings(EPOCH, [('gas', 1.0, None)])[:-1],
+    packReadings(EPOCH, [('gas', 1.0, None)]) + b'\x00',
+    packReadings(EPOCH, [])[:HEADER.size - 1]
+], ids=['bad version', 'short', 'trailing byte', 'truncated header'])
+def test_malformed_binary_payload_is_rejected(payload):
+    with pytest.raises(ValueError):
+        parsePayload(payload)
+
+
+def test_json_payload_passes_through():
+    message = {'timestamp': '2024-01-01T00:00:00', 'gas': {'value': 412.5, 'threshold': 800}}
+    assert parsePayload(json.dumps(message).encode()) == message
+    with pytest.raises(ValueError):
+        parsePayload(b'{"gas": ')
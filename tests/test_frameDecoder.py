@@ -0,0 +1,117 @@
+"""
+Fuzz tests for frameDecoder: seeded streams of valid frames are cut at random points and merged
+into reads of random sizes, and must decode to exactly the frames sent, whatever the initial
+buffer size. Oversize, unterminated and truncated frames are checked separately.
+"""
+
+import random
+import pytest
+from frameDecoder import frameDecoder
+
+STREAMS = 3000
+BUFFER_SIZES = (16, 64, 4096)
+
+
+def buildFrame(device_name: str, payload: bytes) -> bytes:
+    return len(payload).to_bytes(4, byteorder='big') + device_name.encode() + b'\x00' + payload
+
+
+def randomFrames(rng: random.Random) -> list:
+    frames = []
+    for _ in range(rng.randint(1, 20)):
+        device_name = rng.choice(['esp32', 'sensor-1', 'gas-sensor-kitchen', 'd' * rng.randint(1, 40), 'capteur-é'])
+        # Payload sizes from empty to well past the initial buffer
+        payload = rng.randbytes(rng.choice([0, 1, rng.randint(2, 200), rng.randint(1000, 9000)]))
+        frames.append((device_name, payload))
+    return frames
+
+
+def randomReads(rng: random.Random, stream: bytes) -> list:
+    """Split the stream into reads from 1 byte up to several frames long."""
+    reads = []
+    position = 0
+    while position < len(stream):
+        size = rng.choice([1, rng.randint(2, 16), rng.randint(17, 1500), rng.randint(1500, 20000)])
+        reads.append(stream[position:position + size])
+        position += size
+    return reads
+
+
+def receive(decoder: frameDecoder, data: bytes, use_feed: bool):
+    """Copy data in the way feed() does, or the way a BufferedProtocol receives into writable()."""
+    if use_feed:
+        decoder.feed(data)
+        return
+    while data:
+        view = decoder.writable()
+        nbytes = min(len(view), len(data))
+        view[:nbytes] = data[:nbytes]
+        decoder.advance(nbytes)
+        data = data[nbytes:]
+
+
+@pytest.mark.parametrize('buffer_bytes', BUFFER_SIZES)
+def test_split_and_merged_streams_decode_to_the_frames_sent(buffer_bytes):
+    rng = random.Random(buffer_bytes)
+    for _ in range(STREAMS):
+        sent = randomFrames(rng)
+        stream = b''.join(buildFrame(device_name, payload) for device_name, payload in sent)
+        decoder = frameDecoder(buffer_bytes=buffer_bytes)
+        use_feed = rng.random() < 0.5
+        decoded = []
+        for data in randomReads(rng, stream):
+            receive(decoder, data, use_feed)
+            decoded.extend((device_name, bytes(payload)) for device_name, payload in decoder.frames())
+        assert decoded == sent
+        assert len(decoder) == 0
+
+
+def test_truncated_stream_keeps_the_partial_frame():
+    frame = buildFrame('esp32', b'{"gas": {"value": 1}}')
+    for cut in range(1, len(frame)):
+        decoder = frameDecoder(buffer_bytes=16)
+        decoder.feed(frame + frame[:cut])
+        assert [(name, bytes(payload)) for name, payload in decoder.frames()] == [('esp32', b'{"gas": {"value": 1}}')]
+        assert decoder.frames() == []
+        assert len(decoder) == cut
+        # The rest of the frame completes it
+        decoder.feed(frame[cut:])
+        assert len(decoder.frames()) == 1
+        assert len(decoder) == 0
+
+
+def test_oversize_frame_is_rejected_from_its_header():
+    decoder = frameDecoder(max_frame_bytes=1024)
+    decoder.feed(buildFrame('esp32', b'x' * 10) + (1025).to_bytes(4, byteorder='big'))
+    with pytest.raises(ValueError, match='exceeds 1024'):
+        decoder.frames()
+    # The frames before it were consumed
+    assert len(decoder) == 4
+
+
+def test_frame_at_the_limit_is_accepted():
+    decoder = frameDecoder(max_frame_bytes=1024)
+    decoder.feed(buildFrame('esp32', b'x' * 1024))
+    assert [(name, len(payload)) for name, payload in decoder.frames()] == [('esp32', 1024)]
+
+
+def test_unterminated_device_name_is_rejected():
+    decoder = frameDecoder(max_name_bytes=8)
+    decoder.feed((4).to_bytes(4, byteorder='big') + b'device-name-too-long')
+    with pytest.raises(ValueError, match='longer than 8 bytes'):
+        decoder.frames()
+
+
+def test_device_name_waits_for_its_terminator():
+    decoder = frameDecoder(max_name_bytes=8)
+    decoder.feed((2).to_bytes(4, byteorder='big') + b'esp32')
+    assert decoder.frames() == []
+    decoder.feed(b'\x00{}')
+    assert [(name, bytes(payload)) for name, payload in decoder.frames()] == [('esp32', b'{}')]
+
+
+def test_invalid_utf8_device_name_is_rejected():
+    decoder = frameDecoder()
+    decoder.feed((2).to_bytes(4, byteorder='big') + b'\xff\xfe\x00{}')
+    with pytest.raises(ValueError):
+        decoder.frames()
@@ -0,0 +1,183 @@
+"""
+Tests for ingestionManager's set-based write path and its dimension cache, on an in-memory database.
+"""
+
+import uuid
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+from dimensionCache import METRIC_TYPE
+from ingestionManager import ingestionManager
+from models import Aggregator, Base, Device, MetricType, SystemMetricSnapshot, SystemMetricValue
+from systemMetrics import DTO_Aggregator, DTO_ColumnarAggregator, DTO_DataSnapshot, DTO_Device, DTO_Metric
+
+
+@pytest.fixture
+def engine():
+    # One shared connection, so every session sees the same in-memory database
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def aggregator(guid, device_name, *values, threshold=90.0):
+    return DTO_Aggregator(guid, 'aggregator', [
+        DTO_Device(device_name, [
+            DTO_DataSnapshot(f'2024-01-01T00:00:{second:02d}', [DTO_Metric('cpu_percent', value, threshold)])
+            for second, value in enumerate(values)
+        ])
+    ])
+
+
+def test_threshold_read_before_an_update_is_not_cached(engine):
+    manager = ingestionManager(engine)
+    guid = uuid.uuid4()
+    manager.ingestAggregators([aggregator(guid, 'device', 1.0)])
+    with Session(engine) as session:
+        device_id, metric_type_id, _ = manager.lookupMetricType(session, 'device', 'cpu_percent')
+    manager.cache.clear()
+
+    with Session(engine) as session:
+        # The ingest reads the old threshold, then /threshold commits and invalidates before the ingest commits
+        manager.ingestInSession(session, [aggregator(guid, 'device', 2.0)])
+        manager.cache.invalidate(METRIC_TYPE, device_id, 'cpu_percent')
+        manager.commit(session)
+
+    assert manager.cache.get(METRIC_TYPE, device_id, 'cpu_percent') is None
+    assert manager.cache.stats()['stale_puts'] == 1
+    # Keys that were not invalidated are still cached by the same commit
+    assert manager.cache.stats()['size'] > 0
+    assert manager.updateMetricThreshold('device', 'cpu_percent', 50.0)
+    with Session(engine) as session:
+        assert manager.lookupMetricType(session, 'device', 'cpu_percent') == (device_id, metric_type_id, 50.0)
+
+
+def epoch(timestamp: str) -> int:
+    return int(datetime.fromisoformat(timestamp).timestamp())
+
+
+def multiDevicePayload(guid, name='aggregator', devices=3, snapshots=4):
+    """Every value encodes its device and snapshot, so a value stored under the wrong snapshot shows."""
+    return DTO_Aggregator(guid, name, [
+        DTO_Device(f'device-{d}', [
+            DTO_DataSnapshot(f'2024-01-01T00:{d:02d}:{s:02d}', [
+                DTO_Metric('cpu_percent', d * 100.0 + s, 90.0),
+                DTO_Metric('ram_percent', d * 100.0 + s + 0.5)
+            ])
+            for s in range(snapshots)
+        ])
+        for d in range(devices)
+    ])
+
+
+def storedValues(engine) -> list:
+    """(guid, aggregator name, device, client epoch, metric type, threshold, value) for every stored value."""
+    with Session(engine) as session:
+        return sorted(session.execute(
+            select(Aggregator.guid, Aggregator.name, Device.name, SystemMetricSnapshot.client_utc_timestamp_epoch,
+                   MetricType.metric_type, MetricType.metric_threshold, SystemMetricValue.metric_value)
+            .join(SystemMetricSnapshot, SystemMetricValue.metric_snapshot_id == SystemMetricSnapshot.metric_snapshot_id)
+            .join(MetricType, SystemMetricValue.metric_type_id == MetricType.metric_type_id)
+            .join(Device, SystemMetricSnapshot.device_id == Device.device_id)
+            .join(Aggregator, Device.aggregator_id == Aggregator.aggregator_id)
+        ).all())
+
+
+def payloadValues(*payloads) -> list:
+    return sorted(
+        (str(payload.platform_uuid), payload.name, device.name, epoch(snapshot.timestamp_utc), metric.name, metric.threshold, metric.value)
+        for payload in payloads for device in payload.devices for snapshot in device.data_snapshots for metric in snapshot.metrics
+    )
+
+
+def rowCount(engine, model) -> int:
+    with Session(engine) as session:
+        return session.scalar(select(func.count()).select_from(model))
+
+
+def test_stored_rows_match_the_payloads(engine):
+    payloads = [multiDevicePayload(uuid.uuid4(), 'first'), multiDevicePayload(uuid.uuid4(), 'second', devices=2)]
+    # One entry per cpu_percent reading at or above 90, every device but device-0
+    assert ingestionManager(engine).ingestAggregators(payloads) == [
+        ['device-1'] * 4 + ['device-2'] * 4,
+        ['device-1'] * 4
+    ]
+    assert storedValues(engine) == payloadValues(*payloads)
+    assert (rowCount(engine, Aggregator), rowCount(engine, Device), rowCount(engine, MetricType)) == (2, 5, 10)
+    assert rowCount(engine, SystemMetricSnapshot) == 20
+
+
+def test_snapshot_ids_follow_payload_order(engine):
+    payloads = [multiDevicePayload(uuid.uuid4(), 'first'), multiDevicePayload(uuid.uuid4(), 'second')]
+    ingestionManager(engine).ingestAggregators(payloads)
+    with Session(engine) as session:
+        snapshots = session.execute(
+            select(SystemMetricSnapshot.metric_snapshot_id, Aggregator.name, Device.name, SystemMetricSnapshot.client_utc_timestamp_epoch)
+            .join(Device, SystemMetricSnapshot.device_id == Device.device_id)
+            .join(Aggregator, Device.aggregator_id == Aggregator.aggregator_id)
+            .order_by(SystemMetricSnapshot.metric_snapshot_id)
+        ).all()
+        values = session.execute(select(SystemMetricValue.metric_snapshot_id, SystemMetricValue.metric_value)).all()
+    assert [row[1:] for row in snapshots] == [
+        (payload.name, device.name, epoch(snapshot.timestamp_utc))
+        for payload in payloads for device in payload.devices for snapshot in device.data_snapshots
+    ]
+    # Each value is stored under the snapshot it was reported in
+    epochs = {snapshot_id: client_epoch for snapshot_id, _, _, client_epoch in snapshots}
+    for snapshot_id, value in values:
+        assert epochs[snapshot_id] == epoch(f'2024-01-01T00:{int(value) // 100:02d}:{int(value) % 100:02d}')
+
+
+@pytest.mark.parametrize('cached', [True, False], ids=['cached', 'reselected'])
+def test_new_and_existing_dimensions_are_resolved(engine, cached):
+    guid = uuid.uuid4()
+    first = multiDevicePayload(guid, devices=2)
+    manager = ingestionManager(engine)
+    manager.ingestAggregators([first])
+    if not cached:
+        manager = ingestionManager(engine)
+
+    # Stored devices and metric types, a new device and a new metric type on a stored device
+    second = multiDevicePayload(guid, devices=3, snapshots=1)
+    second.devices[0].data_snapshots[0].metrics.append(DTO_Metric('disk_percent', 5.0))
+    manager.ingestAggregators([second])
+
+    assert (rowCount(engine, Aggregator), rowCount(engine, Device), rowCount(engine, MetricType)) == (1, 3, 7)
+    assert storedValues(engine) == payloadValues(first, second)
+
+
+def test_columnar_payloads_store_the_same_rows(engine):
+    payload = multiDevicePayload(uuid.uuid4())
+    payload.devices[1].data_snapshots[2].metrics.pop()
+    ingestionManager(engine).ingestAggregators([DTO_ColumnarAggregator.from_aggregator(payload)])
+    assert storedValues(engine) == payloadValues(payload)
+
+
+def test_critical_devices_use_the_stored_threshold(engine):
+    guid = uuid.uuid4()
+    manager = ingestionManager(engine)
+    # At the threshold is critical
+    assert manager.ingestAggregators([aggregator(guid, 'device', 89.9, 90.0, 95.0)]) == [['device', 'device']]
+    # The stored threshold wins over the one sent with the metric
+    assert manager.updateMetricThreshold('device', 'cpu_percent', 50.0)
+    assert manager.ingestAggregators([aggregator(guid, 'device', 49.9, 50.0, threshold=90.0)]) == [['device']]
+    assert manager.evaluateThresholds(aggregator(guid, 'device', 49.9, 50.0, threshold=90.0)) == ['device']
+    # A metric without a threshold is never critical
+    assert manager.ingestAggregators([aggregator(guid, 'other', 1000.0, threshold=None)]) == [[]]
+
+
+def test_ingest_each_falls_back_to_one_payload_per_transaction(engine):
+    manager = ingestionManager(engine)
+    good = [multiDevicePayload(uuid.uuid4(), 'first', devices=1), multiDevicePayload(uuid.uuid4(), 'third', devices=1)]
+    bad = aggregator(uuid.uuid4(), 'device', 1.0)
+    bad.devices[0].data_snapshots[0].metrics[0].value = 'not a number'
+
+    results = manager.ingestEach([good[0], bad, good[1]])
+
+    assert results[0] == results[2] == []
+    assert isinstance(results[1], ValueError)
+    # The failed batch left nothing behind, the good payloads were stored on their own
+    assert storedValues(engine) == payloadValues(*good)
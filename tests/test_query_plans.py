@@ -0,0 +1,129 @@
+"""
+Query plan regression tests for the indexes in models.py. A database with the tables but none of
+the indexes is migrated with migrateSchema, the hot queries are run against it and every SELECT
+they issue is checked with EXPLAIN QUERY PLAN: the metric values and dimension tables must be
+searched through an index, never scanned.
+"""
+
+import re
+import uuid
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session
+from dashboard import Dashboard
+from ingestionManager import ingestionManager
+from models import Base
+from schemaMigration import migrateSchema
+from seriesQuery import querySeries, resolveSeries
+from systemMetrics import DTO_Aggregator, DTO_DataSnapshot, DTO_Device, DTO_Metric
+
+WATCHED_TABLES = ('metric_values', 'aggregators', 'devices', 'metric_types')
+SCAN = re.compile(rf"^SCAN ({'|'.join(WATCHED_TABLES)})\b")
+SEARCH = re.compile(r"^SEARCH \w+ USING (COVERING INDEX|INDEX|INTEGER PRIMARY KEY)")
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'metrics.db'}")
+    # Tables as an old database has them, the migration has to add every index
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(text(f"DROP INDEX {index.name}"))
+    migrateSchema(engine)
+
+    aggregators = [
+        DTO_Aggregator(uuid.uuid4(), f"aggregator-{a}", [
+            DTO_Device(f"device-{d}", [
+                DTO_DataSnapshot(metrics=[DTO_Metric('cpu_percent', float(s), 90.0), DTO_Metric('ram_percent', float(s))])
+                for s in range(3)
+            ])
+            for d in range(4)
+        ])
+        for a in range(3)
+    ]
+    ingestionManager(engine).ingestAggregators(aggregators)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def selects(engine):
+    """Collects (statement, parameters) for every SELECT run on the engine."""
+    captured = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            captured.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    yield captured
+    event.remove(engine, 'before_cursor_execute', capture)
+
+
+def queryPlan(engine, statement, parameters) -> list:
+    with engine.connect() as connection:
+        return [row[3] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+
+def assertIndexed(engine, captured):
+    assert captured, "No SELECT statements were run"
+    for statement, parameters in captured:
+        plan = queryPlan(engine, statement, parameters)
+        scans = [step for step in plan if SCAN.match(step)]
+        assert not scans, f"Full scan {scans} in plan {plan} for {statement}"
+        assert any(SEARCH.match(step) for step in plan), f"No index search in plan {plan} for {statement}"
+
+
+def test_ingestion_resolves_new_dimensions_through_indexes(engine, selects):
+    payload = DTO_Aggregator(uuid.uuid4(), 'aggregator-new', [
+        DTO_Device('device-new', [DTO_DataSnapshot(metrics=[DTO_Metric('cpu_percent', 1.0, 90.0)])])
+    ])
+    ingestionManager(engine).ingestAggregators([payload])
+    assertIndexed(engine, selects)
+
+
+def test_ingestion_reselects_stored_dimensions_through_indexes(engine, selects):
+    # A fresh manager has an empty dimension cache, so every stored row is selected again
+    manager = ingestionManager(engine)
+    with Session(engine) as session:
+        aggregator_ids = manager.selectAggregators(session, [guid for guid, in session.execute(text('SELECT guid FROM aggregators'))])
+        device_ids = manager.selectDevices(session, {(aggregator_id, 'device-1') for aggregator_id in aggregator_ids.values()})
+        manager.selectMetricTypes(session, {(device_id, 'cpu_percent') for device_id in device_ids.values()})
+        assert manager.lookupMetricType(session, 'device-2', 'ram_percent') is not None
+    assertIndexed(engine, [select for select in selects if 'SELECT guid FROM aggregators' not in select[0]])
+
+
+@pytest.mark.parametrize('span_seconds', [600, 30 * 86400], ids=['raw', 'rollup'])
+def test_query_series_uses_indexes(engine, selects, span_seconds):
+    with Session(engine) as session:
+        metric_type_ids = resolveSeries(session, [('device-0', 'cpu_percent'), ('device-3', 'ram_percent')])
+        assert len(metric_type_ids) == 2
+        end_epoch = 2 ** 31 - 1
+        # A heartbeat also runs the carried value lookup before the range
+        heartbeats = {metric_type_id: 60.0 for metric_type_id in metric_type_ids.values()}
+        querySeries(session, metric_type_ids.values(), end_epoch - span_seconds, end_epoch, heartbeats=heartbeats)
+    assertIndexed(engine, selects)
+
+
+def test_dashboard_latest_readings_use_indexes(engine, selects):
+    dashboard = Dashboard()
+    with Session(engine) as session:
+        metric_type_ids = dashboard.resolve_metric_types(session, ['cpu_percent', 'ram_percent'])
+        series = dashboard.query_latest(session, metric_type_ids.values())
+    assert all(values for _, values, _ in series.values())
+    assertIndexed(engine, selects)
+
+
+def test_dashboard_readings_past_a_cursor_use_indexes(engine, selects):
+    dashboard = Dashboard()
+    with Session(engine) as session:
+        metric_type_ids = dashboard.resolve_metric_types(session, ['cpu_percent', 'ram_percent'])
+        latest = dashboard.query_latest(session, metric_type_ids.values())
+        after = {metric_type_id: snapshot_ids[-2] for metric_type_id, (_, _, snapshot_ids) in latest.items()}
+        series = dashboard.query_latest(session, after.keys(), after=after)
+    assert {metric_type_id: snapshot_ids for metric_type_id, (_, _, snapshot_ids) in series.items()} == {
+        metric_type_id: snapshot_ids[-1:] for metric_type_id, (_, _, snapshot_ids) in latest.items()
+    }
+    assertIndexed(engine, selects)
@@ -0,0 +1,72 @@
+"""
+Tests for uploadSpool's pending count and disk budget, which are kept incrementally and must
+always match what a fresh spool counts from the files on disk.
+"""
+
+import os
+import random
+from uploadSpool import SEGMENT_SUFFIX, uploadSpool
+
+RECORD = b'x' * 92  # 100 bytes with the record header
+
+
+def pendingOnDisk(spool: uploadSpool) -> int:
+    """The pending count of the spool opened afresh from its files."""
+    spool.writer.flush()
+    reopened = uploadSpool(spool.directory, spool.segment_bytes, spool.max_bytes)
+    reopened.writer.close()
+    return len(reopened)
+
+
+def segmentFileBytes(directory) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+def test_eviction_of_a_partly_committed_segment(tmp_path):
+    spool = uploadSpool(str(tmp_path), segment_bytes=500, max_bytes=1000)
+    for _ in range(5):
+        spool.append(RECORD)
+    spool.commit(spool.peek(2)[-1][1])
+    assert len(spool) == 3
+    # Rolls over into a third segment and evicts the first, of which only 3 records were unsent
+    for _ in range(6):
+        spool.append(RECORD)
+    assert spool.evicted_records == 3
+    assert len(spool) == 6
+    assert pendingOnDisk(spool) == 6
+
+
+def test_commit_of_a_batch_spanning_an_evicted_segment(tmp_path):
+    spool = uploadSpool(str(tmp_path), segment_bytes=500, max_bytes=1000)
+    for _ in range(7):
+        spool.append(RECORD)
+    spool.commit(spool.peek(2)[-1][1])
+    # The last three records of the first segment and the first two of the second
+    batch = spool.peek(5)
+    assert [cursor[0] for _, cursor in batch] == [0, 0, 0, 1, 1]
+    for _ in range(4):
+        spool.append(RECORD)
+    assert spool.evicted_records == 3
+    assert len(spool) == 6
+    # Only the two records still on disk are acknowledged
+    spool.commit(batch[-1][1])
+    assert len(spool) == pendingOnDisk(spool) == 4
+
+
+def test_pending_and_disk_bytes_match_the_files(tmp_path):
+    rng = random.Random(7)
+    spool = uploadSpool(str(tmp_path), segment_bytes=700, max_bytes=2500)
+    batch = []
+    for _ in range(3000):
+        action = rng.random()
+        if action < 0.6:
+            spool.append(rng.randbytes(rng.randint(1, 300)))
+        elif action < 0.8 or not batch:
+            batch = spool.peek(rng.randint(1, 12))
+        else:
+            # Commit a prefix of a batch taken earlier, possibly since evicted
+            spool.commit(batch[rng.randrange(len(batch))][1])
+            batch = []
+        stats = spool.stats()
+        assert stats['disk_bytes'] == segmentFileBytes(tmp_path)
+        assert stats['pending'] == pendingOnDisk(spool) == len(spool.peek(10 ** 6))
@@ -0,0 +1,62 @@
+"""
+Tests for windowAggregator: the P-square p95 estimate, breach forwarding and window timestamps.
+"""
+
+import random
+import time
+from datetime import datetime
+import pytest
+from systemMetrics import DTO_DataSnapshot, DTO_Metric
+from windowAggregator import EXACT_SAMPLES, quantileEstimator, windowAggregator
+
+
+def exactPercentile(values, quantile: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(quantile * len(ordered)), len(ordered) - 1)]
+
+
+@pytest.mark.parametrize('samples', [EXACT_SAMPLES // 2, EXACT_SAMPLES, 20 * EXACT_SAMPLES, 200 * EXACT_SAMPLES])
+@pytest.mark.parametrize('distribution', ['uniform', 'gauss', 'exponential'])
+def test_p95_matches_the_exact_percentile(samples, distribution):
+    rng = random.Random(samples)
+    draw = {
+        'uniform': lambda: rng.uniform(0, 100),
+        'gauss': lambda: rng.gauss(50, 10),
+        'exponential': lambda: rng.expovariate(0.1)
+    }[distribution]
+    values = [draw() for _ in range(samples)]
+    estimator = quantileEstimator(0.95)
+    for value in values:
+        estimator.add(value)
+    exact = exactPercentile(values, 0.95)
+    if samples < EXACT_SAMPLES:
+        assert estimator.value() == exact
+    else:
+        # Within 2% of the spread of the stream
+        assert abs(estimator.value() - exact) <= 0.02 * (max(values) - min(values)), (estimator.value(), exact)
+
+
+def test_breach_is_forwarded_with_the_threshold_of_an_earlier_sample():
+    window = windowAggregator(60)
+    assert window.add([DTO_DataSnapshot('2024-01-01T00:00:00', [DTO_Metric('cpu_percent', 10.0, 90.0)], 'device')]) == []
+    [breach] = window.add([DTO_DataSnapshot('2024-01-01T00:00:01', [DTO_Metric('cpu_percent', 95.0)], 'device')])
+    assert [(metric.name, metric.value, metric.threshold) for metric in breach.metrics] == [('cpu_percent', 95.0, 90.0)]
+
+
+def test_late_flush_is_stamped_with_the_window_end():
+    window = windowAggregator(60)
+    window.add([DTO_DataSnapshot('2024-01-01T00:00:00', [DTO_Metric('cpu_percent', 10.0)], 'device')])
+    # The window closed 130 seconds before this flush
+    window.window_end = time.monotonic() - 130
+    [summary] = window.flush()
+    lag = datetime.now() - datetime.fromisoformat(summary.timestamp_utc)
+    assert 129 <= lag.total_seconds() <= 132
+    # The next window stays on the grid, 50 seconds from now
+    assert 49 <= window.window_end - time.monotonic() <= 50
+
+
+def test_forced_flush_is_stamped_now():
+    window = windowAggregator(60)
+    window.add([DTO_DataSnapshot('2024-01-01T00:00:00', [DTO_Metric('cpu_percent', 10.0)], 'device')])
+    [summary] = window.flush(force=True)
+    assert abs((datetime.now() - datetime.fromisoformat(summary.timestamp_utc)).total_seconds()) <= 2
@@ -0,0 +1,77 @@
+"""
+Tests for the binary upload format in wireFormat.py.
+"""
+
+import uuid
+from datetime import datetime
+import pytest
+from systemMetrics import DTO_Aggregator, DTO_DataSnapshot, DTO_Device, DTO_Metric
+from wireFormat import isBinary, packAggregator, packBatch, unpackAggregator, unpackBatch
+
+
+def aggregator(heartbeat_seconds=None):
+    return DTO_Aggregator(uuid.UUID(int=7), 'aggregator', [
+        DTO_Device('device-0', [
+            DTO_DataSnapshot(datetime(2024, 1, 1, 12, 0, 0), [DTO_Metric('cpu_percent', 12.5, 90.0), DTO_Metric('ram_percent', 40.0)]),
+            DTO_DataSnapshot('2024-01-01T12:00:10', [DTO_Metric('cpu_percent', 13.5, 90.0)])
+        ]),
+        DTO_Device('device-1', [])
+    ], heartbeat_seconds)
+
+
+def asTuples(payload: DTO_Aggregator):
+    return str(payload.platform_uuid), payload.name, payload.heartbeat_seconds, [
+        (device.name, [
+            (snapshot.timestamp_utc, [(metric.name, metric.value, metric.threshold) for metric in snapshot.metrics])
+            for snapshot in device.data_snapshots
+        ])
+        for device in payload.devices
+    ]
+
+
+@pytest.mark.parametrize('heartbeat_seconds, version', [(None, 1), (60.0, 2)])
+def test_round_trip(heartbeat_seconds, version):
+    payload = packAggregator(aggregator(heartbeat_seconds))
+    assert isBinary(payload) and payload[2] == version
+    decoded = unpackAggregator(payload)
+    # str and datetime timestamps both come back as datetimes
+    assert asTuples(decoded) == (str(uuid.UUID(int=7)), 'aggregator', heartbeat_seconds, [
+        ('device-0', [
+            (datetime(2024, 1, 1, 12, 0, 0), [('cpu_percent', 12.5, 90.0), ('ram_percent', 40.0, None)]),
+            (datetime(2024, 1, 1, 12, 0, 10), [('cpu_percent', 13.5, 90.0)])
+        ]),
+        ('device-1', [])
+    ])
+
+
+def test_nan_threshold_is_no_threshold():
+    payload = aggregator()
+    payload.devices[0].data_snapshots[0].metrics[0].threshold = float('nan')
+    assert unpackAggregator(packAggregator(payload)).devices[0].data_snapshots[0].metrics[0].threshold is None
+
+
+@pytest.mark.parametrize('heartbeat_seconds', [None, 60.0])
+def test_truncated_or_trailing_bytes_are_rejected(heartbeat_seconds):
+    payload = packAggregator(aggregator(heartbeat_seconds))
+    for end in range(len(payload)):
+        with pytest.raises(ValueError):
+            unpackAggregator(payload[:end])
+    with pytest.raises(ValueError):
+        unpackAggregator(payload + b'\x00')
+
+
+def test_unknown_version_is_rejected():
+    payload = bytearray(packAggregator(aggregator()))
+    payload[2] = 9
+    with pytest.raises(ValueError):
+        unpackAggregator(bytes(payload))
+
+
+def test_batch_splitting():
+    payloads = [packAggregator(aggregator()), packAggregator(aggregator(30.0)), b'']
+    batch = packBatch(payloads)
+    assert [bytes(payload) for payload in unpackBatch(batch)] == payloads
+    assert unpackBatch(b'') == []
+    for end in (2, len(batch) - 5):
+        with pytest.raises(ValueError):
+            unpackBatch(batch[:end])
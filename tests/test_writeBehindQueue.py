@@ -0,0 +1,46 @@
+"""
+Tests for writeBehindQueue shutdown: every payload submit accepted is stored, none are
+accepted once stop has begun.
+"""
+
+import threading
+import time
+from writeBehindQueue import writeBehindQueue
+
+
+class recordingIngestion:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.stored = []
+
+    def ingestAggregators(self, batch):
+        time.sleep(self.delay)
+        self.stored.extend(batch)
+        return [[] for _ in batch]
+
+
+def test_submit_after_stop_is_refused():
+    ingestion = recordingIngestion()
+    writer = writeBehindQueue(ingestion, batch_wait=0)
+    assert writer.submit('before')
+    writer.stop()
+    assert not writer.submit('after')
+    assert ingestion.stored == ['before']
+
+
+def test_stop_during_submit_waits_for_the_payload():
+    ingestion = recordingIngestion()
+    writer = writeBehindQueue(ingestion, batch_wait=0)
+    stopper = threading.Thread(target=writer.stop)
+    put_nowait = writer.queue.put_nowait
+
+    def stopThenPut(item):
+        # stop() arrives between submit's stopping check and its put, give the writer time to exit
+        stopper.start()
+        writer.writer.join(1.0)
+        put_nowait(item)
+
+    writer.queue.put_nowait = stopThenPut
+    assert writer.submit('racing')
+    stopper.join()
+    assert ingestion.stored == ['racing']
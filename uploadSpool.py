@@ -0,0 +1,207 @@
+"""
+Library module for the client's durable upload spool.
+Payloads are appended as length and CRC prefixed records to sequential segment files. A separately
+persisted read offset marks what has been uploaded, so queued payloads survive restarts, and the
+oldest segments are evicted once the spool exceeds its disk budget. Record counts and sizes are
+kept per segment, so the pending count and the disk budget never need the segments re-read.
+"""
+
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+# Record header: payload length and CRC32 of the payload, both big-endian
+RECORD_HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.seg'
+OFFSET_FILE = 'offset.json'
+
+
+class uploadSpool:
+    def __init__(self, directory: str, segment_bytes: int = 1048576, max_bytes: int = 67108864, fsync: bool = False, logger=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.logger = logger or logging.getLogger()
+        self.lock = threading.Lock()
+        self.evicted_segments = 0
+        self.evicted_records = 0
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+        self.read_segment, self.read_position = self.loadOffset()
+        if not self.segments:
+            self.segments.append(0)
+            open(self.segmentPath(0), 'ab').close()
+        self.recoverTail()
+        if self.read_segment not in self.segments:
+            self.read_segment, self.read_position = self.segments[0], 0
+        # Per segment record count and size in bytes
+        self.segment_records = {}
+        self.segment_sizes = {}
+        for segment in self.segments:
+            self.segment_records[segment], self.segment_sizes[segment] = self.scanSegment(segment)
+        self.disk_bytes = sum(self.segment_sizes.values())
+        # Records of the read segment before read_position
+        self.read_index = self.recordsBefore(self.read_segment, self.read_position)
+        self.pending = sum(self.segment_records.values()) - self.read_index - sum(
+            self.segment_records[segment] for segment in self.segments if segment < self.read_segment
+        )
+        self.writer = open(self.segmentPath(self.segments[-1]), 'ab')
+
+    def segmentPath(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{segment:012d}{SEGMENT_SUFFIX}')
+
+    def loadOffset(self):
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as f:
+                offset = json.load(f)
+            return offset['segment'], offset['position']
+        except (OSError, ValueError, KeyError):
+            return (self.segments[0] if self.segments else 0), 0
+
+    def saveOffset(self):
+        # Written to a temporary file and renamed so a crash never leaves a torn offset
+        path = os.path.join(self.directory, OFFSET_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'segment': self.read_segment, 'position': self.read_position}, f)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def recoverTail(self):
+        """Truncate a partially written record left at the end of the newest segment by a crash."""
+        path = self.segmentPath(self.segments[-1])
+        valid_end = 0
+        with open(path, 'rb') as f:
+            for _, end in self.readRecords(f, 0):
+                valid_end = end
+        if valid_end != os.path.getsize(path):
+            self.logger.warning("Truncating %s bytes of partial record from spool segment %s", os.path.getsize(path) - valid_end, path)
+            with open(path, 'r+b') as f:
+                f.truncate(valid_end)
+
+    def scanSegment(self, segment: int):
+        """(records, bytes) of a segment, read once when the spool is opened."""
+        with open(self.segmentPath(segment), 'rb') as f:
+            return sum(1 for _ in self.readRecords(f, 0)), os.path.getsize(self.segmentPath(segment))
+
+    def recordsBefore(self, segment: int, position: int) -> int:
+        with open(self.segmentPath(segment), 'rb') as f:
+            return sum(1 for _, end in self.readRecords(f, 0) if end <= position)
+
+    def unreadRecords(self, segment: int) -> int:
+        if segment < self.read_segment:
+            return 0
+        return self.segment_records[segment] - (self.read_index if segment == self.read_segment else 0)
+
+    @staticmethod
+    def readRecords(f, position: int):
+        """Yield (payload bytes, end position) for each intact record from position onwards."""
+        f.seek(position)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                return
+            position += RECORD_HEADER.size + length
+            yield payload, position
+
+    def append(self, data: bytes):
+        """Append one encoded payload."""
+        with self.lock:
+            self.writer.write(RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data)
+            self.writer.flush()
+            if self.fsync:
+                os.fsync(self.writer.fileno())
+            segment = self.segments[-1]
+            self.segment_records[segment] += 1
+            self.segment_sizes[segment] += RECORD_HEADER.size + len(data)
+            self.disk_bytes += RECORD_HEADER.size + len(data)
+            self.pending += 1
+            if self.writer.tell() >= self.segment_bytes:
+                self.rotate()
+            self.enforceBudget()
+
+    def rotate(self):
+        self.writer.close()
+        segment = self.segments[-1] + 1
+        self.segments.append(segment)
+        self.segment_records[segment] = self.segment_sizes[segment] = 0
+        self.writer = open(self.segmentPath(segment), 'ab')
+
+    def enforceBudget(self):
+        """Evict the oldest sealed segments, unread or not, while the spool is over its disk budget."""
+        while len(self.segments) > 1 and self.disk_bytes > self.max_bytes:
+            oldest = self.segments[0]
+            # Only the records past the read offset were still pending
+            evicted = self.unreadRecords(oldest)
+            self.removeSegment(oldest)
+            self.evicted_segments += 1
+            self.evicted_records += evicted
+            self.pending -= evicted
+            self.logger.warning("Upload spool over %s bytes, evicted oldest segment %s with %s unsent snapshots", self.max_bytes, oldest, evicted)
+            if self.read_segment <= oldest:
+                self.read_segment, self.read_position, self.read_index = self.segments[0], 0, 0
+                self.saveOffset()
+
+    def removeSegment(self, segment: int):
+        self.segments.remove(segment)
+        self.disk_bytes -= self.segment_sizes.pop(segment)
+        del self.segment_records[segment]
+        os.remove(self.segmentPath(segment))
+
+    def peek(self, max_records: int):
+        """
+        Return up to max_records of the oldest unsent payloads as (bytes, cursor) pairs.
+        Passing a cursor to commit acknowledges its payload and every one before it.
+        A cursor is (segment, end position, records of the segment up to and including it).
+        """
+        with self.lock:
+            self.writer.flush()
+            records = []
+            position, index = self.read_position, self.read_index
+            for segment in self.segments[self.segments.index(self.read_segment):]:
+                with open(self.segmentPath(segment), 'rb') as f:
+                    for payload, end in self.readRecords(f, position):
+                        index += 1
+                        records.append((payload, (segment, end, index)))
+                        if len(records) >= max_records:
+                            return records
+                position = index = 0
+            return records
+
+    def commit(self, cursor):
+        """Acknowledge the payloads up to cursor and delete fully consumed segments."""
+        with self.lock:
+            segment, position, index = cursor
+            if segment < self.read_segment or (segment == self.read_segment and index <= self.read_index):
+                # Evicted while the batch was in flight, eviction already moved the offset past it
+                return
+            # Part of the batch may have been in segments evicted meanwhile, those are no longer pending
+            committed = sum(self.unreadRecords(s) for s in self.segments if self.read_segment <= s < segment)
+            committed += index - (self.read_index if segment == self.read_segment else 0)
+            self.read_segment, self.read_position, self.read_index = segment, position, index
+            self.pending -= committed
+            self.saveOffset()
+            while len(self.segments) > 1 and self.segments[0] < self.read_segment:
+                self.removeSegment(self.segments[0])
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'pending': self.pending,
+                'segments': len(self.segments),
+                'disk_bytes': self.disk_bytes,
+                'evicted_segments': self.evicted_segments,
+                'evicted_records': self.evicted_records
+            }
+
+    def __len__(self):
+        return self.pending
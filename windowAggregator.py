@@ -0,0 +1,201 @@
+"""
+Library module for the client's optional windowed pre-aggregation.
+Raw samples are folded into streaming per device, per metric accumulators and only a summary
+per window is uploaded: the mean under the metric's own name, plus <name>_min, _max, _p95,
+_last and _count as configured. Every accumulator has constant memory, p95 is estimated with
+the P-square algorithm (Jain and Chlamtac, 1985). Samples at or above their threshold are also
+returned for immediate upload, so alerts do not wait for the window to close.
+"""
+
+import threading
+import time
+from bisect import insort
+from datetime import datetime
+from systemMetrics import DTO_DataSnapshot, DTO_Metric
+
+STATISTICS = ('mean', 'min', 'max', 'p95', 'last', 'count')
+# Samples per series kept for an exact quantile before switching to the P-square estimate
+EXACT_SAMPLES = 64
+
+
+class quantileEstimator:
+    """
+    Quantile of a stream in bounded memory. The first EXACT_SAMPLES values are kept sorted and
+    give an exact answer, after that five P-square markers seeded from them track the estimate.
+    """
+    __slots__ = ('quantile', 'count', 'heights', 'positions', 'desired', 'increments')
+
+    def __init__(self, quantile: float):
+        self.quantile = quantile
+        self.count = 0
+        self.heights = []
+        self.positions = None
+        self.desired = None
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value: float):
+        self.count += 1
+        heights = self.heights
+        if self.positions is None:
+            insort(heights, value)
+            if self.count == EXACT_SAMPLES:
+                self.seedMarkers()
+            return
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        positions = self.positions
+        for marker in range(cell + 1, 5):
+            positions[marker] += 1
+        for marker in range(5):
+            self.desired[marker] += self.increments[marker]
+        for marker in (1, 2, 3):
+            offset = self.desired[marker] - positions[marker]
+            if (offset >= 1 and positions[marker + 1] - positions[marker] > 1) or (offset <= -1 and positions[marker - 1] - positions[marker] < -1):
+                step = 1 if offset > 0 else -1
+                height = self.parabolic(marker, step)
+                if not heights[marker - 1] < height < heights[marker + 1]:
+                    height = heights[marker] + step * (heights[marker + step] - heights[marker]) / (positions[marker + step] - positions[marker])
+                heights[marker] = height
+                positions[marker] += step
+
+    def seedMarkers(self):
+        """Replace the sorted samples with five markers at the minimum, quantile/2, quantile, (1+quantile)/2 and maximum."""
+        samples = self.heights
+        self.desired = [1 + (self.count - 1) * increment for increment in self.increments]
+        self.positions = [round(desired) for desired in self.desired]
+        self.heights = [samples[position - 1] for position in self.positions]
+
+    def parabolic(self, marker: int, step: int) -> float:
+        heights, positions = self.heights, self.positions
+        below = positions[marker] - positions[marker - 1]
+        above = positions[marker + 1] - positions[marker]
+        return heights[marker] + step / (positions[marker + 1] - positions[marker - 1]) * (
+            (below + step) * (heights[marker + 1] - heights[marker]) / above
+            + (above - step) * (heights[marker] - heights[marker - 1]) / below
+        )
+
+    def value(self) -> float:
+        if self.positions is not None:
+            return self.heights[2]
+        return self.heights[min(int(self.quantile * self.count), self.count - 1)]
+
+
+class seriesSummary:
+    __slots__ = ('count', 'total', 'minimum', 'maximum', 'last', 'threshold', 'p95')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.last = None
+        self.threshold = None
+        self.p95 = quantileEstimator(0.95)
+
+    def add(self, value: float, threshold: float):
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None or value < self.minimum else self.minimum
+        self.maximum = value if self.maximum is None or value > self.maximum else self.maximum
+        self.last = value
+        if threshold is not None:
+            self.threshold = threshold
+        self.p95.add(value)
+
+    def metrics(self, name: str, statistics) -> list:
+        values = {
+            'mean': self.total / self.count,
+            'min': self.minimum,
+            'max': self.maximum,
+            'p95': self.p95.value(),
+            'last': self.last,
+            'count': float(self.count)
+        }
+        return [
+            DTO_Metric(
+                name=name if statistic == 'mean' else f"{name}_{statistic}",
+                value=values[statistic],
+                # The stored threshold applies to the mean, breaches are forwarded as raw samples
+                threshold=self.threshold if statistic == 'mean' else None
+            ) for statistic in statistics
+        ]
+
+
+class windowAggregator:
+    def __init__(self, window_seconds: float, statistics=STATISTICS, forward_breaches: bool = True):
+        unknown = set(statistics) - set(STATISTICS)
+        if unknown:
+            raise ValueError(f"Unknown window statistics {', '.join(sorted(unknown))}, expected some of {', '.join(STATISTICS)}")
+        self.window_seconds = window_seconds
+        self.statistics = list(statistics)
+        self.forward_breaches = forward_breaches
+        self.lock = threading.Lock()
+        # device_name -> {metric name -> seriesSummary}
+        self.devices = {}
+        self.window_end = time.monotonic() + window_seconds
+        self.samples = 0
+        self.summaries = 0
+        self.breaches = 0
+
+    def add(self, snapshots) -> list:
+        """Fold raw snapshots into the window. Returns the snapshots carrying a threshold breach, breaching metrics only."""
+        breaching = []
+        with self.lock:
+            for snapshot in snapshots:
+                series = self.devices.setdefault(snapshot.device_name, {})
+                breached = []
+                for metric in snapshot.metrics:
+                    summary = series.get(metric.name)
+                    if summary is None:
+                        summary = series[metric.name] = seriesSummary()
+                    value = float(metric.value)
+                    summary.add(value, metric.threshold)
+                    self.samples += 1
+                    # The threshold may have come with an earlier sample, the breach is checked and sent with it
+                    if self.forward_breaches and summary.threshold and value >= summary.threshold:
+                        breached.append(DTO_Metric(name=metric.name, value=value, threshold=summary.threshold))
+                if breached:
+                    self.breaches += len(breached)
+                    breaching.append(DTO_DataSnapshot(timestamp_utc=snapshot.timestamp_utc, metrics=breached, device_name=snapshot.device_name))
+        return breaching
+
+    def flush(self, force: bool = False) -> list:
+        """Return one summary snapshot per device once the window has closed (or when forced), and start the next window."""
+        now = time.monotonic()
+        if not force and now < self.window_end:
+            return []
+        with self.lock:
+            devices, self.devices = self.devices, {}
+            # Summaries are stamped with the end of their window, not the time of a late flush.
+            # A forced flush closes the window early, at now.
+            closed_at = time.time() - (now - min(self.window_end, now))
+            timestamp = datetime.fromtimestamp(closed_at).strftime('%Y-%m-%dT%H:%M:%S')
+            # Windows stay on a fixed grid, a late flush does not shift the following ones
+            self.window_end += self.window_seconds * max(1, int((now - self.window_end) // self.window_seconds) + 1)
+            snapshots = []
+            for device_name, series in devices.items():
+                metrics = []
+                for name, summary in series.items():
+                    metrics.extend(summary.metrics(name, self.statistics))
+                if metrics:
+                    snapshots.append(DTO_DataSnapshot(timestamp_utc=timestamp, metrics=metrics, device_name=device_name))
+            self.summaries += len(snapshots)
+            return snapshots
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'window_seconds': self.window_seconds,
+                'samples': self.samples,
+                'summaries': self.summaries,
+                'breaches_forwarded': self.breaches,
+                'open_series': sum(len(series) for series in self.devices.values())
+            }
@@ -0,0 +1,163 @@
+"""
+Library module for the upload wire formats, negotiated through the request Content-Type.
+JSON is the default, either one object per snapshot or, with the columnar layout, one metric
+name dictionary and parallel epoch and value arrays per device (see DTO_ColumnarDevice).
+The binary format is a struct-packed, little-endian encoding of one DTO_Aggregator, and a
+binary batch is a sequence of uint32 length prefixed payloads.
+
+Binary payload layout, strings are stored once and referenced by index. Version 2 is written
+only for payloads reported on change, so it also carries their heartbeat:
+    magic b'SM' | version u8 | string count u16 | string count x (utf-8 length u16 | bytes)
+    platform uuid index u16 | name index u16 | device count u16 | heartbeat seconds f64 (version 2 only)
+    device:   name index u16 | snapshot count u32
+    snapshot: client epoch f64 | metric count u16 | metric count x metric
+    metric:   name index u16 | value f64 | threshold f64 (NaN when absent)
+"""
+
+import json
+import struct
+from datetime import datetime
+from systemMetrics import DTO_Aggregator, DTO_ColumnarAggregator, DTO_DataSnapshot, DTO_Device, DTO_Metric
+
+JSON_CONTENT_TYPE = 'application/json'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+BINARY_CONTENT_TYPE = 'application/x-metrics-binary'
+BINARY_BATCH_CONTENT_TYPE = 'application/x-metrics-binary-batch'
+BINARY_MAGIC = b'SM'
+BINARY_VERSIONS = (1, 2)
+
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+HEADER = struct.Struct('<HHH')
+F64 = struct.Struct('<d')
+DEVICE_HEADER = struct.Struct('<HI')
+SNAPSHOT_HEADER = struct.Struct('<dH')
+METRIC = struct.Struct('<Hdd')
+NAN = float('nan')
+
+
+def encodePayload(aggregator: DTO_Aggregator, wire_format: str = 'json') -> bytes:
+    """Encode a payload as "json", "columnar" (JSON) or "binary"."""
+    if wire_format == 'binary':
+        return packAggregator(aggregator)
+    if wire_format == 'columnar':
+        aggregator = DTO_ColumnarAggregator.from_aggregator(aggregator)
+    return json.dumps(aggregator.to_dict(), separators=(',', ':')).encode()
+
+
+def decodeJsonPayload(data: dict):
+    """Decode a parsed JSON payload of either layout."""
+    if data.get('layout') == 'columnar':
+        return DTO_ColumnarAggregator.from_dict(data)
+    return DTO_Aggregator.from_dict(data)
+
+
+def isBinary(payload: bytes) -> bool:
+    return payload[:2] == BINARY_MAGIC and len(payload) > 2 and payload[2] in BINARY_VERSIONS
+
+
+def packAggregator(aggregator: DTO_Aggregator) -> bytes:
+    strings = {}
+
+    def index(value):
+        position = strings.get(value)
+        if position is None:
+            position = strings[value] = len(strings)
+        return position
+
+    body = [HEADER.pack(index(str(aggregator.platform_uuid)), index(aggregator.name), len(aggregator.devices))]
+    append = body.append
+    version = 1
+    if aggregator.heartbeat_seconds is not None:
+        version = 2
+        append(F64.pack(aggregator.heartbeat_seconds))
+    pack_metric = METRIC.pack
+    for device in aggregator.devices:
+        append(DEVICE_HEADER.pack(index(device.name), len(device.data_snapshots)))
+        for snapshot in device.data_snapshots:
+            timestamp = snapshot.timestamp_utc
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp)
+            append(SNAPSHOT_HEADER.pack(timestamp.timestamp(), len(snapshot.metrics)))
+            for metric in snapshot.metrics:
+                append(pack_metric(index(metric.name), metric.value, NAN if metric.threshold is None else metric.threshold))
+    table = [BINARY_MAGIC, bytes((version,)), U16.pack(len(strings))]
+    for value in strings:
+        encoded = value.encode()
+        table.append(U16.pack(len(encoded)))
+        table.append(encoded)
+    return b''.join(table + body)
+
+
+def unpackAggregator(data) -> DTO_Aggregator:
+    """Decode one binary payload. Raises ValueError if it is truncated or not a binary payload."""
+    view = memoryview(data)
+    if not isBinary(view[:3]):
+        raise ValueError("Not a binary metrics payload")
+    version = view[2]
+    metric_size = METRIC.size
+    iter_metrics = METRIC.iter_unpack
+    unpack_snapshot = SNAPSHOT_HEADER.unpack_from
+    fromtimestamp = datetime.fromtimestamp
+    try:
+        string_count, = U16.unpack_from(view, 3)
+        offset = 5
+        strings = []
+        for _ in range(string_count):
+            length, = U16.unpack_from(view, offset)
+            if offset + 2 + length > len(view):
+                raise ValueError("Truncated binary metrics payload")
+            strings.append(str(view[offset + 2:offset + 2 + length], 'utf-8'))
+            offset += 2 + length
+        uuid_index, name_index, device_count = HEADER.unpack_from(view, offset)
+        offset += HEADER.size
+        heartbeat_seconds = None
+        if version == 2:
+            heartbeat_seconds, = F64.unpack_from(view, offset)
+            offset += F64.size
+        devices = []
+        for _ in range(device_count):
+            device_index, snapshot_count = DEVICE_HEADER.unpack_from(view, offset)
+            offset += DEVICE_HEADER.size
+            snapshots = []
+            for _ in range(snapshot_count):
+                epoch, metric_count = unpack_snapshot(view, offset)
+                offset += SNAPSHOT_HEADER.size
+                end = offset + metric_count * metric_size
+                if end > len(view):
+                    raise ValueError("Truncated binary metrics payload")
+                # NaN is the only value not equal to itself
+                metrics = [
+                    DTO_Metric(strings[name], value, threshold if threshold == threshold else None)
+                    for name, value, threshold in iter_metrics(view[offset:end])
+                ]
+                offset = end
+                snapshots.append(DTO_DataSnapshot(fromtimestamp(epoch), metrics))
+            devices.append(DTO_Device(strings[device_index], snapshots))
+        aggregator = DTO_Aggregator(strings[uuid_index], strings[name_index], devices, heartbeat_seconds)
+    except (struct.error, IndexError, OverflowError, OSError) as e:
+        raise ValueError(f"Malformed binary metrics payload: {e}") from None
+    if offset != len(view):
+        raise ValueError(f"{len(view) - offset} trailing bytes after binary metrics payload")
+    return aggregator
+
+
+def packBatch(payloads) -> bytes:
+    return b''.join(U32.pack(len(payload)) + payload for payload in payloads)
+
+
+def unpackBatch(data):
+    """Split a binary batch into its payloads, as memoryviews into data."""
+    view = memoryview(data)
+    payloads = []
+    offset = 0
+    while offset < len(view):
+        if offset + 4 > len(view):
+            raise ValueError("Truncated binary batch")
+        length, = U32.unpack_from(view, offset)
+        offset += 4
+        if offset + length > len(view):
+            raise ValueError("Truncated binary batch")
+        payloads.append(view[offset:offset + length])
+        offset += length
+    return payloads
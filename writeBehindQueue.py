@@ -0,0 +1,119 @@
+"""
+Library module for the optional write-behind ingestion mode of the server.
+Validated aggregator payloads are placed on a bounded queue and a single writer thread drains
+it, storing many payloads per transaction through the ingestionManager.
+"""
+
+import logging
+import queue
+import threading
+import time
+from systemMetrics import DTO_Aggregator
+
+
+class writeBehindQueue:
+    def __init__(self, ingestion, logger=None, max_size: int = 1000, batch_size: int = 200, batch_wait: float = 0.05):
+        self.ingestion = ingestion
+        self.logger = logger or logging.getLogger()
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.stopping = threading.Event()
+        # Held to enqueue and to start stopping, so no payload is queued once the writer may have exited
+        self.submit_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.rejected = 0
+        self.committed_batches = 0
+        self.committed_payloads = 0
+        self.failed_payloads = 0
+        self.last_commit_ms = 0.0
+        self.max_commit_ms = 0.0
+        self.total_commit_ms = 0.0
+        self.writer = threading.Thread(target=self.drain, name="write-behind-writer", daemon=True)
+        self.writer.start()
+
+    def submit(self, dto_aggregator: DTO_Aggregator) -> bool:
+        """Queue a payload for storage. Returns False when the queue is full or shutting down."""
+        with self.submit_lock:
+            if self.stopping.is_set():
+                return False
+            try:
+                self.queue.put_nowait(dto_aggregator)
+            except queue.Full:
+                with self.stats_lock:
+                    self.rejected += 1
+                return False
+        with self.stats_lock:
+            self.enqueued += 1
+        return True
+
+    def drain(self):
+        """Writer thread loop. Runs until stopped and the queue is empty."""
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            # Give concurrent uploads a moment to arrive so they share the transaction
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self.store(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    def store(self, batch):
+        start = time.perf_counter()
+        try:
+            self.ingestion.ingestAggregators(batch)
+            stored, failed = len(batch), 0
+        except Exception as e:
+            # Retry one by one so a single bad payload does not discard the whole batch
+            self.logger.error("Write-behind batch of %s failed, retrying individually: %s", len(batch), e)
+            stored, failed = 0, 0
+            for dto_aggregator in batch:
+                try:
+                    self.ingestion.ingestAggregators([dto_aggregator])
+                    stored += 1
+                except Exception as e:
+                    self.logger.exception("Dropping payload from %s: %s", dto_aggregator.name, e)
+                    failed += 1
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self.stats_lock:
+            self.committed_batches += 1
+            self.committed_payloads += stored
+            self.failed_payloads += failed
+            self.last_commit_ms = elapsed_ms
+            self.max_commit_ms = max(self.max_commit_ms, elapsed_ms)
+            self.total_commit_ms += elapsed_ms
+
+    def stop(self, timeout: float = 30.0):
+        """Stop accepting payloads and wait for the writer to flush the queue."""
+        with self.submit_lock:
+            if self.stopping.is_set():
+                return
+            self.stopping.set()
+        self.writer.join(timeout)
+        if self.writer.is_alive():
+            self.logger.error("Write-behind writer did not flush within %ss, %s payloads lost", timeout, self.queue.qsize())
+        else:
+            self.logger.info("Write-behind queue flushed")
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_size': self.queue.maxsize,
+                'enqueued': self.enqueued,
+                'rejected': self.rejected,
+                'committed_batches': self.committed_batches,
+                'committed_payloads': self.committed_payloads,
+                'failed_payloads': self.failed_payloads,
+                'last_commit_ms': self.last_commit_ms,
+                'max_commit_ms': self.max_commit_ms,
+                'avg_commit_ms': self.total_commit_ms / self.committed_batches if self.committed_batches else 0.0
+            }